@@ -1,17 +1,32 @@
-from pymavlink.dialects.v10.common import MAVLink, MAVLink_message, MAVError
-from pymavlink.dialects.v10 import common
-from pymavlink import mavutil
+from pymavlink.dialects.v20.common import MAVLink, MAVLink_message, MAVError
+from pymavlink.dialects.v20 import common
 from serial import Serial
 from serial.serialutil import SerialException
 import sys
-from typing import Callable, List, Dict, Tuple
-from threading import Event, Thread
-from io import StringIO
+from typing import Any, Callable, List, Dict, Set, Tuple, Union
+from threading import Event, Lock, Thread
 from queue import Queue, Empty
 import time
 from enum import IntEnum
+import logging
 import utils
 from typing import Dict
+from mavlink_filter import FilteringMAVLink
+from fields import FieldSubscription, FieldWatcher
+from parameters import ParameterStore
+from link_stats import LinkStats
+from stream_rates import StreamRateController
+from dispatch import ExecutionPolicy, HandlerStats, MessageHandler, Overflow
+from rx_queue import RxQueue
+from baudrate import BAUDRATE_AUTO, DEFAULT_BAUDRATE, BaudrateCache, detect_baudrate
+from commands import CommandError, CommandManager
+from param_ftp import FtpError, FtpUnsupported, ParamFtpClient
+from scheduler import TimerHandle, get_scheduler
+from timesync import TimeSync
+from msg_template import MessageTemplate
+from param_fetch import ParameterFetcher
+from subscriptions import Subscription
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
 
 
 __all__ = ['ASAC']
@@ -19,6 +34,22 @@ __all__ = ['ASAC']
 
 REBOOT_AUTOPILOT = 1
 
+RX_QUEUE_SIZE = 200
+
+# High-rate state messages, where only the newest one matters
+CONFLATED_MESSAGES = [
+    common.MAVLink_attitude_message,
+    common.MAVLink_rc_channels_message,
+    common.MAVLink_battery_status_message,
+]
+
+# Messages that must never be dropped, even when we can't keep up
+CRITICAL_MESSAGES = [
+    common.MAVLink_param_value_message,
+    common.MAVLink_statustext_message,
+    common.MAVLink_command_ack_message,
+]
+
 
 class ASAC_State(IntEnum):
     NOT_CONNECTED = 0
@@ -30,11 +61,42 @@ class ASAC:
 
     MAVLINK_SYSTEM_ID = 0
 
+    TIMESYNC_INTERVAL_S = 1
+    HEARTBEAT_INTERVAL_S = 1
+    # Lower bounds of adaptive timeouts, since the vehicle needs some time
+    # to act, not only the link.
+    MIN_COMMAND_TIMEOUT_S = 0.2
+    MIN_PARAM_TIMEOUT_S = 0.2
+    # Writing to flash can take a while, regardless of the link
+    STORAGE_COMMAND_TIMEOUT_S = 2
+    # Used until the round trip time is measured
+    PARAM_SET_TIMEOUT_S = 0.5
+    PARAM_SET_RETRIES = 3
+    # PARAM_SETs in flight at a time
+    PARAM_SET_WINDOW = 16
+    # How long the PARAM_VALUE stream of a list download may pause, at least
+    MIN_PARAM_LIST_QUIET_S = 1
+    # The vehicle opens param.pck from flash before it answers, however
+    # fast the link is
+    MIN_FTP_TIMEOUT_S = 0.5
+    # Vehicles that don't know the request never answer
+    AUTOPILOT_VERSION_TIMEOUT_S = 1
+    # Rounds of requesting missing parameters by index after the stream
+    PARAM_LIST_RETRIES = 3
+
     def __init__(self,
                  port: str = None,
                  on_connect: callable = None,
-                 on_disconnect: callable = None) -> None:
+                 on_disconnect: callable = None,
+                 mavlink2: bool = True,
+                 baudrate: int = DEFAULT_BAUDRATE) -> None:
+        '''
+        If baudrate is BAUDRATE_AUTO, the baudrate is detected when starting,
+        and remembered per port for next time.
+        '''
         self.port = port
+        self.baudrate = baudrate
+        self._baudrate_cache = BaudrateCache()
         self.logger = utils.get_logger()
 
         if on_connect is None:
@@ -46,80 +108,173 @@ class ASAC:
 
         self._stop_flag = Event()
         self._stop_flag.set()
-        self._serial = Serial(baudrate=115200, timeout=0.5, write_timeout=5)
+        # Stops the threads of one connection. A new one is made for each
+        # connection, since threads of the last one may not have seen the
+        # stop yet when we quickly reconnect, eg after a reboot.
+        self._connection_stop = Event()
+        self._connection_stop.set()
+        self._serial = Serial(timeout=0.5, write_timeout=5)
         self._fake_file = self._serial#StringIO()
-        self._mav = MAVLink(self._fake_file)
-        self._rx = Queue()
-        self._msg_handlers: Dict[MAVLink_message, callable] = {}
+        self._mav = FilteringMAVLink(self._fake_file)
+        self.link_stats = LinkStats()
+        self._mav.on_frame = self.link_stats.record_frame
+        # We start out with MAVLink 1, and switch to MAVLink 2 if the vehicle
+        # speaks it.
+        self._mav.auto_mavlink2 = mavlink2
+        self._mav.on_mavlink2 = lambda: self.logger.info('Vehicle speaks MAVLink 2, switching to MAVLink 2')
+        self.stream_rates = StreamRateController(self)
+        self._rx = RxQueue(RX_QUEUE_SIZE, CONFLATED_MESSAGES, CRITICAL_MESSAGES)
+        # Lists of handlers are replaced rather than modified, so that the
+        # dispatch thread can iterate over them without locking.
+        self._msg_handlers: Dict[MAVLink_message, List[MessageHandler]] = {}
+        # Held while replacing them, since handlers come and go from any thread
+        self._handlers_lock = Lock()
+        # Futures of wait_for_message, failed when the connection is closed
+        self._waits: Set[Future] = set()
+        self._waits_lock = Lock()
+        self._field_watchers: Dict[MAVLink_message, FieldWatcher] = {}
+        self._field_watchers_lock = Lock()
         self._param_receive_timeout_ms = 2000
         self._first_tx_since_connected = True
         self._reboot_flag = Event()
         self._state = ASAC_State.NOT_CONNECTED
 
         self._REBOOT_RECONNECT_TIMEOUT_S = 3
+        # How long to wait for the port to go away after a reboot is acked.
+        # USB devices do, while a UART link just stays open.
+        self._REBOOT_DISCONNECT_TIMEOUT_S = 2
+
+        # Raw received bytes are written here while recording
+        self._recording = None
+        # Held while writing to the recording and while closing it
+        self._recording_lock = Lock()
+        # Called with the bytes of every valid received frame
+        self._raw_frame_handlers: List[Callable[[bytes], None]] = []
 
         self._serial_write = self._serial.write
+        # Frames are sent from many threads, and must not be interleaved
+        self._tx_lock = Lock()
 
         def write_wrapper(*args, **kwargs):
-            if self._first_tx_since_connected:
-                self._serial.flush()
-                self._first_tx_since_connected = True
-            self._serial_write(*args, **kwargs)
+            with self._tx_lock:
+                if self._first_tx_since_connected:
+                    self._serial.flush()
+                    self._first_tx_since_connected = True
+                self._serial_write(*args, **kwargs)
 
         self._serial.write = write_wrapper
 
-        self._param_values = Queue() # Queue[common.MAVLink_param_value_message]
+        # Prebuilt frames for the messages that are sent at high rates, eg
+        # while dragging a motor slider, where only a few fields change.
+        self._command_templates = {
+            common.MAV_CMD_DO_MOTOR_TEST: MessageTemplate(
+                self._mav,
+                common.MAVLink_command_long_message(self.MAVLINK_SYSTEM_ID,
+                                                    common.MAV_COMP_ID_ALL,
+                                                    common.MAV_CMD_DO_MOTOR_TEST,
+                                                    0, 0, 0, 0, 0, 0, 0, 0),
+                ['confirmation'] + [f'param{i}' for i in range(1, 8)])
+        }
+        self._param_set_template = MessageTemplate(
+            self._mav,
+            common.MAVLink_param_set_message(self.MAVLINK_SYSTEM_ID,
+                                             common.MAV_COMP_ID_ALL,
+                                             b'', 0, 0),
+            ['param_id', 'param_value', 'param_type'])
+        self._heartbeat_template = MessageTemplate(
+            self._mav,
+            common.MAVLink_heartbeat_message(common.MAV_TYPE_GCS,
+                                             common.MAV_AUTOPILOT_INVALID,
+                                             0, 0, 0, 3))
+        self._heartbeat_timer: TimerHandle = None
+
+        self.parameters = ParameterStore()
 
         # Add some default message handlers
         self.add_message_handler(common.MAVLink_param_value_message,
-                                 self._param_values.put)
-
-    def reboot(self) -> None:
-        self._mav.command_int_send(self.MAVLINK_SYSTEM_ID,
-                                   common.MAV_COMP_ID_ALL,
-                                   0,
-                                   common.MAV_CMD_PREFLIGHT_REBOOT_SHUTDOWN,
-                                   0,
-                                   0,
-                                   REBOOT_AUTOPILOT,
-                                   0,
-                                   0,
-                                   0,
-                                   0,
-                                   0,
-                                   0,
-                                   True)
-        self._serial.flushOutput()
-
-        # Quick-fix for now, should not have these hard-coded sleeps in future...
-        delay = 5
-        self.logger.info(f'Sending reboot request, waiting for {delay} seconds...')
-        time.sleep(delay)
-        self.logger.info('Closing serial connection')
-        self.stop()
-        self.logger.info('Opening serial connection')
-        time.sleep(1)
-        self.start()
-
-        # Once we reboot, we start a timer, waiting for the system reboots
-        # so that we can try to re-connect instantly after.
-        #self._reboot_flag.clear()
-        #self._wait_for_reboot()
-        #Thread(target=self._wait_for_reboot, daemon=True).start()
-
-    def set_parameters(self, parameters: Dict[str, Tuple[float, int]],
-                       on_complete: Callable) -> None:
-        for param in parameters:
-            param_value, param_type = parameters[param]
-            self.set_parameter(param, param_value, param_type)
+                                 self.parameters.update)
+
+        # Round trip time of the link, which timeouts are based on
+        self.timesync = TimeSync(self._send_timesync)
+        self._timesync_timer: TimerHandle = None
+        self.add_message_handler(common.MAVLink_timesync_message,
+                                 self.timesync.handle_message)
+
+        self.commands = CommandManager(
+            self._send_command,
+            lambda: self.timesync.timeout_s(CommandManager.DEFAULT_TIMEOUT_S,
+                                            self.MIN_COMMAND_TIMEOUT_S))
+        self.add_message_handler(common.MAVLink_command_ack_message,
+                                 self.commands.handle_ack)
+
+        # Single parameters, eg the ones shown on a page, are fetched by name
+        self._param_fetcher = ParameterFetcher(
+            self._send_param_request_read,
+            lambda: self.timesync.timeout_s(ParameterFetcher.DEFAULT_TIMEOUT_S,
+                                            self.MIN_PARAM_TIMEOUT_S))
+        self.add_message_handler(common.MAVLink_param_value_message,
+                                 self._param_fetcher.handle_message)
+
+        # Parameters are downloaded over FTP when the vehicle supports it
+        self.use_param_ftp = True
+        self._param_ftp_supported: bool = None
+        # Future of the AUTOPILOT_VERSION of the vehicle, requested on connect
+        self._autopilot_version: Future = None
+        self._param_ftp = ParamFtpClient(self._send_ftp)
+        self.add_message_handler(common.MAVLink_file_transfer_protocol_message,
+                                 self._param_ftp.handle_message)
+
+    def reboot(self) -> bool:
+        '''
+        Reboots the vehicle, and reconnects once it's back. Blocks until
+        then, returns True if we're connected again.
+        '''
+        self.logger.info('Sending reboot request')
+        try:
+            self.send_command(common.MAV_CMD_PREFLIGHT_REBOOT_SHUTDOWN,
+                              REBOOT_AUTOPILOT).result()
+        except CommandError as e:
+            self.logger.error(f'Reboot failed: {e}')
+            return False
+        except ConnectionError:
+            # The port went away before the ack, so it's rebooting already
+            pass
 
-        self._serial.flushOutput()
+        self._reboot_flag.clear()
+        self._wait_for_reboot()
+        return self.is_connected()
 
-        if on_complete:
-            # TODO: Real implementation, now we'll just wait some time...
-            # Assuming all Setters are OK
-            time.sleep(1)
+    def set_parameters(self, parameters: Dict[str, Tuple[float, int]],
+                       on_complete: Callable[[], None] = None) -> bool:
+        '''
+        Sets the parameters, {name: (value, type)}, and waits until the
+        vehicle has confirmed all of them. on_complete is then called, unless
+        some parameter failed. Blocks, so it mustn't be called from the
+        dispatch thread. Returns True if all parameters were set.
+        '''
+        names = list(parameters)
+        failed = []
+        # A window at a time, so a large set doesn't overrun the vehicle
+        for start in range(0, len(names), self.PARAM_SET_WINDOW):
+            futures = {name: self.set_parameter(name, *parameters[name])
+                       for name in names[start:start + self.PARAM_SET_WINDOW]}
+            # All attempts, with some slack. The futures fail by themselves
+            # before that, unless the timers can't run.
+            deadline = time.monotonic() + (self.PARAM_SET_RETRIES + 2) * \
+                self.timesync.timeout_s(self.PARAM_SET_TIMEOUT_S, self.MIN_PARAM_TIMEOUT_S)
+            for name, future in futures.items():
+                try:
+                    future.result(max(deadline - time.monotonic(), 0))
+                except (TimeoutError, FutureTimeoutError, ConnectionError):
+                    future.cancel()
+                    failed.append(name)
+
+        if failed:
+            self.logger.error(f'Failed to set parameters: {", ".join(failed)}')
+            return False
+        if on_complete is not None:
             on_complete()
+        return True
 
     def wait_until_rebooted(self) -> bool:
         '''
@@ -131,11 +286,11 @@ class ASAC:
         return self.is_connected()
 
     def _wait_for_reboot(self) -> None:
-        # Need to wait some time before closing serial port, to ensure that
-        # reboot packed was successfully sent. Not a fan of hardcoding the
-        # timeout value, but works for now.
-        time.sleep(.5)
-        self.stop()
+        if not self._stop_flag.wait(self._REBOOT_DISCONNECT_TIMEOUT_S):
+            # The link stayed up through the reboot
+            self._reboot_flag.set()
+            return
+        self.logger.info('Reconnecting after reboot')
 
         t0 = time.time()
         reconnected = False
@@ -144,81 +299,354 @@ class ASAC:
             try:
                 reconnected = self.start()
             except SerialException:
-                pass
-            time.sleep(.1)
+                time.sleep(.1)
 
         self._reboot_flag.set()
 
-    def add_message_handler(self, msg_type: MAVLink_message, callback: callable) -> None:
+    def add_message_handler(self,
+                            msg_type: MAVLink_message,
+                            callback: callable,
+                            policy: ExecutionPolicy = ExecutionPolicy.INLINE,
+                            queue_size: int = 100,
+                            overflow: Overflow = Overflow.DROP_OLDEST) -> None:
         '''
         Need to specify mavlink message class instead of ID, since some mavlink
         messages has ID as attribute (eg MAVLink_battery_status_message),
         so if we identified the messages with ID this fails.
-        '''
-        if msg_type not in self._msg_handlers:
-            self._msg_handlers[msg_type] = []
 
-        self._msg_handlers[msg_type].append(callback)
+        Inline handlers are called from the dispatch thread, and should be
+        quick, since they delay all other messages. Slow handlers should use
+        a worker or the shared pool instead, see dispatch.MessageHandler.
+        '''
+        self._add_handler(msg_type, MessageHandler(callback, policy, queue_size, overflow))
+
+    def del_message_handler(self, msg_type: MAVLink_message, callback: callable) -> None:
+        if not self._del_handler(msg_type, callback):
+            raise ValueError(f'{callback} is not a handler of {msg_type.msgname}')
+
+    def subscribe(self,
+                  msg_type: MAVLink_message,
+                  callback: Callable[[MAVLink_message], None],
+                  predicate: Callable[[MAVLink_message], bool] = None,
+                  once: bool = False,
+                  timeout_s: float = None,
+                  on_timeout: Callable[[], None] = None,
+                  policy: ExecutionPolicy = ExecutionPolicy.INLINE,
+                  queue_size: int = 100,
+                  overflow: Overflow = Overflow.DROP_OLDEST) -> Subscription:
+        '''
+        Like add_message_handler, but returns a handle to cancel the handler
+        with, and the callback can be limited to the messages that
+        `predicate` returns True for, to the first of them (`once`), and to
+        a time window (`timeout_s`, after which `on_timeout` is called if
+        nothing was delivered). See subscriptions.Subscription.
+        '''
+        subscription = Subscription(msg_type, callback,
+                                    lambda s: self._del_handler(msg_type, s),
+                                    predicate, once, on_timeout)
+        self._add_handler(msg_type, MessageHandler(subscription, policy, queue_size, overflow))
+        if timeout_s is not None:
+            subscription.set_timeout(timeout_s)
+        return subscription
+
+    def wait_for_message(self,
+                         msg_type: MAVLink_message,
+                         predicate: Callable[[MAVLink_message], bool] = None,
+                         timeout_s: float = None) -> Future:
+        '''
+        Returns a future of the next message of the type that `predicate`, if
+        given, returns True for. It fails with TimeoutError if there is none
+        within timeout_s, or ConnectionError if the connection is closed.
+        Cancelling the future stops waiting.
+
+        For request/response flows, wait before sending the request, so the
+        response can't be missed. Future callbacks are called from the
+        dispatch thread, so they shouldn't block.
+        '''
+        future = Future()
+        subscription = self.subscribe(
+            msg_type,
+            lambda msg: utils.try_set(future.set_result, msg),
+            predicate,
+            once=True,
+            timeout_s=timeout_s,
+            on_timeout=lambda: utils.try_set(future.set_exception, TimeoutError(
+                f'No {msg_type.msgname} within {timeout_s:.2f} s')))
+
+        with self._waits_lock:
+            self._waits.add(future)
+
+        def done(future: Future) -> None:
+            subscription.cancel()
+            with self._waits_lock:
+                self._waits.discard(future)
+
+        future.add_done_callback(done)
+        return future
+
+    def _add_handler(self, msg_type: MAVLink_message, handler: MessageHandler) -> None:
+        with self._handlers_lock:
+            handlers = self._msg_handlers.get(msg_type, [])
+            self._msg_handlers[msg_type] = handlers + [handler]
+            self._update_wanted_ids()
+
+    def _del_handler(self, msg_type: MAVLink_message, callback: callable) -> bool:
+        ''' Returns False if the callback isn't a handler of the type. '''
+        with self._handlers_lock:
+            handlers = self._msg_handlers.get(msg_type, [])
+            for handler in handlers:
+                if handler.callback == callback:
+                    break
+            else:
+                return False
+            self._msg_handlers[msg_type] = [h for h in handlers if h is not handler]
+            self._update_wanted_ids()
+        handler.close()
+        return True
 
-    def del_message_handler(self, msg_id: int, callback: callable) -> None:
-        handlers = self._msg_handlers.get(msg_id, [])
-        handlers.remove(callback)
+    def rx_queue_stats(self) -> Tuple[int, int, int]:
+        '''
+        Returns (queued, dropped, conflated) of the queue between the RX
+        thread and the dispatch thread.
+        '''
+        return self._rx.qsize(), self._rx.dropped, self._rx.conflated
+
+    def handler_stats(self) -> Dict[str, List[HandlerStats]]:
+        ''' Returns statistics, eg lag, of all handlers per message type. '''
+        return {msg_type.msgname: [handler.stats() for handler in handlers]
+                for msg_type, handlers in list(self._msg_handlers.items())}
+
+    def add_field_handler(self,
+                          msg_type: MAVLink_message,
+                          field: str,
+                          callback: Callable[[Any], None],
+                          deadband: float = 0,
+                          max_rate_hz: float = None) -> FieldSubscription:
+        '''
+        Subscribes to a single field of a message type, eg the `roll` field of
+        MAVLink_attitude_message. The callback is called with the new value,
+        but only when the value changes by more than `deadband`, and at most
+        `max_rate_hz` times per second.
+        '''
+        subscription = FieldSubscription(field, callback, deadband, max_rate_hz)
+        with self._field_watchers_lock:
+            watcher = self._field_watchers.get(msg_type)
+            if watcher is None:
+                watcher = FieldWatcher()
+                self._field_watchers[msg_type] = watcher
+                # Field handlers are only interested in the latest state, so
+                # intermediate messages can be skipped if the handlers are slow.
+                self.add_message_handler(msg_type, watcher,
+                                         policy=ExecutionPolicy.WORKER,
+                                         queue_size=1,
+                                         overflow=Overflow.CONFLATE)
+            watcher.add(subscription)
+        return subscription
+
+    def del_field_handler(self,
+                          msg_type: MAVLink_message,
+                          subscription: FieldSubscription) -> None:
+        with self._field_watchers_lock:
+            watcher = self._field_watchers.get(msg_type)
+            if watcher is None:
+                return
+            if not watcher.remove(subscription):
+                del self._field_watchers[msg_type]
+                self.del_message_handler(msg_type, watcher)
+
+    def _update_wanted_ids(self) -> None:
+        '''
+        Only messages that have at least one handler are decoded, everything
+        else is dropped by the parser directly after reading the header.
+        Called with _handlers_lock held.
+        '''
+        self._mav.wanted_ids = {msg_type.id for msg_type, handlers
+                                in self._msg_handlers.items() if handlers}
 
-    def reset_parameters(self) -> None:
+    def send_command(self, command: int, *params: float, **kwargs) -> Future:
+        '''
+        Sends a command with up to 7 params, returns a future of its
+        COMMAND_ACK. See commands.CommandManager.
+        '''
+        return self.commands.send(command, *params, **kwargs)
+
+    def _send_command(self, command: int, confirmation: int, params: List[float]) -> None:
+        template = self._command_templates.get(command)
+        if template is not None:
+            template.send(confirmation, *params)
+            return
+        self._mav.command_long_send(self.MAVLINK_SYSTEM_ID,
+                                    common.MAV_COMP_ID_ALL,
+                                    command,
+                                    confirmation,
+                                    *params)
+
+    def _send_param_request_read(self, name: str) -> None:
+        self._mav.param_request_read_send(self.MAVLINK_SYSTEM_ID,
+                                          common.MAV_COMP_ID_ALL,
+                                          name.encode(),
+                                          -1)
+
+    def _send_timesync(self, tc1: int, ts1: int) -> None:
+        try:
+            self._mav.timesync_send(tc1, ts1)
+        except SerialException:
+            # Sent from a timer, which may race with stop()
+            pass
+
+    def _send_heartbeat(self) -> None:
+        try:
+            self._heartbeat_template.send()
+        except SerialException:
+            # Sent from a timer, which may race with stop()
+            pass
+
+    def message_age(self, msg: MAVLink_message) -> float:
+        '''
+        Returns how many seconds ago a message with a `time_boot_ms` field,
+        eg ATTITUDE, was created on the vehicle, including the link latency.
+        Returns None if that isn't known (yet).
+        '''
+        time_boot_ms = getattr(msg, 'time_boot_ms', None)
+        if time_boot_ms is None:
+            return None
+        created = self.timesync.to_local_time(time_boot_ms)
+        if created is None:
+            return None
+        return time.monotonic() - created
+
+    def _send_ftp(self, payload: List[int]) -> None:
+        self._mav.file_transfer_protocol_send(0,
+                                              self.MAVLINK_SYSTEM_ID,
+                                              common.MAV_COMP_ID_ALL,
+                                              payload)
+
+    def reset_parameters(self) -> Future:
         PARAM_RESET_CONFIG_DEFAULT = 2
+        return self.send_command(common.MAV_CMD_PREFLIGHT_STORAGE,
+                                 PARAM_RESET_CONFIG_DEFAULT,
+                                 timeout_s=self.STORAGE_COMMAND_TIMEOUT_S)
 
-        self._mav.command_int_send(self.MAVLINK_SYSTEM_ID,
-                            common.MAV_COMP_ID_ALL,
-                            0,
-                            common.MAV_CMD_PREFLIGHT_STORAGE,
-                            0,
-                            0,
-                            PARAM_RESET_CONFIG_DEFAULT,
-                            0,
-                            0,
-                            0,
-                            0,
-                            0,
-                            0,
-                            True)
-
-    def write_params_to_flash(self, on_complete: Callable) -> None:
+    def write_params_to_flash(self, on_complete: Callable[[], None]) -> Future:
+        '''
+        Writes the parameters to flash. on_complete is called once the
+        vehicle has acked, from the thread that received the ack, so it must
+        not block.
+        '''
         PARAM_WRITE_PERSISTENT = 1
-        self._mav.command_int_send(self.MAVLINK_SYSTEM_ID,
-                            common.MAV_COMP_ID_ALL,
-                            0,
-                            common.MAV_CMD_PREFLIGHT_STORAGE,
-                            0,
-                            0,
-                            PARAM_WRITE_PERSISTENT,
-                            0,
-                            0,
-                            0,
-                            0,
-                            0,
-                            0,
-                            True)
-
-    def set_parameter(self, name: str, value: float, type: int,
-                      on_ack: Callable[[common.MAVLink_message], None] = None) -> None:
-        #def cb(msg):
-        #    # Remove temporary message handler
-        #    self.del_message_handler(common.MAVLINK_MSG_ID_PARAM_VALUE, cb)
-        #    if on_ack is not None:
-        #        on_ack(msg)
-
-        #self.add_message_handler(common.MAVLINK_MSG_ID_PARAM_VALUE, cb)
-        self._mav.param_set_send(self.MAVLINK_SYSTEM_ID,
-                                 common.MAV_COMP_ID_ALL,
-                                 name,
-                                 value,
-                                 type,
-                                 True)
-
-    def set_parameter_blocking(self, name: str, value: float, type: int) -> None:
-        self.set_parameter()
-        response = self._get_parameters.get()
-        print(response)
+        future = self.send_command(common.MAV_CMD_PREFLIGHT_STORAGE,
+                                   PARAM_WRITE_PERSISTENT,
+                                   timeout_s=self.STORAGE_COMMAND_TIMEOUT_S)
+
+        def done(future: Future) -> None:
+            if future.cancelled():
+                self.logger.warning('Writing parameters to flash was cancelled')
+                return
+            if future.exception() is not None:
+                self.logger.error(f'Failed to write parameters to flash: {future.exception()}')
+            elif on_complete is not None:
+                on_complete()
+
+        future.add_done_callback(done)
+        return future
+
+    def set_parameter(self, name: Union[str, bytes], value: float, type: int,
+                      on_ack: Callable[[common.MAVLink_message], None] = None,
+                      retries: int = PARAM_SET_RETRIES) -> Future:
+        '''
+        Sets a parameter. Returns a future of the PARAM_VALUE the vehicle
+        answers with, which has the value it actually took. PARAM_SET is
+        retransmitted if the answer doesn't come in time, and the future
+        fails with TimeoutError after `retries` retransmissions, or with
+        ConnectionError if the connection is closed.
+
+        on_ack is called with the PARAM_VALUE, from the thread that received
+        it, so it must not block.
+        '''
+        if isinstance(name, bytes):
+            # PARAM_VALUE names are str, which the answer is matched by
+            name = name.rstrip(b'\x00').decode('ascii', errors='replace')
+
+        result = Future()
+        if on_ack is not None:
+            def acked(future: Future) -> None:
+                if not future.cancelled() and future.exception() is None:
+                    on_ack(future.result())
+
+            result.add_done_callback(acked)
+
+        def attempt(attempts_left: int) -> None:
+            # Waiting before sending, so the answer can't be missed
+            answer = self.wait_for_message(
+                common.MAVLink_param_value_message,
+                lambda msg: msg.param_id == name,
+                self.timesync.timeout_s(self.PARAM_SET_TIMEOUT_S, self.MIN_PARAM_TIMEOUT_S))
+            answer.add_done_callback(lambda answer: answered(answer, attempts_left))
+            try:
+                self._param_set_template.send(name, value, type)
+            except SerialException:
+                answer.cancel()
+                utils.try_set(result.set_exception, ConnectionError('Connection closed'))
+
+        def answered(answer: Future, attempts_left: int) -> None:
+            if answer.cancelled() or result.done():
+                # Eg the caller gave up
+                return
+            exception = answer.exception()
+            if exception is None:
+                utils.try_set(result.set_result, answer.result())
+            elif isinstance(exception, TimeoutError) and attempts_left > 0:
+                self.logger.debug(f'Retransmitting PARAM_SET of {name}')
+                attempt(attempts_left - 1)
+            elif isinstance(exception, TimeoutError):
+                utils.try_set(result.set_exception, TimeoutError(
+                    f'No answer when setting {name} after {retries + 1} attempts'))
+            else:
+                utils.try_set(result.set_exception, exception)
+
+        attempt(retries)
+        return result
+
+    def set_parameter_blocking(self, name: str, value: float, type: int) -> common.MAVLink_param_value_message:
+        '''
+        Sets a parameter, returns the PARAM_VALUE the vehicle answers with.
+        Raises TimeoutError or ConnectionError, see set_parameter.
+        '''
+        return self.set_parameter(name, value, type).result()
+
+    def _get_parameters_ftp(self) -> Dict[str, common.MAVLink_param_value_message]:
+        '''
+        Downloads all parameters in one file over MAVLink FTP, which is much
+        faster than one message per parameter. Returns None if the vehicle
+        doesn't support it.
+        '''
+        if self._supports_ftp() is False:
+            self.logger.info('Parameter download over FTP not supported by the vehicle')
+            self._param_ftp_supported = False
+            return None
+
+        self._param_ftp.timeout_s = self.timesync.timeout_s(ParamFtpClient.DEFAULT_TIMEOUT_S,
+                                                            self.MIN_FTP_TIMEOUT_S)
+        try:
+            params = self._param_ftp.get_parameters()
+        except FtpUnsupported as e:
+            self.logger.info(f'Parameter download over FTP not supported: {e}')
+            self._param_ftp_supported = False
+            return None
+        except FtpError as e:
+            self.logger.warning(f'Parameter download over FTP failed: {e}')
+            return None
+
+        self._param_ftp_supported = True
+        # Handled as if they were received one at a time, so that everyone
+        # sees the same parameter messages.
+        msgs = {}
+        for index, (name, value, param_type) in enumerate(params):
+            msg = common.MAVLink_param_value_message(name.encode(), value, param_type,
+                                                     len(params), index)
+            self.parameters.update(msg)
+            msgs[name] = msg
+        return msgs
 
     def _get_parameters(self,
                        on_complete: Callable[..., dict] = None,
@@ -226,47 +654,108 @@ class ASAC:
                        delay_between_attempts_ms: int = 1000) -> None:
 
         attempt = 1
-        params = []
+        params = None
 
-        while attempt < max_attempts and self._param_values.empty():
-            self.logger.info('> Sending PARAM Request')
-            # Send a PARAM Request list message
-            self._mav.param_request_list_send(self.MAVLINK_SYSTEM_ID,
-                                          common.MAV_COMP_ID_ALL,
-                                          True)
-            # Wait for some time for us to get response
-            time.sleep(self._param_receive_timeout_ms / 1000)
+        if self.use_param_ftp and self._param_ftp_supported is not False:
+            params = self._get_parameters_ftp()
+            if params is not None:
+                # Skip the list request below
+                attempt = max_attempts
 
-            if self._param_values.empty():
+        received = {}
+        while attempt < max_attempts and not received:
+            self.logger.info('> Sending PARAM Request')
+            # Only subscribed while downloading, so values from other
+            # requests don't pile up in between.
+            param_values = Queue() # Queue[common.MAVLink_param_value_message]
+            subscription = self.subscribe(common.MAVLink_param_value_message,
+                                          param_values.put)
+            try:
+                # Send a PARAM Request list message
+                self._mav.param_request_list_send(self.MAVLINK_SYSTEM_ID,
+                                                  common.MAV_COMP_ID_ALL)
+                received = self._receive_param_values(param_values)
+            finally:
+                subscription.cancel()
+
+            if not received:
                 # If we got no response, we'll wait some time before sending
                 # another request
                 time.sleep(delay_between_attempts_ms / 1000)
                 attempt += 1
 
-        params = {}
-        while not self._param_values.empty():
-            param = self._param_values.get()
-            params[param.param_id] = param
+        if params is None:
+            params = {}
+        params.update(received)
 
-        self.logger.info(f'Recevied params {len(params)} parameters:')
-        for name, p in params.items():
-            self.logger.info(f'    {name}: {p.param_value}')
+        self.logger.info(f'Received {len(params)} parameters')
+        if self.logger.isEnabledFor(logging.DEBUG):
+            # One record, instead of one per parameter
+            self.logger.debug('Parameters:\n' + '\n'.join(
+                f'    {name}: {p.param_value}' for name, p in params.items()))
 
         if on_complete is not None:
             on_complete(params)
 
+    def _receive_param_values(self, param_values: Queue) -> Dict[str, common.MAVLink_param_value_message]:
+        '''
+        Collects PARAM_VALUEs until all `param_count` parameters are there.
+        When the stream goes quiet before that, the missing ones are
+        requested by index, up to PARAM_LIST_RETRIES times.
+        '''
+        # The vehicle may pause the stream, eg while busy, so don't go by the
+        # link alone.
+        timeout_s = max(self.timesync.timeout_s(self._param_receive_timeout_ms / 1000,
+                                                self.MIN_PARAM_TIMEOUT_S),
+                        self.MIN_PARAM_LIST_QUIET_S)
+        received = {}
+        indices = set()
+        param_count = None
+        retries = 0
+        while param_count is None or len(indices) < param_count:
+            try:
+                param = param_values.get(timeout=timeout_s)
+            except Empty:
+                if param_count is None or retries >= self.PARAM_LIST_RETRIES:
+                    break
+                retries += 1
+                missing = [index for index in range(param_count) if index not in indices]
+                self.logger.info(f'Requesting {len(missing)} missing parameters')
+                for index in missing:
+                    self._mav.param_request_read_send(self.MAVLINK_SYSTEM_ID,
+                                                      common.MAV_COMP_ID_ALL,
+                                                      b'', index)
+                continue
+            received[param.param_id] = param
+            param_count = param.param_count
+            if param.param_index < param_count:
+                indices.add(param.param_index)
+        return received
+
+    def fetch_parameters(self, names: List[str]) -> Future:
+        '''
+        Fetches the given parameters by name, which is much faster than
+        downloading all of them when only a few are needed. The values end
+        up in `parameters` as they arrive. Returns a future of
+        {name: (value, type)}, without the parameters the vehicle doesn't
+        have.
+        '''
+        return self._param_fetcher.fetch(names)
+
     def get_parameters(self,
                        on_complete: Callable[..., dict] = None,
                        max_attempts: int = 5,
-                       delay_between_attempts_ms: int = 1000) -> None:
-
-        Thread(target=self._get_parameters,
-               args=(on_complete,
-                     max_attempts,
-                     delay_between_attempts_ms),
-               daemon=True).start()
+                       delay_between_attempts_ms: int = 1000) -> Future:
+        '''
+        Downloads all parameters in the background. Returns a future that
+        is done after on_complete was called, or failed if the download did.
+        '''
+        return get_scheduler().submit(self._get_parameters,
+                               on_complete,
+                               max_attempts,
+                               delay_between_attempts_ms)
 
-    def set_motor_throttle_test(self, motor: int, throttle: int) -> None:
+    def set_motor_throttle_test(self, motor: int, throttle: int) -> Future:
         '''
         Sets the throttle of the given motor to the given throttle.
 
@@ -274,31 +763,136 @@ class ASAC:
             motor: Number of motor, eg 1, 2, ...
             throttle: Throttle value of motor, 0-100.
         '''
-        self._mav.command_int_send(
+        # Sent continuously, so a lost command is replaced by the next one
+        # rather than retransmitted.
+        return self.send_command(common.MAV_CMD_DO_MOTOR_TEST,
+                                 motor,
+                                 common.MOTOR_TEST_THROTTLE_PERCENT,
+                                 throttle,
+                                 retries=0,
+                                 replace=True)
+
+    def set_message_interval(self, msg_id: int, rate_hz: float) -> Future:
+        '''
+        Asks the vehicle to stream the given message at the given rate.
+        A rate of 0 restores the default rate of the vehicle.
+        '''
+        if rate_hz > 0:
+            interval_us = 1e6 / rate_hz
+        else:
+            interval_us = 0
+
+        return self.send_command(common.MAV_CMD_SET_MESSAGE_INTERVAL,
+                                 msg_id,
+                                 interval_us)
+
+    def _get_baudrate(self) -> int:
+        if self.baudrate != BAUDRATE_AUTO:
+            return self.baudrate
+
+        baudrate = detect_baudrate(self.port, cache=self._baudrate_cache)
+        if baudrate is None:
+            self.logger.warning(f'Failed to detect baudrate on {self.port}, using {DEFAULT_BAUDRATE}')
+            baudrate = DEFAULT_BAUDRATE
+        return baudrate
+
+    def uses_mavlink2(self) -> bool:
+        return self._mav.use_mavlink2
+
+    def mavlink2_savings(self) -> Dict[str, Tuple[int, int, int]]:
+        '''
+        Returns how many bytes MAVLink 2 has saved, per message type, as
+        (frames, bytes saved by payload truncation, net bytes saved compared
+        to MAVLink 1). The net value includes the 4 bytes larger MAVLink 2
+        header, so it can be negative for messages that are rarely truncated.
+        '''
+        MAVLINK2_EXTRA_HEADER_LEN = 4
+        savings = {}
+        for msg_id, (frames, truncated) in list(self._mav.mavlink2_savings.items()):
+            msg_type = common.mavlink_map.get(msg_id)
+            name = msg_type.msgname if msg_type is not None else str(msg_id)
+            savings[name] = (frames, truncated,
+                             truncated - frames * MAVLINK2_EXTRA_HEADER_LEN)
+        return savings
+
+    def _request_protocol_version(self) -> None:
+        '''
+        Asks the vehicle for its protocol version, using MAVLink 2 framing.
+        A vehicle that speaks MAVLink 2 answers in MAVLink 2, which makes us
+        switch, while a MAVLink 1 vehicle just drops the request.
+        '''
+        msg = self._mav.command_long_encode(
             self.MAVLINK_SYSTEM_ID,
             common.MAV_COMP_ID_ALL,
+            common.MAV_CMD_REQUEST_PROTOCOL_VERSION,
             0,
-            common.MAV_CMD_DO_MOTOR_TEST,
-            0, 0,
-            motor, # 1
-            common.MOTOR_TEST_THROTTLE_PERCENT, # 2
-            throttle, # 3
-            0, 0, 0, 0
+            1, # 1: Request protocol version
+            0, 0, 0, 0, 0, 0
         )
-
-    def start(self, port: str = None) -> bool:
+        self._mav.send_mavlink2(msg)
+
+    def _request_autopilot_version(self) -> None:
+        ''' Asks for AUTOPILOT_VERSION, which tells eg whether FTP is supported. '''
+        self._autopilot_version = self.wait_for_message(common.MAVLink_autopilot_version_message,
+                                                        timeout_s=self.AUTOPILOT_VERSION_TIMEOUT_S)
+        self.send_command(common.MAV_CMD_REQUEST_MESSAGE,
+                          common.MAVLINK_MSG_ID_AUTOPILOT_VERSION)
+
+    def _supports_ftp(self) -> bool:
+        ''' Returns whether the vehicle advertises FTP, None if we don't know. '''
+        if self._autopilot_version is None:
+            return None
+        try:
+            version = self._autopilot_version.result()
+        except (TimeoutError, ConnectionError):
+            return None
+        return bool(version.capabilities & common.MAV_PROTOCOL_CAPABILITY_FTP)
+
+    def link_capacity(self) -> float:
+        ''' Returns how many bytes per second the link can carry. '''
+        # 8N1, ie 10 bits on the wire per byte
+        return self._serial.baudrate / 10
+
+    def start(self, port: str = None, baudrate: int = None) -> bool:
         if not self._stop_flag.is_set():
             return False
 
         if port is not None:
             self.port = port
+        if baudrate is not None:
+            self.baudrate = baudrate
 
         self._serial.port = self.port
+        self._serial.baudrate = self._get_baudrate()
 
         self._serial.open()
+        self.parameters.clear()
+        self._param_ftp_supported = None
+        self._rx.clear()
+        self.link_stats.reset()
+        self._mav.reset()
+        connection_stop = self._connection_stop = Event()
         self._stop_flag.clear()
-        Thread(target=self._receive_thread, daemon=True).start()
-        Thread(target=self._msg_handler_thread, daemon=True).start()
+        Thread(target=self._receive_thread, args=(connection_stop, ), name='asac-rx',
+               daemon=True).start()
+        Thread(target=self._msg_handler_thread, args=(connection_stop, ), name='asac-dispatch',
+               daemon=True).start()
+        self.stream_rates.reset()
+        Thread(target=self.stream_rates.run, args=(connection_stop, ), name='asac-stream-rates',
+               daemon=True).start()
+        Thread(target=self.commands.run, args=(connection_stop, ), name='asac-commands',
+               daemon=True).start()
+        Thread(target=self._param_fetcher.run, args=(connection_stop, ), name='asac-param-fetch',
+               daemon=True).start()
+        self._heartbeat_timer = get_scheduler().call_every(self.HEARTBEAT_INTERVAL_S,
+                                                           self._send_heartbeat)
+        self.timesync.reset()
+        self._timesync_timer = get_scheduler().call_every(self.TIMESYNC_INTERVAL_S,
+                                                          self.timesync.send_request)
+
+        if self._mav.auto_mavlink2:
+            self._request_protocol_version()
+        self._request_autopilot_version()
 
         if self.on_connect is not None:
             self.on_connect()
@@ -307,51 +901,124 @@ class ASAC:
 
         return True
 
+    def add_raw_frame_handler(self, callback: Callable[[bytes], None]) -> None:
+        '''
+        Adds a handler that is called with the raw bytes of every valid
+        received frame, decoded or not, eg to forward them. It's called from
+        the RX thread, so it must be quick.
+        '''
+        self._raw_frame_handlers = self._raw_frame_handlers + [callback]
+        self._mav.on_raw_frame = self._on_raw_frame
+
+    def del_raw_frame_handler(self, callback: Callable[[bytes], None]) -> None:
+        self._raw_frame_handlers = [h for h in self._raw_frame_handlers if h != callback]
+        if not self._raw_frame_handlers:
+            # Saves copying every frame
+            self._mav.on_raw_frame = None
+
+    def _on_raw_frame(self, frame: bytes) -> None:
+        for handler in self._raw_frame_handlers:
+            handler(frame)
+
+    def send_raw(self, data: bytes) -> None:
+        ''' Sends already encoded frames to the vehicle. '''
+        self._serial.write(data)
+
+    def start_recording(self, path: str) -> None:
+        '''
+        Records all received raw bytes to the given file, which can later be
+        exported with export.TelemetryExporter.export_log.
+        '''
+        recording = open(path, 'ab')
+        with self._recording_lock:
+            previous, self._recording = self._recording, recording
+        if previous is not None:
+            previous.close()
+
+    def stop_recording(self) -> None:
+        with self._recording_lock:
+            recording, self._recording = self._recording, None
+        if recording is not None:
+            # The RX thread can't be writing to it anymore
+            recording.close()
+
     def is_connected(self) -> None:
         return self._serial.is_open
 
+    def wait_until_stopped(self, timeout: float = None) -> bool:
+        '''
+        Blocks the calling thread until ASAC is stopped, or until the timeout
+        expires. Returns True if ASAC is stopped.
+        '''
+        return self._stop_flag.wait(timeout)
+
     def stop(self) -> None:
         if self._stop_flag.is_set():
             return False
 
+        self._connection_stop.set()
         self._stop_flag.set()
-        self._serial.close()
+        for timer in (self._timesync_timer, self._heartbeat_timer):
+            if timer is not None:
+                timer.cancel()
+        # A timer that already fired may be sending right now
+        with self._tx_lock:
+            self._serial.close()
+        self.commands.cancel_all()
+        self._param_fetcher.cancel_all()
+        with self._waits_lock:
+            waits = list(self._waits)
+        for future in waits:
+            utils.try_set(future.set_exception, ConnectionError('Connection closed'))
 
         if self.on_disconnect is not None:
             self.on_disconnect()
 
         return True
 
-    def _msg_handler_thread(self) -> None:
-        while not self._stop_flag.is_set():
+    def _msg_handler_thread(self, stop_flag: Event) -> None:
+        while not stop_flag.is_set():
             try:
                 msg: MAVLink_message = self._rx.get(timeout=1)
                 msg_type = type(msg)
                 handlers = self._msg_handlers.get(msg_type)
 
                 if not handlers:
-                    print(f'No handler found for message: {msg}')
+                    self.logger.debug(f'No handler found for message: {msg}')
                     pass
                 else:
                     for handler in handlers:
-                        handler(msg)
+                        try:
+                            handler(msg)
+                        except Exception:
+                            # A broken handler mustn't stop the dispatch of
+                            # everything else
+                            self.logger.exception(f'Exception in message handler {handler.callback}')
             except Empty:
                 pass
             except TimeoutError:
                 pass
 
-    def _receive_thread(self) -> None:
+    def _receive_thread(self, stop_flag: Event) -> None:
         self.logger.info('RX Thread started')
-        while not self._stop_flag.is_set():
+        while not stop_flag.is_set():
             try:
                 byte = self._serial.read(1)
                 if byte:
+                    if self._recording is not None:
+                        with self._recording_lock:
+                            if self._recording is not None:
+                                self._recording.write(byte)
                     try:
                         res = self._mav.parse_char(byte)
                         if res:
+                            res._rx_time = time.monotonic()
                             self._rx.put(res)
-                    except MAVError:
-                        pass
+                    except MAVError as e:
+                        if 'CRC' in e.message:
+                            self.link_stats.record_crc_error()
+                        else:
+                            self.link_stats.record_parse_error()
             except SerialException:
                 # Device probably disconnected itself
                 self.logger.warning('Device disconnected or multiple access on port?')
@@ -366,5 +1033,7 @@ if __name__ == '__main__':
     PORT = sys.argv[1]
     asac = ASAC(PORT)
     asac.start()
-    while True:
-        pass
\ No newline at end of file
+    try:
+        asac.wait_until_stopped()
+    except KeyboardInterrupt:
+        asac.stop()
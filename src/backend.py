@@ -70,9 +70,9 @@ class Transport:
 
 class TransportSerial(Transport):
 
-    def __init__(self, port) -> None:
+    def __init__(self, port, baudrate: int = 115200) -> None:
         super().__init__()
-        self._serial = Serial(baudrate=115200)
+        self._serial = Serial(baudrate=baudrate)
         self._serial.port = port
 
     @abstractmethod
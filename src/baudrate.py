@@ -0,0 +1,127 @@
+from pymavlink.dialects.v20.common import MAVLink, MAVError, MAVLink_heartbeat_message
+from serial import Serial
+from serial.serialutil import SerialException
+from pathlib import Path
+from threading import Lock
+from typing import Dict, List
+import json
+import time
+import utils
+
+
+__all__ = ['BAUDRATE_AUTO', 'DEFAULT_BAUDRATE', 'BaudrateCache', 'detect_baudrate']
+
+
+# Use as baudrate to detect it automatically
+BAUDRATE_AUTO = 0
+
+DEFAULT_BAUDRATE = 115200
+
+CANDIDATE_BAUDRATES = [115200, 57600, 230400, 460800, 921600, 38400, 9600]
+
+
+class BaudrateCache:
+    '''
+    Remembers which baudrate worked for each port, stored as json on disk so
+    it survives restarts.
+    '''
+
+    DEFAULT_PATH = Path(__file__).absolute().parent.parent.joinpath('baudrates.json')
+
+    def __init__(self, path: Path = DEFAULT_PATH) -> None:
+        self._path = path
+        self._lock = Lock()
+        self._baudrates: Dict[str, int] = {}
+        try:
+            with open(self._path) as f:
+                self._baudrates = json.load(f)
+        except (OSError, ValueError):
+            pass
+
+    def get(self, port: str) -> int:
+        return self._baudrates.get(port)
+
+    def set(self, port: str, baudrate: int) -> None:
+        with self._lock:
+            if self._baudrates.get(port) == baudrate:
+                return
+            self._baudrates[port] = baudrate
+            try:
+                with open(self._path, 'w') as f:
+                    json.dump(self._baudrates, f, indent=4)
+            except OSError as e:
+                utils.get_logger('baudrate').warning(f'Failed to store baudrates to {self._path}: {e}')
+
+
+def _probe(port: str, baudrate: int, timeout_s: float) -> int:
+    '''
+    Listens on the port at the given baudrate, and returns the number of
+    valid (CRC-passing) MAVLink frames received. Returns early, with a
+    negative count, as soon as a heartbeat is seen.
+    '''
+    mav = MAVLink(None)
+    frames = 0
+    with Serial(port, baudrate=baudrate, timeout=0.1) as serial:
+        t0 = time.monotonic()
+        while (time.monotonic() - t0) < timeout_s:
+            data = serial.read(max(1, serial.in_waiting))
+            if not data:
+                continue
+            try:
+                msgs = mav.parse_buffer(data) or []
+            except MAVError:
+                continue
+            for msg in msgs:
+                frames += 1
+                if isinstance(msg, MAVLink_heartbeat_message):
+                    return -frames
+    return frames
+
+
+def detect_baudrate(port: str,
+                    candidates: List[int] = None,
+                    timeout_s: float = 1.5,
+                    cache: BaudrateCache = None) -> int:
+    '''
+    Tries the candidate baudrates one at a time, starting with the one that
+    last worked for the port and then from the fastest down, and returns
+    the first one where we receive a heartbeat. That's the fastest working
+    one, eg for USB links that work at any baudrate. If there's no
+    heartbeat at any baudrate, the one that gave the most valid frames is
+    used. Returns None if no valid frames were received at all.
+    '''
+    logger = utils.get_logger('baudrate')
+    if candidates is None:
+        candidates = CANDIDATE_BAUDRATES
+
+    candidates = sorted(candidates, reverse=True)
+    if cache is not None:
+        cached = cache.get(port)
+        if cached in candidates:
+            candidates.remove(cached)
+        if cached is not None:
+            candidates.insert(0, cached)
+
+    best_baudrate = None
+    best_frames = 0
+    for baudrate in candidates:
+        try:
+            frames = _probe(port, baudrate, timeout_s)
+        except SerialException as e:
+            logger.warning(f'Failed to open {port} at {baudrate} baud: {e}')
+            return None
+
+        if frames < 0:
+            logger.info(f'Detected baudrate {baudrate} on {port}')
+            best_baudrate = baudrate
+            break
+
+        logger.debug(f'{frames} valid frames at {baudrate} baud, but no heartbeat')
+        if frames > best_frames:
+            best_baudrate = baudrate
+            best_frames = frames
+
+    if best_baudrate is not None and cache is not None:
+        cache.set(port, best_baudrate)
+
+    return best_baudrate
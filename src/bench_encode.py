@@ -0,0 +1,82 @@
+'''
+Compares the time to encode and send the high rate messages with pymavlink
+and with msg_template.MessageTemplate, without any serial port:
+
+    python src/bench_encode.py [-n 100000]
+'''
+from pymavlink.dialects.v20 import common
+from mavlink_filter import FilteringMAVLink
+from msg_template import MessageTemplate
+import argparse
+import time
+
+
+class _NullFile:
+
+    def write(self, data: bytes) -> None:
+        pass
+
+
+def _time_per_call_us(function, n: int) -> float:
+    start = time.perf_counter()
+    for i in range(n):
+        function(i)
+    return (time.perf_counter() - start) / n * 1e6
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-n', type=int, default=100000, help='Messages per case')
+    args = parser.parse_args()
+
+    for mavlink2 in (False, True):
+        mav = FilteringMAVLink(_NullFile())
+        mav.use_mavlink2 = mavlink2
+
+        motor_test = MessageTemplate(
+            mav,
+            common.MAVLink_command_long_message(0, common.MAV_COMP_ID_ALL,
+                                                common.MAV_CMD_DO_MOTOR_TEST,
+                                                0, 0, 0, 0, 0, 0, 0, 0),
+            ['confirmation'] + [f'param{i}' for i in range(1, 8)])
+        param_set = MessageTemplate(
+            mav,
+            common.MAVLink_param_set_message(0, common.MAV_COMP_ID_ALL, b'', 0, 0),
+            ['param_id', 'param_value', 'param_type'])
+        heartbeat = MessageTemplate(
+            mav,
+            common.MAVLink_heartbeat_message(common.MAV_TYPE_GCS,
+                                             common.MAV_AUTOPILOT_INVALID, 0, 0, 0, 3))
+
+        cases = [
+            ('motor test',
+             lambda i: mav.command_long_send(0, common.MAV_COMP_ID_ALL,
+                                             common.MAV_CMD_DO_MOTOR_TEST, 0,
+                                             1, common.MOTOR_TEST_THROTTLE_PERCENT,
+                                             i % 100, 0, 0, 0, 0),
+             lambda i: motor_test.send(0, 1, common.MOTOR_TEST_THROTTLE_PERCENT,
+                                       i % 100, 0, 0, 0, 0)),
+            ('PARAM_SET',
+             lambda i: mav.param_set_send(0, common.MAV_COMP_ID_ALL, b'ATC_RAT_RLL_P',
+                                          i * 1e-4, common.MAV_PARAM_TYPE_REAL32),
+             lambda i: param_set.send(b'ATC_RAT_RLL_P', i * 1e-4,
+                                      common.MAV_PARAM_TYPE_REAL32)),
+            ('HEARTBEAT',
+             lambda i: mav.heartbeat_send(common.MAV_TYPE_GCS,
+                                          common.MAV_AUTOPILOT_INVALID, 0, 0, 0),
+             lambda i: heartbeat.send()),
+        ]
+
+        print(f'MAVLink {2 if mavlink2 else 1}')
+        for name, pymavlink_send, template_send in cases:
+            # Warm up, the template frame is built on first use
+            template_send(0)
+            reference = _time_per_call_us(pymavlink_send, args.n)
+            fast = _time_per_call_us(template_send, args.n)
+            print(f'    {name:12} pymavlink {reference:6.2f} us  '
+                  f'template {fast:6.2f} us  ({reference / fast:.1f}x)')
+
+
+if __name__ == '__main__':
+    main()
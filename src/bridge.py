@@ -0,0 +1,304 @@
+'''
+Forwards the raw MAVLink stream of an ASAC session to local UDP and TCP
+clients, so that other tools (loggers, scripts, a second GCS) can see the
+vehicle without opening the serial port themselves.
+
+UDP clients register by sending any datagram to the UDP port, after which
+every frame is sent to them as a datagram. TCP clients just connect. If
+injection is enabled, the MAVLink frames clients send are forwarded to the
+vehicle.
+
+Received frames go into one shared ring buffer, and each client only keeps
+its position in it, so frames are never copied per client. All clients are
+served from one thread with a selector. A client that falls too far behind
+is dropped: UDP clients skip ahead, losing frames, while TCP clients are
+disconnected, since a gap in the stream would corrupt it.
+'''
+from pymavlink.dialects.v20.common import MAVLink, MAVError
+from serial.serialutil import SerialException
+from threading import Lock, Thread
+from typing import Dict, List, Tuple
+import selectors
+import socket
+import utils
+
+
+__all__ = ['FrameBridge']
+
+
+class _Client:
+
+    def __init__(self, name: str, position: int) -> None:
+        self.name = name
+        # Sequence number of the next frame to send
+        self.position = position
+        # Bytes of the current frame that have already been sent (TCP only)
+        self.sent = 0
+        self.parser = MAVLink(None)
+        self.dropped = 0
+
+
+class FrameBridge:
+    '''
+    Fans out received frames from ASAC to UDP and TCP clients.
+
+    client_buffer: How many frames a client may be behind before it's dropped
+    '''
+
+    # Max number of buffers per sendmsg call
+    _MAX_IOV = 64
+    MAX_UDP_CLIENTS = 32
+
+    def __init__(self,
+                 asac: 'ASAC',
+                 udp_port: int = None,
+                 tcp_port: int = None,
+                 host: str = '127.0.0.1',
+                 inject: bool = False,
+                 client_buffer: int = 1000) -> None:
+        self._asac = asac
+        self._udp_port = udp_port
+        self._tcp_port = tcp_port
+        self._host = host
+        self.inject = inject
+        self._client_buffer = client_buffer
+
+        # Frames are stored by sequence number modulo the ring size. The ring
+        # is larger than the client buffer, so that a frame a client is about
+        # to send can't be overwritten before it's dropped as too slow.
+        self._ring_size = 2 * client_buffer
+        self._ring: List[bytes] = [b''] * self._ring_size
+        self._head = 0
+        self._lock = Lock()
+        self._wake_pending = False
+
+        self._selector: selectors.BaseSelector = None
+        self._udp: socket.socket = None
+        self._tcp: socket.socket = None
+        self._wake_r: socket.socket = None
+        self._wake_w: socket.socket = None
+        self._udp_clients: Dict[Tuple, _Client] = {}
+        self._tcp_clients: Dict[socket.socket, _Client] = {}
+        self._thread: Thread = None
+        self._running = False
+        self.logger = utils.get_logger('bridge')
+
+    def start(self) -> None:
+        self._selector = selectors.DefaultSelector()
+        self._wake_r, self._wake_w = socket.socketpair()
+        self._wake_r.setblocking(False)
+        self._wake_w.setblocking(False)
+        self._selector.register(self._wake_r, selectors.EVENT_READ)
+
+        if self._udp_port is not None:
+            self._udp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self._udp.bind((self._host, self._udp_port))
+            self._udp.setblocking(False)
+            self._selector.register(self._udp, selectors.EVENT_READ)
+            self.logger.info(f'Bridge listening on udp://{self._host}:{self._udp_port}')
+        if self._tcp_port is not None:
+            self._tcp = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self._tcp.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            self._tcp.bind((self._host, self._tcp_port))
+            self._tcp.listen()
+            self._tcp.setblocking(False)
+            self._selector.register(self._tcp, selectors.EVENT_READ)
+            self.logger.info(f'Bridge listening on tcp://{self._host}:{self._tcp_port}')
+
+        self._running = True
+        self._asac.add_raw_frame_handler(self.put)
+        self._thread = Thread(target=self._run, name='bridge', daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        if not self._running:
+            return
+        self._asac.del_raw_frame_handler(self.put)
+        self._running = False
+        self._wake()
+        self._thread.join()
+
+        for sock in list(self._tcp_clients) + [self._udp, self._tcp, self._wake_r, self._wake_w]:
+            if sock is not None:
+                sock.close()
+        self._tcp_clients.clear()
+        self._udp_clients.clear()
+        self._selector.close()
+
+    def clients(self) -> Dict[str, int]:
+        ''' Returns the number of frames dropped, per client. '''
+        clients = list(self._udp_clients.values()) + list(self._tcp_clients.values())
+        return {client.name: client.dropped for client in clients}
+
+    def put(self, frame: bytes) -> None:
+        ''' Raw frame handler, called from the RX thread. '''
+        with self._lock:
+            self._ring[self._head % self._ring_size] = frame
+            self._head += 1
+            if self._wake_pending:
+                return
+            self._wake_pending = True
+        self._wake()
+
+    def _wake(self) -> None:
+        try:
+            self._wake_w.send(b'\x00')
+        except (BlockingIOError, OSError):
+            # Already plenty of wakeups pending
+            pass
+
+    def _run(self) -> None:
+        while self._running:
+            for key, events in self._selector.select():
+                sock = key.fileobj
+                if sock is self._wake_r:
+                    try:
+                        while sock.recv(4096):
+                            pass
+                    except BlockingIOError:
+                        pass
+                elif sock is self._udp:
+                    self._receive_udp()
+                elif sock is self._tcp:
+                    self._accept()
+                elif events & selectors.EVENT_READ:
+                    self._receive_tcp(sock)
+            self._pump()
+
+    def _pump(self) -> None:
+        ''' Sends what's new to all clients. '''
+        with self._lock:
+            head = self._head
+            self._wake_pending = False
+
+        for address, client in list(self._udp_clients.items()):
+            self._send_udp(address, client, head)
+        for sock, client in list(self._tcp_clients.items()):
+            self._send_tcp(sock, client, head)
+
+    def _skip_ahead(self, client: _Client, head: int) -> bool:
+        ''' Returns True if the client was too slow. '''
+        behind = head - client.position
+        if behind <= self._client_buffer:
+            return False
+        client.dropped += behind
+        client.position = head
+        client.sent = 0
+        return True
+
+    def _send_udp(self, address: Tuple, client: _Client, head: int) -> None:
+        self._skip_ahead(client, head)
+        while client.position < head:
+            try:
+                self._udp.sendto(self._ring[client.position % self._ring_size], address)
+            except BlockingIOError:
+                # The socket buffer is full, the rest is dropped
+                client.dropped += head - client.position
+                client.position = head
+                return
+            except OSError:
+                del self._udp_clients[address]
+                return
+            client.position += 1
+
+    def _send_tcp(self, sock: socket.socket, client: _Client, head: int) -> None:
+        if self._skip_ahead(client, head):
+            self.logger.warning(f'Bridge client {client.name} is too slow, disconnecting')
+            self._close(sock)
+            return
+
+        while client.position < head:
+            end = min(head, client.position + self._MAX_IOV)
+            buffers = [memoryview(self._ring[client.position % self._ring_size])[client.sent:]]
+            buffers += [self._ring[i % self._ring_size] for i in range(client.position + 1, end)]
+            try:
+                if hasattr(sock, 'sendmsg'):
+                    sent = sock.sendmsg(buffers)
+                else:
+                    sent = sock.send(b''.join(buffers))
+            except BlockingIOError:
+                sent = 0
+            except OSError:
+                self._close(sock)
+                return
+
+            # Advance past the frames that were fully sent
+            for buffer in buffers:
+                if sent < len(buffer):
+                    client.sent += sent
+                    break
+                sent -= len(buffer)
+                client.position += 1
+                client.sent = 0
+            else:
+                continue
+            # The socket is full, continue when it's writable again
+            self._selector.modify(sock, selectors.EVENT_READ | selectors.EVENT_WRITE)
+            return
+
+        self._selector.modify(sock, selectors.EVENT_READ)
+
+    def _accept(self) -> None:
+        try:
+            sock, address = self._tcp.accept()
+        except BlockingIOError:
+            return
+        sock.setblocking(False)
+        with self._lock:
+            client = _Client(f'tcp://{address[0]}:{address[1]}', self._head)
+        self._tcp_clients[sock] = client
+        self._selector.register(sock, selectors.EVENT_READ)
+        self.logger.info(f'Bridge client {client.name} connected')
+
+    def _close(self, sock: socket.socket) -> None:
+        client = self._tcp_clients.pop(sock)
+        self._selector.unregister(sock)
+        sock.close()
+        self.logger.info(f'Bridge client {client.name} disconnected')
+
+    def _receive_tcp(self, sock: socket.socket) -> None:
+        try:
+            data = sock.recv(4096)
+        except BlockingIOError:
+            return
+        except OSError:
+            data = b''
+        if not data:
+            self._close(sock)
+            return
+        self._inject(self._tcp_clients[sock], data)
+
+    def _receive_udp(self) -> None:
+        while True:
+            try:
+                data, address = self._udp.recvfrom(4096)
+            except (BlockingIOError, OSError):
+                return
+            client = self._udp_clients.get(address)
+            if client is None:
+                if len(self._udp_clients) >= self.MAX_UDP_CLIENTS:
+                    # Make room by forgetting the oldest client
+                    del self._udp_clients[next(iter(self._udp_clients))]
+                with self._lock:
+                    client = _Client(f'udp://{address[0]}:{address[1]}', self._head)
+                self._udp_clients[address] = client
+                self.logger.info(f'Bridge client {client.name} registered')
+            self._inject(client, data)
+
+    def _inject(self, client: _Client, data: bytes) -> None:
+        ''' Forwards complete frames sent by the client to the vehicle. '''
+        if not self.inject:
+            return
+        try:
+            msgs = client.parser.parse_buffer(data) or []
+        except MAVError as e:
+            self.logger.debug(f'Bad frame from bridge client {client.name}: {e}')
+            return
+        for msg in msgs:
+            try:
+                self._asac.send_raw(bytes(msg.get_msgbuf()))
+            except SerialException:
+                # Not connected, eg before start or during a reboot. Clients
+                # resend what matters, eg heartbeats.
+                self.logger.debug(f'Dropped frame from bridge client {client.name}, not connected')
+                return
@@ -0,0 +1,262 @@
+'''
+Headless command line interface to ASAC, for scripting bench checks and
+hardware-in-the-loop runs without a display.
+
+Examples:
+    python src/cli.py /dev/ttyUSB0 run
+    python src/cli.py /dev/ttyUSB0 dump-params -o params.json
+    python src/cli.py /dev/ttyUSB0 set-params params.json --write
+    python src/cli.py /dev/ttyUSB0 reboot
+    python src/cli.py /dev/ttyUSB0 telemetry ATTITUDE RC_CHANNELS
+    python src/cli.py --baud auto /dev/ttyUSB0 run
+    python src/cli.py --bridge-udp 14550 /dev/ttyUSB0 run
+    python src/cli.py --shm --shm-history 100 /dev/ttyUSB0 run
+
+Set ASAC_PROFILE=1 to profile a run, the profile is written on exit. Send
+SIGUSR1 to start profiling, or to write the profile while running.
+'''
+import argparse
+import json
+import signal
+import sys
+import time
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from threading import Event
+from typing import Dict, List, Tuple
+
+from pymavlink.dialects.v20 import common
+
+from asac import ASAC
+from baudrate import BAUDRATE_AUTO, DEFAULT_BAUDRATE
+from bridge import FrameBridge
+from commands import CommandError
+from shared_telemetry import DEFAULT_NAME as SHM_DEFAULT_NAME, SharedTelemetryWriter
+import profiler
+import utils
+
+
+DEFAULT_TELEMETRY = ['HEARTBEAT', 'ATTITUDE', 'RC_CHANNELS', 'BATTERY_STATUS', 'STATUSTEXT']
+
+# A download over PARAM_REQUEST_LIST takes a while, with its retries
+PARAMS_TIMEOUT_S = 60
+
+MESSAGE_TYPES = {msg_type.msgname: msg_type for msg_type in common.mavlink_map.values()}
+
+
+def _wait_for_shutdown(asac: ASAC, shutdown: Event) -> None:
+    ''' Blocks until we're interrupted, or the connection is lost. '''
+    while not shutdown.wait(timeout=1):
+        if asac.wait_until_stopped(timeout=0):
+            # The connection is closed for a short while when the vehicle
+            # reboots, so give it some time to come back before giving up.
+            if shutdown.wait(timeout=5) or not asac.is_connected():
+                break
+
+
+def _get_parameters(asac: ASAC, shutdown: Event) -> bool:
+    '''
+    Downloads all parameters, returns False if the download failed, timed
+    out or we were interrupted.
+    '''
+    future = asac.get_parameters()
+    deadline = time.monotonic() + PARAMS_TIMEOUT_S
+    while not shutdown.is_set():
+        try:
+            future.result(timeout=min(1, max(deadline - time.monotonic(), 0)))
+            return True
+        except FutureTimeoutError:
+            if time.monotonic() >= deadline:
+                asac.logger.error('Timed out downloading parameters')
+                return False
+        except Exception:
+            # Already logged by the scheduler
+            return False
+    return False
+
+
+def cmd_run(asac: ASAC, args: argparse.Namespace, shutdown: Event) -> int:
+    _wait_for_shutdown(asac, shutdown)
+    return 0
+
+
+def cmd_dump_params(asac: ASAC, args: argparse.Namespace, shutdown: Event) -> int:
+    if not _get_parameters(asac, shutdown):
+        return 1
+
+    params = asac.parameters.as_dict()
+    if not params:
+        asac.logger.error('Received no parameters')
+        return 1
+
+    output = json.dumps({name: {'value': value, 'type': type}
+                         for name, (value, type) in sorted(params.items())},
+                        indent=4)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+    return 0
+
+
+def _load_params(path: str) -> Dict[str, Tuple[float, int]]:
+    '''
+    Loads parameters from a json file, in the same format as dump-params
+    writes. The value can also be given directly, eg {"pid_gyro_roll_p": 1.2}.
+    '''
+    with open(path) as f:
+        data = json.load(f)
+
+    params = {}
+    for name, param in data.items():
+        if isinstance(param, dict):
+            params[name] = (float(param['value']), param.get('type'))
+        else:
+            params[name] = (float(param), None)
+    return params
+
+
+def cmd_set_params(asac: ASAC, args: argparse.Namespace, shutdown: Event) -> int:
+    params = _load_params(args.file)
+
+    # Parameters without a type in the file use the type the vehicle reports
+    if any(type is None for _, type in params.values()):
+        if not _get_parameters(asac, shutdown):
+            return 1
+
+    for name, (value, type) in params.items():
+        if type is None:
+            type = asac.parameters.get_type(name, common.MAV_PARAM_TYPE_REAL32)
+        params[name] = (value, type)
+
+    if not asac.set_parameters(params):
+        # Already logged
+        return 1
+    asac.logger.info(f'Set {len(params)} parameters')
+
+    if args.write:
+        try:
+            asac.write_params_to_flash(None).result()
+        except (CommandError, ConnectionError):
+            # Already logged
+            return 1
+        asac.logger.info('Wrote parameters to flash')
+    return 0
+
+
+def cmd_reboot(asac: ASAC, args: argparse.Namespace, shutdown: Event) -> int:
+    return 0 if asac.reboot() else 1
+
+
+def cmd_telemetry(asac: ASAC, args: argparse.Namespace, shutdown: Event) -> int:
+    names = args.messages or DEFAULT_TELEMETRY
+    unknown = [name for name in names if name not in MESSAGE_TYPES]
+    if unknown:
+        asac.logger.error(f'Unknown message types: {", ".join(unknown)}')
+        return 1
+
+    def write(msg: common.MAVLink_message) -> None:
+        line = msg.to_dict()
+        line['time'] = time.time()
+        sys.stdout.write(json.dumps(line, default=str) + '\n')
+        sys.stdout.flush()
+
+    for name in names:
+        asac.add_message_handler(MESSAGE_TYPES[name], write)
+
+    _wait_for_shutdown(asac, shutdown)
+    return 0
+
+
+def parse_args(argv: List[str] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description='ASAC headless interface')
+    parser.add_argument('port', help='Serial port, eg /dev/ttyUSB0')
+    parser.add_argument('-b', '--baud', default=str(DEFAULT_BAUDRATE),
+                        help=f'Baudrate, or "auto" to detect it (default: {DEFAULT_BAUDRATE})')
+    parser.add_argument('--log-level', metavar='LEVELS',
+                        help='Log levels, eg "INFO,ftp=DEBUG" (default: ASAC_LOG_LEVEL or INFO)')
+    parser.add_argument('--log-file', metavar='PATH',
+                        help='Also write the log to this file, rotated when large')
+    parser.add_argument('--bridge-udp', type=int, metavar='PORT',
+                        help='Forward the vehicle stream to UDP clients on this local port')
+    parser.add_argument('--bridge-tcp', type=int, metavar='PORT',
+                        help='Forward the vehicle stream to TCP clients on this local port')
+    parser.add_argument('--bridge-inject', action='store_true',
+                        help='Send frames from bridge clients to the vehicle')
+    parser.add_argument('--shm', nargs='?', const=SHM_DEFAULT_NAME, metavar='NAME',
+                        help='Publish live telemetry in shared memory, see shared_telemetry.py '
+                             f'(default name: {SHM_DEFAULT_NAME})')
+    parser.add_argument('--shm-history', type=int, default=1, metavar='N',
+                        help='Records kept per message type in shared memory (default: 1)')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    run = subparsers.add_parser('run', help='Keep the connection open until interrupted')
+    run.set_defaults(func=cmd_run)
+
+    dump = subparsers.add_parser('dump-params', help='Print all parameters as json')
+    dump.add_argument('-o', '--output', help='Write to file instead of stdout')
+    dump.set_defaults(func=cmd_dump_params)
+
+    set_params = subparsers.add_parser('set-params', help='Set parameters from a json file')
+    set_params.add_argument('file')
+    set_params.add_argument('--write', action='store_true',
+                            help='Write the parameters to flash afterwards')
+    set_params.set_defaults(func=cmd_set_params)
+
+    reboot = subparsers.add_parser('reboot', help='Reboot the vehicle')
+    reboot.set_defaults(func=cmd_reboot)
+
+    telemetry = subparsers.add_parser('telemetry', help='Stream telemetry to stdout as json lines')
+    telemetry.add_argument('messages', nargs='*',
+                           help=f'Message types to stream (default: {" ".join(DEFAULT_TELEMETRY)})')
+    telemetry.set_defaults(func=cmd_telemetry)
+
+    return parser.parse_args(argv)
+
+
+def main(argv: List[str] = None) -> int:
+    args = parse_args(argv)
+
+    # stdout is reserved for command output
+    utils.set_log_stream(sys.stderr)
+    if args.log_level is not None:
+        utils.set_log_levels(args.log_level)
+    if args.log_file is not None:
+        utils.set_log_file(args.log_file)
+
+    shutdown = Event()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(sig, lambda *_: shutdown.set())
+    profiler.install_signal_handler()
+
+    if args.baud == 'auto':
+        baudrate = BAUDRATE_AUTO
+    else:
+        baudrate = int(args.baud)
+
+    asac = ASAC(args.port, baudrate=baudrate)
+    bridge = None
+    if args.bridge_udp is not None or args.bridge_tcp is not None:
+        bridge = FrameBridge(asac, udp_port=args.bridge_udp, tcp_port=args.bridge_tcp,
+                             inject=args.bridge_inject)
+        bridge.start()
+    shm = None
+    if args.shm is not None:
+        shm = SharedTelemetryWriter(args.shm, history=args.shm_history)
+        shm.attach(asac)
+
+    asac.start()
+    try:
+        return args.func(asac, args, shutdown)
+    finally:
+        asac.stop()
+        if bridge is not None:
+            bridge.stop()
+        if shm is not None:
+            shm.close()
+        if profiler.get_profiler().running:
+            profiler.get_profiler().dump()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,220 @@
+from pymavlink.dialects.v20 import common
+from collections import deque
+from concurrent.futures import Future
+from dataclasses import dataclass
+from threading import Condition, Event
+from typing import Callable, Deque, Dict, List
+import time
+import utils
+
+
+__all__ = ['CommandError', 'CommandTimeout', 'CommandManager']
+
+
+class CommandError(Exception):
+    ''' The vehicle didn't accept a command. '''
+
+    def __init__(self, command: int, result: int) -> None:
+        result_name = common.enums['MAV_RESULT'].get(result)
+        result_name = result_name.name if result_name is not None else str(result)
+        super().__init__(f'Command {_command_name(command)} failed: {result_name}')
+        self.command = command
+        self.result = result
+
+
+class CommandTimeout(CommandError):
+    ''' The vehicle never acked a command, even after retransmissions. '''
+
+    def __init__(self, command: int, attempts: int) -> None:
+        Exception.__init__(self, f'No ack for command {_command_name(command)} '
+                                 f'after {attempts} attempts')
+        self.command = command
+        self.result = None
+
+
+def _command_name(command: int) -> str:
+    entry = common.enums['MAV_CMD'].get(command)
+    return entry.name if entry is not None else str(command)
+
+
+@dataclass
+class _PendingCommand:
+    command: int
+    params: List[float]
+    future: Future
+    retries: int
+    timeout_s: float
+    deadline: float
+    confirmation: int = 0
+
+
+class CommandManager:
+    '''
+    Sends commands (COMMAND_LONG) and tracks their COMMAND_ACK.
+
+    Each command gets a future, which resolves to the ack when the vehicle
+    accepts the command, or fails with CommandError if the vehicle rejects
+    it, or CommandTimeout if it never answers. Acks are matched by command
+    ID, so only one command of each ID can be in flight; a command sent
+    while another of the same ID is in flight waits until that one is done,
+    eg a SET_MESSAGE_INTERVAL for each of several messages. With
+    `replace`, it's sent right away instead, and replaces (cancels) the one
+    in flight, for commands where only the latest matters. A command that
+    isn't acked in time is retransmitted with the confirmation field
+    incremented, as the protocol requires. A MAV_RESULT_IN_PROGRESS ack
+    keeps the command alive without retransmissions.
+
+    Future callbacks are called from the thread that receives the ack, so
+    they shouldn't block.
+    '''
+
+    DEFAULT_TIMEOUT_S = 0.5
+    DEFAULT_RETRIES = 3
+    # How long to wait for the final ack after MAV_RESULT_IN_PROGRESS
+    IN_PROGRESS_TIMEOUT_S = 5
+
+    def __init__(self,
+                 send: Callable[[int, int, List[float]], None],
+                 timeout: Callable[[], float] = None) -> None:
+        '''
+        send: Sends a command with (command, confirmation, params)
+        timeout: Returns the current ack timeout, eg based on the measured
+            round trip time. DEFAULT_TIMEOUT_S is used if not given.
+        '''
+        self._send = send
+        self._timeout = timeout
+        self._cond = Condition()
+        # In flight, by command ID
+        self._pending: Dict[int, _PendingCommand] = {}
+        # Waiting for the one in flight of the same ID
+        self._queued: Dict[int, Deque[_PendingCommand]] = {}
+        self.logger = utils.get_logger('commands')
+
+    def send(self,
+             command: int,
+             *params: float,
+             timeout_s: float = None,
+             retries: int = None,
+             replace: bool = False) -> Future:
+        '''
+        Sends the command with up to 7 params, returns a future of the
+        COMMAND_ACK.
+        '''
+        if timeout_s is None:
+            timeout_s = self._timeout() if self._timeout is not None else self.DEFAULT_TIMEOUT_S
+        if retries is None:
+            retries = self.DEFAULT_RETRIES
+
+        params = list(params) + [0] * (7 - len(params))
+        future = Future()
+        pending = _PendingCommand(command, params, future, retries, timeout_s,
+                                  time.monotonic() + timeout_s)
+
+        with self._cond:
+            if command in self._pending and not replace:
+                # Sent when the one in flight is done
+                self._queued.setdefault(command, deque()).append(pending)
+                return future
+            previous = self._pending.pop(command, None)
+            self._pending[command] = pending
+            self._cond.notify()
+
+        if previous is not None:
+            previous.future.cancel()
+        self._send(command, 0, params)
+        return future
+
+    def handle_ack(self, msg: common.MAVLink_command_ack_message) -> None:
+        ''' Message handler for COMMAND_ACK. '''
+        with self._cond:
+            pending = self._pending.get(msg.command)
+            if pending is None:
+                return
+            if msg.result == common.MAV_RESULT_IN_PROGRESS:
+                pending.deadline = time.monotonic() + self.IN_PROGRESS_TIMEOUT_S
+                pending.retries = 0
+                return
+            del self._pending[msg.command]
+            next_pending = self._start_next(msg.command)
+
+        # The caller may have cancelled the future meanwhile
+        if msg.result == common.MAV_RESULT_ACCEPTED:
+            utils.try_set(pending.future.set_result, msg)
+        else:
+            utils.try_set(pending.future.set_exception, CommandError(msg.command, msg.result))
+        if next_pending is not None:
+            self._send(next_pending.command, 0, next_pending.params)
+
+    def cancel_all(self) -> None:
+        ''' Fails all commands in flight or waiting, eg when the connection is closed. '''
+        with self._cond:
+            pending = list(self._pending.values())
+            for queued in self._queued.values():
+                pending += queued
+            self._pending.clear()
+            self._queued.clear()
+            self._cond.notify()
+
+        for command in pending:
+            utils.try_set(command.future.set_exception, ConnectionError('Connection closed'))
+
+    def run(self, stop_flag: Event) -> None:
+        ''' Retransmits commands that time out, until stop_flag is set. '''
+        while not stop_flag.is_set():
+            now = time.monotonic()
+            retransmit: List[_PendingCommand] = []
+            timed_out: List[_PendingCommand] = []
+            started: List[_PendingCommand] = []
+
+            with self._cond:
+                for pending in list(self._pending.values()):
+                    if pending.deadline > now:
+                        continue
+                    if pending.future.cancelled():
+                        # The caller gave up on it
+                        del self._pending[pending.command]
+                    elif pending.confirmation < pending.retries:
+                        pending.confirmation += 1
+                        pending.deadline = now + pending.timeout_s
+                        retransmit.append(pending)
+                        continue
+                    else:
+                        del self._pending[pending.command]
+                        timed_out.append(pending)
+                    next_pending = self._start_next(pending.command)
+                    if next_pending is not None:
+                        started.append(next_pending)
+
+                deadlines = [pending.deadline for pending in self._pending.values()]
+                if not retransmit and not timed_out and not started:
+                    # Wake up at the next deadline, a new command, or now and
+                    # then to check the stop flag.
+                    timeout = min(deadlines, default=now + 0.5) - now
+                    self._cond.wait(min(max(timeout, 0), 0.5))
+                    continue
+
+            for pending in retransmit:
+                self.logger.debug(f'Retransmitting command {_command_name(pending.command)}, '
+                                  f'confirmation {pending.confirmation}')
+                self._send(pending.command, pending.confirmation, pending.params)
+            for pending in timed_out:
+                utils.try_set(pending.future.set_exception,
+                              CommandTimeout(pending.command, pending.confirmation + 1))
+            for pending in started:
+                self._send(pending.command, 0, pending.params)
+
+    def _start_next(self, command: int) -> _PendingCommand:
+        '''
+        Puts the next waiting command of the ID in flight, and returns it to
+        be sent, if there is one. Locked.
+        '''
+        queued = self._queued.get(command)
+        while queued:
+            pending = queued.popleft()
+            if pending.future.cancelled():
+                continue
+            pending.deadline = time.monotonic() + pending.timeout_s
+            self._pending[command] = pending
+            return pending
+        self._queued.pop(command, None)
+        return None
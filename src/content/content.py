@@ -1,11 +1,17 @@
 import tkinter as tk
 from tkinter import ttk
+from typing import Any, Callable, Dict, List, Tuple
 import utils
 
+from asac import ASAC
+from fields import FieldSubscription
+from scheduler import TkExecutor
+from pymavlink.dialects.v20.common import MAVLink_message
+
 
 class Content(ttk.Frame):
 
-    def __init__(self, parent, title: str) -> None:
+    def __init__(self, parent, title: str, asac: ASAC = None) -> None:
         super().__init__(parent)
         title = ttk.Label(self, text=title)
         title.config(font=('Courier', 20))
@@ -13,7 +19,97 @@ class Content(ttk.Frame):
         self.content = ttk.Frame(self)
         self.content.pack()
         self.name = title
-        self.logger = utils.get_logger()
+        self.logger = utils.get_logger('gui')
+        self.asac = asac
+        self.visible = False
+
+        self._field_handlers: List[Tuple[MAVLink_message, str, Callable, Dict]] = []
+        self._field_subscriptions: List[Tuple[MAVLink_message, FieldSubscription]] = []
+        self._stream_rates: Dict[MAVLink_message, float] = {}
+        self._parameters: List[str] = []
+        # Field handlers are called from other threads, and Tk isn't thread
+        # safe, so their callbacks are run on the Tk thread.
+        self._tk = TkExecutor(self)
+
+    def add_field_handler(self,
+                          msg_type: MAVLink_message,
+                          field: str,
+                          callback: Callable[[Any], None],
+                          **kwargs) -> None:
+        '''
+        Adds a field handler (see ASAC.add_field_handler) that is only
+        subscribed while the page is shown. The callback is called on the Tk
+        thread.
+        '''
+        self._field_handlers.append((msg_type, field, callback, kwargs))
+        if self.visible:
+            self._subscribe(msg_type, field, callback, kwargs)
+
+    def request_stream_rate(self, msg_type: MAVLink_message, rate_hz: float) -> None:
+        '''
+        Asks for the given message to be streamed at the given rate, but
+        only while the page is shown.
+        '''
+        self._stream_rates[msg_type] = rate_hz
+        if self.visible:
+            self.asac.stream_rates.request(self, msg_type, rate_hz)
+
+    def request_parameters(self, names: List[str]) -> None:
+        '''
+        Fetches the given parameters when the page is shown, if they aren't
+        known yet. Their values end up in `asac.parameters`.
+        '''
+        self._parameters += names
+        if self.visible:
+            self.fetch_parameters()
+
+    def fetch_parameters(self) -> None:
+        ''' Fetches the parameters of the page that aren't known yet. '''
+        if not self._parameters or not self.asac.is_connected():
+            return
+        missing = [name for name in self._parameters if name not in self.asac.parameters]
+        if missing:
+            self.asac.fetch_parameters(missing)
+
+    def show(self) -> None:
+        if self.visible:
+            return
+
+        self.visible = True
+        self.pack(fill=tk.BOTH, expand=True)
+        for msg_type, field, callback, kwargs in self._field_handlers:
+            self._subscribe(msg_type, field, callback, kwargs)
+        for msg_type, rate_hz in self._stream_rates.items():
+            self.asac.stream_rates.request(self, msg_type, rate_hz)
+        self.fetch_parameters()
+        self.on_show()
+
+    def hide(self) -> None:
+        if not self.visible:
+            return
+
+        self.visible = False
+        self.pack_forget()
+        for msg_type, subscription in self._field_subscriptions:
+            self.asac.del_field_handler(msg_type, subscription)
+        self._field_subscriptions.clear()
+        for msg_type in self._stream_rates:
+            self.asac.stream_rates.release(self, msg_type)
+        self.on_hide()
+
+    def on_show(self) -> None:
+        ''' Called when the page is shown, can be overridden by pages. '''
+        pass
+
+    def on_hide(self) -> None:
+        ''' Called when the page is hidden, can be overridden by pages. '''
+        pass
+
+    def _subscribe(self, msg_type: MAVLink_message, field: str,
+                   callback: Callable, kwargs: Dict) -> None:
+        subscription = self.asac.add_field_handler(
+            msg_type, field, lambda value: self._tk.call(callback, value), **kwargs)
+        self._field_subscriptions.append((msg_type, subscription))
 
 
 class ParamFloat:
@@ -39,4 +135,45 @@ class ParamFloat:
         self._entry['state'] = 'normal'
         self._entry.delete(0, tk.END)
         self._entry.insert(tk.END, round(value, self._decimals))
-        self._entry['state'] = state
\ No newline at end of file
+        self._entry['state'] = state
+
+
+class Readout(tk.Canvas):
+    '''
+    Read-only display of live values, eg telemetry. All rows are text items
+    on one canvas, and a row is only redrawn when its formatted text
+    changes, which is much cheaper than updating an Entry per value.
+
+    rows: (key, label, format) for each row, eg ('roll', 'Roll', '{:.4f}')
+    '''
+
+    ROW_HEIGHT = 30
+    LABEL_WIDTH = 130
+    VALUE_WIDTH = 120
+
+    def __init__(self, parent, rows: List[Tuple[str, str, str]], font=('Helvetica', 14)) -> None:
+        super().__init__(parent,
+                         width=self.LABEL_WIDTH + self.VALUE_WIDTH,
+                         height=self.ROW_HEIGHT * len(rows),
+                         background='white',
+                         highlightthickness=0)
+        self._items: Dict[str, int] = {}
+        self._formats: Dict[str, Callable[[Any], str]] = {}
+        self._texts: Dict[str, str] = {}
+        for row, (key, label, fmt) in enumerate(rows):
+            y = row * self.ROW_HEIGHT + self.ROW_HEIGHT // 2
+            self.create_text(5, y, text=label, anchor=tk.W, font=font)
+            self._items[key] = self.create_text(self.LABEL_WIDTH + self.VALUE_WIDTH - 5, y,
+                                                text='', anchor=tk.E, font=font)
+            self._formats[key] = fmt.format
+            self._texts[key] = ''
+
+    def set(self, key: str, value: Any) -> None:
+        text = self._formats[key](value)
+        if text != self._texts[key]:
+            self._texts[key] = text
+            self.itemconfigure(self._items[key], text=text)
+
+    def setter(self, key: str) -> Callable[[Any], None]:
+        ''' Returns a callback that sets the given row, eg for field handlers. '''
+        return lambda value: self.set(key, value)
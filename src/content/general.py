@@ -1,31 +1,32 @@
 from asac import ASAC
-from content.content import Content, ParamFloat
+from content.content import Content, Readout
 from tkinter import ttk
 import tkinter as tk
-from pymavlink.dialects.v10 import common
-
-from utils import run_thread
+from pymavlink.dialects.v20 import common
 
 
 class AttitudeInfo(ttk.LabelFrame):
 
+    ROWS = [
+        ('time_boot_ms', 'MS since boot', '{:d}'),
+        ('roll', 'Roll', '{:.4f}'),
+        ('pitch', 'Pitch', '{:.4f}'),
+        ('yaw', 'Yaw', '{:.4f}'),
+        ('rollspeed', 'Roll Speed', '{:.4f}'),
+        ('pitchspeed', 'Pitch Speed', '{:.4f}'),
+        ('yawspeed', 'Yaw Speed', '{:.4f}'),
+    ]
+    FIELDS = [field for field, _, _ in ROWS]
+
     def __init__(self, parent) -> None:
         super().__init__(parent, text='Attitude')
-        pad = {}
-        self.time_boot_ms = ParamFloat(self, 0, 'MS since boot', 0, True)
-        self.roll = ParamFloat(self, 1, 'Roll', 0, True)
-        self.pitch = ParamFloat(self, 2, 'Pitch', 0, True)
-        self.yaw = ParamFloat(self, 3, 'Yaw', 0, True)
-        self.rollspeed = ParamFloat(self, 4, 'Roll Speed', 0, True)
-        self.pitchspeed = ParamFloat(self, 5, 'Pitch Speed', 0, True)
-        self.yawspeed = ParamFloat(self, 6, 'Yaw Speed', 0, True)
-
+        self.readout = Readout(self, self.ROWS)
+        self.readout.pack(padx=5, pady=5)
 
 
 class ContentGeneral(Content):
     def __init__(self, parent, asac: ASAC, save_callback: callable) -> None:
-        super().__init__(parent, 'General')
-        self.asac = asac
+        super().__init__(parent, 'General', asac)
         pack = {'padx': 10, 'pady': 10}
 
         self.config_frame = ttk.Frame(self.content)
@@ -58,16 +59,17 @@ class ContentGeneral(Content):
         self.attitude_info.pack(side=tk.LEFT, **frame_pad)
         self.config_frame.pack(side=tk.LEFT, **frame_pad)
 
-    def set_attitude_info(self, msg: common.MAVLink_attitude_message) -> None:
-        self.attitude_info.time_boot_ms.set(msg.time_boot_ms)
-        self.attitude_info.roll.set(msg.roll)
-        self.attitude_info.pitch.set(msg.pitch)
-        self.attitude_info.yaw.set(msg.yaw)
-        self.attitude_info.rollspeed.set(msg.rollspeed)
-        self.attitude_info.pitchspeed.set(msg.pitchspeed)
-        self.attitude_info.yawspeed.set(msg.yawspeed)
+        # Attitude fields are shown with 4 decimals, so smaller changes than
+        # that won't be visible anyway.
+        for field in AttitudeInfo.FIELDS:
+            self.add_field_handler(common.MAVLink_attitude_message,
+                                   field,
+                                   self.attitude_info.readout.setter(field),
+                                   deadband=0.00005,
+                                   max_rate_hz=20)
+        self.request_stream_rate(common.MAVLink_attitude_message, 25)
 
     def _reset_settings(self) -> None:
         self.logger.info('Resetting system parameters!')
-        run_thread(self.asac.reset_parameters)
+        self.asac.reset_parameters()
 
@@ -2,11 +2,11 @@ from content.content import Content
 from tkinter import ttk
 import tkinter as tk
 
-from threading import Thread, Event
-from typing import Tuple
-import time
+from threading import Lock
+from typing import Dict
 
 from asac import ASAC
+from scheduler import TimerHandle, get_scheduler
 
 
 class MotorSlider(ttk.Frame):
@@ -52,9 +52,11 @@ class MotorSlider(ttk.Frame):
 
 
 class ContentMotors(Content):
+
+    MOTOR_THROTTLE_INTERVAL_S = 0.05
+
     def __init__(self, parent, asac: ASAC, info_popup: callable) -> None:
-        super().__init__(parent, 'Motors')
-        self.asac = asac
+        super().__init__(parent, 'Motors', asac)
         self.info_popup = info_popup
 
         self._checked = tk.BooleanVar()
@@ -74,10 +76,10 @@ class ContentMotors(Content):
         self.check_enabled.pack(**pad)
         self.frame_sliders.pack(**pad)
 
-        self._motor_throttle_request_flag = Event()
-        self._motor_throttle_request_flag.clear()
-        self._motor_throttle_request: Tuple[int, int] # [motor, throttle]
-        Thread(target=self._motor_throttle_request_thread, daemon=True).start()
+        # Latest throttle per motor, not yet sent
+        self._motor_throttle_requests: Dict[int, int] = {}
+        self._motor_throttle_lock = Lock()
+        self._motor_throttle_timer: TimerHandle = None
 
     def _reset_all(self) -> None:
         for slider in self._sliders:
@@ -89,16 +91,28 @@ class ContentMotors(Content):
             return
 
         if self.asac.is_connected():
-            self._motor_throttle_request = motor, throttle
-            self._motor_throttle_request_flag.set()
+            with self._motor_throttle_lock:
+                self._motor_throttle_requests[motor] = throttle
+                if self._motor_throttle_timer is not None:
+                    # Sent when the timer fires
+                    return
+                self._motor_throttle_timer = get_scheduler().call_later(0, self._send_motor_throttle)
         else:
             self.info_popup('Not connected!', bg='red')
 
-    def _motor_throttle_request_thread(self) -> None:
-        while True:
-            self._motor_throttle_request_flag.wait()
-            motor, throttle = self._motor_throttle_request
-            self._motor_throttle_request_flag.clear()
+    def _send_motor_throttle(self) -> None:
+        '''
+        Sends the latest throttle requests, at most every MOTOR_THROTTLE_INTERVAL_S,
+        so that dragging a slider doesn't flood the link.
+        '''
+        with self._motor_throttle_lock:
+            requests = self._motor_throttle_requests
+            self._motor_throttle_requests = {}
+            if not requests:
+                self._motor_throttle_timer = None
+                return
+            self._motor_throttle_timer = get_scheduler().call_later(
+                self.MOTOR_THROTTLE_INTERVAL_S, self._send_motor_throttle)
+
+        for motor, throttle in requests.items():
             self.asac.set_motor_throttle_test(motor, throttle)
-            # Let's wait some time before we send another request
-            time.sleep(.05)
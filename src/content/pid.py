@@ -1,17 +1,32 @@
 from content.content import Content, ParamFloat
-from typing import Dict
 
 from asac import ASAC
 from tkinter import ttk
 import tkinter as tk
-from utils import run_thread
+from scheduler import get_scheduler
 
-from pymavlink.dialects.v10 import common
+from pymavlink.dialects.v20 import common
+
+
+PID_PARAMS = [
+    'pid_gyro_roll_p',
+    'pid_gyro_roll_i',
+    'pid_gyro_roll_d',
+    'pid_gyro_roll_f',
+    'pid_gyro_pitch_p',
+    'pid_gyro_pitch_i',
+    'pid_gyro_pitch_d',
+    'pid_gyro_pitch_f',
+    'pid_gyro_yaw_p',
+    'pid_gyro_yaw_i',
+    'pid_gyro_yaw_d',
+    'pid_gyro_yaw_f',
+]
 
 
 class ContentPid(Content):
     def __init__(self, parent, save_callback: callable, asac: ASAC) -> None:
-        super().__init__(parent, 'PID')
+        super().__init__(parent, 'PID', asac)
         self._asac = asac
         pack = {'padx': 10, 'pady': 10, 'ipadx': 5, 'ipady': 5}
         self.frame_roll = ttk.LabelFrame(self.content, text='ROLL')
@@ -38,23 +53,22 @@ class ContentPid(Content):
         btn_save = ttk.Button(self, text='Save', command=self._save)
         btn_save.pack()
 
+        # Show values from the parameter store as soon as they're received
+        for name in PID_PARAMS:
+            value = self._asac.parameters.get(name)
+            if value is not None:
+                getattr(self, name).set(value)
+            self._asac.parameters.add_observer(self._on_parameter, name)
+        self.request_parameters(PID_PARAMS)
+
     def _save(self) -> None:
-        parameters = {
-            b'pid_gyro_roll_p': (self.pid_gyro_roll_p.get(), 9),
-            b'pid_gyro_roll_i': (self.pid_gyro_roll_i.get(), 9),
-            b'pid_gyro_roll_d': (self.pid_gyro_roll_d.get(), 9),
-            b'pid_gyro_roll_f': (self.pid_gyro_roll_f.get(), 9),
-            b'pid_gyro_pitch_p': (self.pid_gyro_pitch_p.get(), 9),
-            b'pid_gyro_pitch_i': (self.pid_gyro_pitch_i.get(), 9),
-            b'pid_gyro_pitch_d': (self.pid_gyro_pitch_d.get(), 9),
-            b'pid_gyro_pitch_f': (self.pid_gyro_pitch_f.get(), 9),
-            b'pid_gyro_yaw_p': (self.pid_gyro_yaw_p.get(), 9),
-            b'pid_gyro_yaw_i': (self.pid_gyro_yaw_i.get(), 9),
-            b'pid_gyro_yaw_d': (self.pid_gyro_yaw_d.get(), 9),
-            b'pid_gyro_yaw_f': (self.pid_gyro_yaw_f.get(), 9),
-        }
+        parameters = {}
+        for name in PID_PARAMS:
+            param_type = self._asac.parameters.get_type(
+                name, common.MAV_PARAM_TYPE_REAL32)
+            parameters[name] = (getattr(self, name).get(), param_type)
 
-        run_thread(self._asac.set_parameters, parameters, self._on_param_set)
+        get_scheduler().submit(self._asac.set_parameters, parameters, self._on_param_set)
 
     def _on_param_set(self) -> None:
         print('PARAM SET OK, writing to flash..')
@@ -62,28 +76,9 @@ class ContentPid(Content):
 
     def _on_write_to_flash_ok(self) -> None:
         print('Write to flash OK, rebooting..')
-        self._asac.reboot()
-
-    def set_pid_values(self, pid_values: Dict[str, common.MAVLink_param_value_message]) -> None:
-        PID_PARAMS = [
-            'pid_gyro_roll_p',
-            'pid_gyro_roll_i',
-            'pid_gyro_roll_d',
-            'pid_gyro_roll_f',
-            'pid_gyro_pitch_p',
-            'pid_gyro_pitch_i',
-            'pid_gyro_pitch_d',
-            'pid_gyro_pitch_f',
-            'pid_gyro_yaw_p',
-            'pid_gyro_yaw_i',
-            'pid_gyro_yaw_d',
-            'pid_gyro_yaw_f',
-        ]
-        for pid_param in PID_PARAMS:
-            value = pid_values.get(pid_param)
-            if value is not None:
-                value = value.param_value
-            else:
-                value = 0
+        # Called from the thread that received the ack, which reboot waits on
+        get_scheduler().submit(self._asac.reboot)
 
-            getattr(self, pid_param).set(value)
+    def _on_parameter(self, name: str, value: float, type: int) -> None:
+        # Called from the thread that received the parameter
+        self._tk.call(getattr(self, name).set, value)
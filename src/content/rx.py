@@ -1,65 +1,84 @@
 from content.content import Content
 from tkinter import ttk
 import tkinter as tk
+from typing import Callable
 from asac import ASAC
 import utils
 
-from pymavlink.dialects.v10 import common
+from pymavlink.dialects.v20 import common
 
 
 RX_PROTOCOLS = ['ibus', 'elrs']
 
 
-class ProgressBar(tk.Canvas):
+class RxChannels(tk.Canvas):
+    '''
+    Shows all RX channels as bars on one canvas. A channel is only redrawn
+    when its value changes.
+    '''
 
     BACKGROUND = '#aaaaaa'
     FILL = '#00aa00'
 
-    def __init__(self, parent) -> None:
-        self.w = 250
-        self.h = 20
-        super().__init__(parent, width=self.w, height=self.h, bg=self.BACKGROUND)
-        self.fill = self.create_rectangle(0, 0, self.w, self.h, fill=self.FILL)
-        self.text = self.create_text(self.w//2, self.h//2, text='')
-        self.set(1500)
-
-    def set(self, value: int) -> None:
-        perc = (value - 1000) / 1000
-        self.coords(self.fill, 0, 0, self.w * perc, self.h)
-        self.itemconfig(self.text, text=f'{int(perc*100)} %')
-
-
-class RxChannel:
-
-    def __init__(self, parent, channel: int):
-        self._text_var = tk.StringVar()
-        self._text_var.set(500)
-
-        label = ttk.Label(parent, text=f'Channel {channel}', justify=tk.LEFT)
-        label_value = ttk.Label(parent, textvariable=self._text_var)
-        self.progress_bar = ProgressBar(parent)
-
-        pad = {'padx': 10, 'pady': 1, 'sticky': tk.W}
-        label.grid(row=channel, column=0, **pad)
-        self.progress_bar.grid(row=channel, column=1, **pad)
-        label_value.grid(row=channel, column=2, **pad)
-
-    def set(self, value: int) -> None:
+    ROW_HEIGHT = 26
+    LABEL_WIDTH = 110
+    BAR_WIDTH = 250
+    BAR_HEIGHT = 20
+    VALUE_WIDTH = 60
+
+    def __init__(self, parent, channels: int) -> None:
+        super().__init__(parent,
+                         width=self.LABEL_WIDTH + self.BAR_WIDTH + self.VALUE_WIDTH,
+                         height=self.ROW_HEIGHT * channels,
+                         background='white',
+                         highlightthickness=0)
+        # channel: (fill, percent text, value text)
+        self._items = {}
+        self._values = {}
+        for channel in range(1, channels + 1):
+            top = (channel - 1) * self.ROW_HEIGHT + (self.ROW_HEIGHT - self.BAR_HEIGHT) // 2
+            middle = top + self.BAR_HEIGHT // 2
+            x0 = self.LABEL_WIDTH
+            x1 = x0 + self.BAR_WIDTH
+            self.create_text(5, middle, text=f'Channel {channel}', anchor=tk.W)
+            self.create_rectangle(x0, top, x1, top + self.BAR_HEIGHT, fill=self.BACKGROUND, width=0)
+            fill = self.create_rectangle(x0, top, x0, top + self.BAR_HEIGHT, fill=self.FILL, width=0)
+            perc = self.create_text((x0 + x1) // 2, middle, text='')
+            value = self.create_text(x1 + 10, middle, text='', anchor=tk.W)
+            self._items[channel] = (fill, perc, value)
+            self._values[channel] = None
+            self.set(channel, 1500)
+
+    def set(self, channel: int, value: int) -> None:
         '''
         value: RX channel value, between 1000 and 2000
         '''
-        self.progress_bar.set(value)
-        self._text_var.set(str(value))
+        if value == self._values[channel]:
+            return
+        self._values[channel] = value
+
+        fill, perc_text, value_text = self._items[channel]
+        perc = (value - 1000) / 1000
+        x0, y0, _, y1 = self.coords(fill)
+        self.coords(fill, x0, y0, x0 + self.BAR_WIDTH * perc, y1)
+        self.itemconfigure(perc_text, text=f'{int(perc*100)} %')
+        self.itemconfigure(value_text, text=str(value))
+
+    def setter(self, channel: int) -> Callable[[int], None]:
+        return lambda value: self.set(channel, value)
 
 
 class ContentRx(Content):
     def __init__(self, parent, asac: ASAC) -> None:
-        super().__init__(parent, 'RX')
-        asac.add_message_handler(common.MAVLink_rc_channels_message, self._new_data)
-
-        self.frame_channels = ttk.Frame(self.content)
+        super().__init__(parent, 'RX', asac)
+        self.frame_channels = RxChannels(self.content, 16)
 
-        self.channels = {ch: RxChannel(self.frame_channels, ch ) for ch in range(1, 17)}
+        for ch in range(1, 17):
+            self.add_field_handler(common.MAVLink_rc_channels_message,
+                                   f'chan{ch}_raw',
+                                   self.frame_channels.setter(ch),
+                                   max_rate_hz=30)
+        self.request_stream_rate(common.MAVLink_rc_channels_message, 50)
 
         # Config
         self.frame_config = ttk.Frame(self.content)
@@ -69,9 +88,3 @@ class ContentRx(Content):
 
         self.frame_channels.grid(row=0, column=0, sticky=tk.N)
         self.frame_config.grid(row=0, column=1, sticky=tk.N)
-
-    def _new_data(self, msg: common.MAVLink_rc_channels_message) -> None:
-        for ch, ui_ch in self.channels.items():
-            attr_name = f'chan{ch}_raw'
-            ch_value = getattr(msg, attr_name)
-            ui_ch.set(ch_value)
@@ -0,0 +1,199 @@
+from pymavlink.dialects.v20.common import MAVLink_message
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+from dataclasses import dataclass
+from enum import IntEnum
+from threading import Lock, Thread, Condition
+from typing import Callable, Deque
+import time
+import utils
+from profiler import get_profiler
+
+
+__all__ = ['ExecutionPolicy', 'Overflow', 'MessageHandler', 'HandlerStats']
+
+
+class ExecutionPolicy(IntEnum):
+    # Called directly from the dispatch thread
+    INLINE = 0
+    # Called from a thread of its own
+    WORKER = 1
+    # Called from a thread pool shared with other handlers
+    POOL = 2
+
+
+class Overflow(IntEnum):
+    # When the queue is full, the oldest message is dropped
+    DROP_OLDEST = 0
+    # Only the newest message of each type is kept in the queue
+    CONFLATE = 1
+
+
+POOL_WORKERS = 4
+
+_pool: ThreadPoolExecutor = None
+_pool_lock = Lock()
+
+
+def _get_pool() -> ThreadPoolExecutor:
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ThreadPoolExecutor(max_workers=POOL_WORKERS,
+                                       thread_name_prefix='handler-pool')
+        return _pool
+
+
+@dataclass
+class HandlerStats:
+    name: str
+    policy: ExecutionPolicy
+    calls: int
+    dropped: int
+    conflated: int
+    queued: int
+    lag_avg_ms: float
+    lag_max_ms: float
+
+
+class MessageHandler:
+    '''
+    Wraps a message handler callback with an execution policy.
+
+    Handlers that aren't inline get a bounded queue of their own, so that
+    a slow handler only delays itself, never the dispatch thread or other
+    handlers. Messages of one handler are always handled in order, one at
+    a time, even in the shared pool.
+
+    Lag is measured from when the message was received (the `_rx_time`
+    attribute set by ASAC) until the handler is called.
+    '''
+
+    # Weight of the latest sample in the average lag
+    _LAG_ALPHA = 0.1
+    # Max number of messages handled per turn in the shared pool
+    _POOL_BATCH = 32
+
+    def __init__(self,
+                 callback: Callable[[MAVLink_message], None],
+                 policy: ExecutionPolicy = ExecutionPolicy.INLINE,
+                 queue_size: int = 100,
+                 overflow: Overflow = Overflow.DROP_OLDEST) -> None:
+        self.callback = callback
+        self.policy = policy
+        self.overflow = overflow
+        self._queue: Deque[MAVLink_message] = deque()
+        self._queue_size = queue_size
+        self._cond = Condition()
+        self._scheduled = False
+        self._worker: Thread = None
+        self._closed = False
+
+        self.calls = 0
+        self.dropped = 0
+        self.conflated = 0
+        self.lag_avg_s = 0.0
+        self.lag_max_s = 0.0
+
+    def __call__(self, msg: MAVLink_message) -> None:
+        ''' Called from the dispatch thread. '''
+        if self.policy == ExecutionPolicy.INLINE:
+            self._call(msg)
+            return
+
+        with self._cond:
+            if self._closed:
+                return
+            self._enqueue(msg)
+            if self.policy == ExecutionPolicy.WORKER:
+                if self._worker is None:
+                    name = getattr(self.callback, '__qualname__', 'handler')
+                    self._worker = Thread(target=self._worker_thread, name=f'handler-{name}',
+                                          daemon=True)
+                    self._worker.start()
+                self._cond.notify()
+            elif not self._scheduled:
+                self._scheduled = True
+                _get_pool().submit(self._drain)
+
+    def close(self) -> None:
+        ''' Stops the worker, if any. Queued messages are dropped. '''
+        with self._cond:
+            self._closed = True
+            self._queue.clear()
+            self._cond.notify()
+
+    def stats(self) -> HandlerStats:
+        return HandlerStats(
+            name=getattr(self.callback, '__qualname__', repr(self.callback)),
+            policy=self.policy,
+            calls=self.calls,
+            dropped=self.dropped,
+            conflated=self.conflated,
+            queued=len(self._queue),
+            lag_avg_ms=self.lag_avg_s * 1000,
+            lag_max_ms=self.lag_max_s * 1000
+        )
+
+    def _enqueue(self, msg: MAVLink_message) -> None:
+        if self.overflow == Overflow.CONFLATE:
+            msg_type = type(msg)
+            for i, queued in enumerate(self._queue):
+                if type(queued) is msg_type:
+                    del self._queue[i]
+                    self.conflated += 1
+                    break
+
+        if len(self._queue) >= self._queue_size:
+            self._queue.popleft()
+            self.dropped += 1
+
+        self._queue.append(msg)
+
+    def _call(self, msg: MAVLink_message) -> None:
+        rx_time = getattr(msg, '_rx_time', None)
+        if rx_time is not None:
+            lag = time.monotonic() - rx_time
+            self.lag_avg_s += self._LAG_ALPHA * (lag - self.lag_avg_s)
+            if lag > self.lag_max_s:
+                self.lag_max_s = lag
+
+        self.calls += 1
+        profiler = get_profiler()
+        t0 = time.perf_counter() if profiler.running else None
+        try:
+            self.callback(msg)
+        except Exception:
+            if self.policy == ExecutionPolicy.INLINE:
+                raise
+            # There's no one else to report to from a worker thread
+            utils.get_logger('dispatch').exception(f'Exception in message handler {self.callback}')
+        finally:
+            if t0 is not None:
+                name = getattr(self.callback, '__qualname__', repr(self.callback))
+                profiler.record_call('handler', f'{type(msg).__name__} {name}', time.perf_counter() - t0)
+
+    def _worker_thread(self) -> None:
+        while True:
+            with self._cond:
+                while not self._queue and not self._closed:
+                    self._cond.wait()
+                if self._closed:
+                    return
+                msg = self._queue.popleft()
+            self._call(msg)
+
+    def _drain(self) -> None:
+        '''
+        Runs in the pool, handles what's queued. A busy handler gives up its
+        pool thread after a batch, so that it can't starve other handlers.
+        '''
+        for _ in range(self._POOL_BATCH):
+            with self._cond:
+                if not self._queue or self._closed:
+                    self._scheduled = False
+                    return
+                msg = self._queue.popleft()
+            self._call(msg)
+
+        _get_pool().submit(self._drain)
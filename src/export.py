@@ -0,0 +1,232 @@
+'''
+Streaming export of telemetry to columnar files, for post-flight analysis.
+
+Each message type gets its own directory, with one NumPy .npy file per
+field, plus a `_time` column with the GCS receive time (NaN for messages
+read from a byte log, since the log has no timestamps). Rows are buffered
+in small chunks and appended to the files, so memory use is constant no
+matter how long the session is. The .npy files are written without NumPy,
+but can be loaded with it, eg:
+
+    columns = load_columns('export/ATTITUDE')
+    columns['roll']  # numpy array
+'''
+from pymavlink.dialects.v20 import common
+from pymavlink.dialects.v20.common import MAVLink, MAVLink_message, MAVError
+from array import array
+from pathlib import Path
+from threading import Lock
+from typing import Any, Dict, List, Tuple, Union
+import math
+import struct
+import time
+
+
+__all__ = ['TelemetryExporter', 'load_columns']
+
+
+# MAVLink field type: (array typecode, npy descr)
+_FIELD_TYPES = {
+    'int8_t': ('b', '|i1'),
+    'uint8_t': ('B', '|u1'),
+    'int16_t': ('h', '<i2'),
+    'uint16_t': ('H', '<u2'),
+    'int32_t': ('i', '<i4'),
+    'uint32_t': ('I', '<u4'),
+    'int64_t': ('q', '<i8'),
+    'uint64_t': ('Q', '<u8'),
+    'float': ('f', '<f4'),
+    'double': ('d', '<f8'),
+}
+
+_NPY_MAGIC = b'\x93NUMPY\x01\x00'
+# Room reserved for the header, so that it can be rewritten in place with
+# the final shape once we know how many rows there are.
+_NPY_HEADER_LEN = 128
+
+TIME_COLUMN = '_time'
+
+
+class _NpyColumn:
+    ''' A .npy file that rows are appended to. '''
+
+    def __init__(self, path: Path, descr: str, row_shape: Tuple[int, ...]) -> None:
+        self._descr = descr
+        self._row_shape = row_shape
+        self.rows = 0
+        self._file = open(path, 'wb')
+        self._write_header()
+
+    def append(self, data: bytes, rows: int) -> None:
+        self._file.write(data)
+        self.rows += rows
+
+    def close(self) -> None:
+        self._file.seek(0)
+        self._write_header()
+        self._file.close()
+
+    def _write_header(self) -> None:
+        shape = (self.rows, ) + self._row_shape
+        header = f"{{'descr': '{self._descr}', 'fortran_order': False, 'shape': {shape}, }}"
+        header = header.encode('latin1')
+        padding = _NPY_HEADER_LEN - len(_NPY_MAGIC) - 2 - len(header) - 1
+        header = header + b' ' * padding + b'\n'
+        self._file.write(_NPY_MAGIC + struct.pack('<H', len(header)) + header)
+
+
+class _Field:
+    ''' Buffers values of one field until they're written as a chunk. '''
+
+    def __init__(self, directory: Path, name: str, field_type: str, length: int) -> None:
+        self.name = name
+        self._values = []
+        if field_type == 'char':
+            # Strings are stored as fixed length bytes
+            self._typecode = None
+            self._length = length or 1
+            descr = f'|S{self._length}'
+            row_shape = ()
+        else:
+            self._typecode, descr = _FIELD_TYPES[field_type]
+            self._length = length
+            row_shape = (length, ) if length else ()
+        self._column = _NpyColumn(directory.joinpath(f'{name}.npy'), descr, row_shape)
+
+    def add(self, value: Any) -> None:
+        if self._typecode is None:
+            if isinstance(value, str):
+                value = value.encode('latin1', errors='replace')
+            self._values.append(value[:self._length].ljust(self._length, b'\x00'))
+        elif self._length:
+            self._values.extend(value)
+        else:
+            self._values.append(value)
+
+    def flush(self, rows: int) -> None:
+        if self._typecode is None:
+            data = b''.join(self._values)
+        else:
+            data = array(self._typecode, self._values).tobytes()
+        self._column.append(data, rows)
+        self._values.clear()
+
+    def close(self) -> None:
+        self._column.close()
+
+
+class _MessageWriter:
+    ''' Writes all fields of one message type. '''
+
+    def __init__(self, directory: Path, msg_type: MAVLink_message) -> None:
+        directory.mkdir(parents=True, exist_ok=True)
+        lengths = dict(zip(msg_type.ordered_fieldnames, msg_type.array_lengths))
+        self._fields = [_Field(directory, name, field_type, lengths.get(name, 0))
+                        for name, field_type in zip(msg_type.fieldnames, msg_type.fieldtypes)]
+        self._time = _Field(directory, TIME_COLUMN, 'double', 0)
+        self._rows = 0
+
+    def add(self, msg: MAVLink_message, timestamp: float) -> int:
+        for field in self._fields:
+            field.add(getattr(msg, field.name))
+        self._time.add(timestamp)
+        self._rows += 1
+        return self._rows
+
+    def flush(self) -> None:
+        if not self._rows:
+            return
+        for field in self._fields:
+            field.flush(self._rows)
+        self._time.flush(self._rows)
+        self._rows = 0
+
+    def close(self) -> None:
+        self.flush()
+        for field in self._fields:
+            field.close()
+        self._time.close()
+
+
+class TelemetryExporter:
+    '''
+    Exports messages to columnar files in the given directory, with one
+    sub directory per message type. Call `close` when done, it's only then
+    the files get their final row count.
+    '''
+
+    def __init__(self, directory: Union[str, Path], chunk_rows: int = 1024) -> None:
+        self.directory = Path(directory)
+        self._chunk_rows = chunk_rows
+        self._writers: Dict[type, _MessageWriter] = {}
+        self._lock = Lock()
+        self._attached: List[Tuple['ASAC', type]] = []
+
+    def write(self, msg: MAVLink_message, timestamp: float = None) -> None:
+        if timestamp is None:
+            timestamp = time.time()
+
+        msg_type = type(msg)
+        if common.mavlink_map.get(getattr(msg_type, 'id', None)) is not msg_type:
+            # Bad data, unknown messages etc
+            return
+
+        with self._lock:
+            writer = self._writers.get(msg_type)
+            if writer is None:
+                writer = _MessageWriter(self.directory.joinpath(msg_type.msgname), msg_type)
+                self._writers[msg_type] = writer
+            if writer.add(msg, timestamp) >= self._chunk_rows:
+                writer.flush()
+
+    def attach(self, asac: 'ASAC', msg_types: List[MAVLink_message]) -> None:
+        ''' Exports the given message types live from an ASAC session. '''
+        for msg_type in msg_types:
+            asac.add_message_handler(msg_type, self.write)
+            self._attached.append((asac, msg_type))
+
+    def export_log(self, path: Union[str, Path]) -> int:
+        '''
+        Exports all messages in a log of raw MAVLink bytes, eg recorded with
+        ASAC.start_recording. Returns the number of exported messages.
+        '''
+        mav = MAVLink(None)
+        count = 0
+        with open(path, 'rb') as f:
+            for data in iter(lambda: f.read(65536), b''):
+                # Parse until the parser needs more data to make progress
+                while True:
+                    buf_len = mav.buf_len()
+                    try:
+                        msg = mav.parse_char(data)
+                    except MAVError:
+                        msg = None
+                    data = b''
+                    if msg is not None:
+                        self.write(msg, math.nan)
+                        count += 1
+                    elif mav.buf_len() == buf_len:
+                        break
+        return count
+
+    def close(self) -> None:
+        for asac, msg_type in self._attached:
+            asac.del_message_handler(msg_type, self.write)
+        self._attached.clear()
+
+        with self._lock:
+            for writer in self._writers.values():
+                writer.close()
+            self._writers.clear()
+
+
+def load_columns(directory: Union[str, Path], mmap: bool = True) -> Dict[str, Any]:
+    '''
+    Loads all columns of one exported message type as NumPy arrays.
+    Requires NumPy, which is only needed for loading.
+    '''
+    import numpy
+
+    mmap_mode = 'r' if mmap else None
+    return {path.stem: numpy.load(path, mmap_mode=mmap_mode)
+            for path in sorted(Path(directory).glob('*.npy'))}
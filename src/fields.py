@@ -0,0 +1,84 @@
+from pymavlink.dialects.v20.common import MAVLink_message
+from threading import Lock
+from typing import Any, Callable, List
+import time
+
+
+__all__ = ['FieldSubscription', 'FieldWatcher']
+
+
+class FieldSubscription:
+    '''
+    Subscription to a single field of a MAVLink message.
+
+    The callback is only called with the new value when the field actually
+    changes. For numeric fields, changes smaller than `deadband` are ignored,
+    and `max_rate_hz` limits how often the callback may be called. Changes
+    that are held back by the rate limit are delivered with the next message
+    once the limit allows it.
+    '''
+
+    def __init__(self,
+                 field: str,
+                 callback: Callable[[Any], None],
+                 deadband: float = 0,
+                 max_rate_hz: float = None) -> None:
+        self.field = field
+        self.callback = callback
+        self.deadband = deadband
+        if max_rate_hz:
+            self._min_interval_s = 1 / max_rate_hz
+        else:
+            self._min_interval_s = 0
+        self._value: Any = None
+        self._has_value = False
+        self._last_called = 0
+
+    def update(self, msg: MAVLink_message, now: float) -> None:
+        value = getattr(msg, self.field)
+
+        if self._has_value:
+            if not self._changed(value):
+                return
+            if (now - self._last_called) < self._min_interval_s:
+                return
+
+        self._value = value
+        self._has_value = True
+        self._last_called = now
+        self.callback(value)
+
+    def _changed(self, value: Any) -> bool:
+        if self.deadband and isinstance(value, (int, float)):
+            return abs(value - self._value) > self.deadband
+        return value != self._value
+
+
+class FieldWatcher:
+    '''
+    Message handler that runs change detection for all field subscriptions
+    of one message type, so it's only done once per message.
+
+    Subscriptions come and go from other threads, eg when a page is shown,
+    so the list is replaced rather than modified, and the handler iterates
+    over the list it got without locking.
+    '''
+
+    def __init__(self) -> None:
+        self.subscriptions: List[FieldSubscription] = []
+        self._lock = Lock()
+
+    def add(self, subscription: FieldSubscription) -> None:
+        with self._lock:
+            self.subscriptions = self.subscriptions + [subscription]
+
+    def remove(self, subscription: FieldSubscription) -> bool:
+        ''' Returns True if there are subscriptions left. '''
+        with self._lock:
+            self.subscriptions = [s for s in self.subscriptions if s is not subscription]
+            return bool(self.subscriptions)
+
+    def __call__(self, msg: MAVLink_message) -> None:
+        now = time.monotonic()
+        for subscription in self.subscriptions:
+            subscription.update(msg, now)
@@ -1,20 +1,24 @@
+import utils
+# Created first, so that the startup profile includes the imports below
+startup_profile = utils.StartupProfile()
+
 from dataclasses import dataclass, asdict
+from functools import lru_cache
 import json
 import tkinter as tk
 from tkinter import ttk
 from pathlib import Path
-from threading import Thread
-from serial.tools import list_ports
-from serial.tools.list_ports_common import ListPortInfo
-import time
-from typing import List, Dict, Tuple
+from typing import Callable, List, Dict, Tuple
 import sys
-import utils
+from threading import Lock
 
-from pymavlink.dialects.v10 import common
+from pymavlink.dialects.v20 import common
 
 
 from asac import ASAC
+import profiler
+from baudrate import BAUDRATE_AUTO, DEFAULT_BAUDRATE
+from dispatch import ExecutionPolicy
 from content.content import Content
 from content.general import ContentGeneral
 from content.motors import ContentMotors
@@ -22,14 +26,17 @@ from content.pid import ContentPid
 from content.rx import ContentRx
 from content.vtx import ContentVTX
 from content.pid import ContentPid
-from utils import run_thread
+from scheduler import TkExecutor, get_scheduler
+from utils import constrain
 
 
 PROJECT_ROOT = Path(__file__).absolute().parent.parent
 RESOURCES = PROJECT_ROOT.joinpath('resources')
 
 
+@lru_cache(maxsize=None)
 def get_image(name: str) -> tk.PhotoImage:
+    ''' Images are decoded the first time they're used, and then cached. '''
     return tk.PhotoImage(file=RESOURCES.joinpath(name))
 
 
@@ -40,6 +47,8 @@ DEFAULT_WINDOW_HEIGHT = 900
 
 FONT = 'Helvetica'
 
+BAUDRATES = ['auto', '57600', '115200', '230400', '460800', '921600']
+
 
 # Settings struct
 @dataclass
@@ -77,18 +86,57 @@ frame_style = {'bg': BASE_BACKGROUND}
 
 class LogDebug(ttk.LabelFrame):
 
+    # Text is inserted in batches, since every insert is slow
+    FLUSH_INTERVAL_MS = 100
+    MAX_LINES = 2000
+
     def __init__(self, parent) -> None:
         super().__init__(parent, text='Debug Console')
         self.text = tk.Text(self, height=10)
-        btn_clear = ttk.Button(self, text='Clear', command=lambda: self.text.delete("1.0","end"))
-
-        btn_clear.pack(anchor=tk.W)
+        self._pending: List[str] = []
+        self._pending_lock = Lock()
+        self._flush_scheduled = False
+        frame_buttons = ttk.Frame(self)
+        btn_clear = ttk.Button(frame_buttons, text='Clear', command=lambda: self.text.delete("1.0","end"))
+        # Profiling can also be enabled from start with ASAC_PROFILE=1
+        self._profiler = profiler.get_profiler()
+        self.profile_var = tk.BooleanVar(value=self._profiler.running)
+        check_profile = ttk.Checkbutton(frame_buttons, text='Profile', variable=self.profile_var,
+                                        command=self._toggle_profiling)
+        btn_dump = ttk.Button(frame_buttons, text='Dump profile', command=self._profiler.dump)
+
+        btn_clear.pack(side=tk.LEFT)
+        check_profile.pack(side=tk.LEFT, padx=10)
+        btn_dump.pack(side=tk.LEFT)
+        frame_buttons.pack(anchor=tk.W)
         self.text.pack(side=tk.BOTTOM, expand=True, fill=tk.X)
 
     def log(self, msg: str) -> None:
-        self.text.insert(tk.END, msg)
+        ''' May be called from any thread, eg the logging thread. '''
+        with self._pending_lock:
+            self._pending.append(msg)
+            if self._flush_scheduled:
+                return
+            self._flush_scheduled = True
+        self.after(self.FLUSH_INTERVAL_MS, self._flush)
+
+    def _flush(self) -> None:
+        with self._pending_lock:
+            text = ''.join(self._pending)
+            self._pending.clear()
+            self._flush_scheduled = False
+        self.text.insert(tk.END, text)
+        lines = int(self.text.index('end-1c').split('.')[0])
+        if lines > self.MAX_LINES:
+            self.text.delete('1.0', f'{lines - self.MAX_LINES}.0')
         self.text.see(tk.END)
 
+    def _toggle_profiling(self) -> None:
+        if self.profile_var.get():
+            self._profiler.start()
+        else:
+            self._profiler.stop()
+
 
 class Battery(tk.Canvas):
 
@@ -108,14 +156,20 @@ class Battery(tk.Canvas):
         super().__init__(parent, width=self.w, height=self.h, background=self.BG)
         self._fill = self.create_rectangle(0, 0, 0, self.h, fill=self.FILL)
         self._text = self.create_text(self.w//2, self.h//2+5, text='0V', font=(FONT, 14, 'bold'))
+        self._shown = None
         self.set(0)
 
     def set(self, voltage: float) -> None:
+        # Only redraw when the shown value changes
+        text = f'{voltage:.2f} V'
+        if text == self._shown:
+            return
+        self._shown = text
+
         min_, max_ = self._get_min_max(voltage)
-        print(min_, max_)
-        perc = (voltage - min_) / (max_ - min_)
+        perc = constrain((voltage - min_) / (max_ - min_), 0, 1)
         self.coords(self._fill, 0, 0, perc*self.w, self.h)
-        self.itemconfigure(self._text, text=f'{voltage:.2f} V')
+        self.itemconfigure(self._text, text=text)
 
     def _get_min_max(self, voltage: float) -> Tuple[float, float]:
         for min_, max_ in self.VOLTAGE_TABLE:
@@ -128,15 +182,27 @@ class Gui(tk.Tk):
 
     _SETTINGS_PATH = PROJECT_ROOT.joinpath('gui_settings.json')
 
+    HEARTBEAT_TIMEOUT_S = 3
+
     @dataclass
     class GuiSettings:
         active_content: str
         window_width: int
         window_height: int
+        # A number, or 'auto' to detect it
+        baudrate: str = str(DEFAULT_BAUDRATE)
+        # Download all parameters on connect, rather than only the ones the
+        # shown page needs
+        full_param_sync: bool = False
 
     def __init__(self) -> None:
         super().__init__()
-        self.logger = utils.get_logger()
+        self.logger = utils.get_logger('gui')
+        self._scheduler = get_scheduler()
+        # For UI updates from other threads
+        self._tk = TkExecutor(self)
+        self._port_scanner = None
+        profiler.install_tk_hooks()
 
         self.protocol("WM_DELETE_WINDOW", self._on_exit)
 
@@ -154,11 +220,19 @@ class Gui(tk.Tk):
         self._asac = ASAC(on_connect=self._on_connect,
                           on_disconnect=self._on_disconnect)
         # Add handlers for MAVlink messages
-        self._asac.add_message_handler(common.MAVLink_statustext_message, self._mavlink_statustext)
+        # Printing goes to the debug console, which is slow
+        self._asac.add_message_handler(common.MAVLink_statustext_message, self._mavlink_statustext,
+                                       policy=ExecutionPolicy.WORKER)
         self._asac.add_message_handler(common.MAVLink_heartbeat_message, self._mavlink_heartbeat)
         #self._asac.add_message_handler(common.MAVLINK_MSG_ID_SCALED_IMU, self._mavlink_scaled_imu)
-        self._asac.add_message_handler(common.MAVLink_attitude_message, self._mavlink_attitude)
-        self._asac.add_message_handler(common.MAVLink_battery_status_message, self._mavlink_battery_status)
+        self._asac.add_field_handler(common.MAVLink_battery_status_message, 'voltages', self._mavlink_battery_voltages)
+
+        # Telemetry is streamed slowly, unless a content page that shows it
+        # asks for more.
+        for msg_type in (common.MAVLink_attitude_message,
+                         common.MAVLink_rc_channels_message,
+                         common.MAVLink_battery_status_message):
+            self._asac.stream_rates.set_default_rate(msg_type, 1)
 
         # -- Frames --- #
         frame_pack_kw = {'padx': 5, 'pady': 5}
@@ -172,20 +246,22 @@ class Gui(tk.Tk):
 
         # -- Control frame -- #
         ctrl_pack_kw = {'padx': '10', 'pady': '0'}
-        self.img_btn_connected = get_image('btn_connected.png')
-        self.img_btn_disconnected = get_image('btn_disconnected.png')
-        self.img_title = get_image('title.png')
-        title = ttk.Label(self.frame_ctrl, image=self.img_title)
+        title = ttk.Label(self.frame_ctrl, image=get_image('title.png'))
 
         serial_port = ttk.Label(self.frame_ctrl, text='Serial port')
         self.combo_serial_port_var = tk.StringVar()
         self.combo_serial_port = ttk.Combobox(self.frame_ctrl, width=40,
                                               state='readonly',
                                               textvariable=self.combo_serial_port_var)
+        self.combo_baudrate_var = tk.StringVar(value=self.settings.baudrate)
+        self.combo_baudrate = ttk.Combobox(self.frame_ctrl, width=8,
+                                           values=BAUDRATES,
+                                           textvariable=self.combo_baudrate_var)
         self.btn_connect = ttk.Button(self.frame_ctrl, text='Connect',
                                      command=self._connect)
         self.btn_reboot = ttk.Button(self.frame_ctrl, text='Reboot',
                                      command=self._reboot)
+        self.label_link_stats = ttk.Label(self.frame_ctrl, width=30)
         self.battery = Battery(self.frame_ctrl)
         self.label_image_connected = ttk.Label(self.frame_ctrl)
 
@@ -194,26 +270,25 @@ class Gui(tk.Tk):
         self.battery.pack(side=tk.RIGHT, **ctrl_pack_kw)
         self.btn_reboot.pack(side=tk.RIGHT, **ctrl_pack_kw)
         self.btn_connect.pack(side=tk.RIGHT, **ctrl_pack_kw)
+        self.label_link_stats.pack(side=tk.RIGHT, **ctrl_pack_kw)
+        self.combo_baudrate.pack(side=tk.RIGHT, **ctrl_pack_kw)
         self.combo_serial_port.pack(side=tk.RIGHT, **ctrl_pack_kw)
         serial_port.pack(side=tk.RIGHT, **ctrl_pack_kw)
 
         # -- Main content -- #
-        self.content_general = ContentGeneral(self.frame_content, self._asac, self.general_save)
-        self.content_pid = ContentPid(self.frame_content, self.pid_save, self._asac)
-        self.content_motors = ContentMotors(self.frame_content, self._asac, self.info_popup)
-        self.content_rx = ContentRx(self.frame_content, self._asac)
-        self.content_vtx = ContentVTX(self.frame_content)
-        self.contents = {
-            'general': self.content_general,
-            'pid': self.content_pid,
-            'motors': self.content_motors,
-            'rx': self.content_rx,
-            'vtx': self.content_vtx,
+        # Content pages are built the first time they're shown
+        self._content_factories: Dict[str, Callable[[], Content]] = {
+            'general': lambda: ContentGeneral(self.frame_content, self._asac, self.general_save),
+            'pid': lambda: ContentPid(self.frame_content, self.pid_save, self._asac),
+            'motors': lambda: ContentMotors(self.frame_content, self._asac, self.info_popup),
+            'rx': lambda: ContentRx(self.frame_content, self._asac),
+            'vtx': lambda: ContentVTX(self.frame_content),
         }
+        self.contents: Dict[str, Content] = {}
 
         # -- Side bar -- #
         sidebar_btn_pack = {'ipadx': 10, 'ipady': 10, 'fill': tk.X}
-        for content in self.contents:
+        for content in self._content_factories:
             # The weird-looking lambda here is just using a default value
             # for the argument.
             btn = ttk.Button(self.frame_sidebar, text=content.upper(),
@@ -251,38 +326,72 @@ class Gui(tk.Tk):
         self._info_showing = False
         self._info = tk.Label(self)
 
-        self._available_serial_ports: List[ListPortInfo] = []
-        Thread(target=self._available_serial_port_thread, daemon=True).start()
+        self._available_serial_ports: List['ListPortInfo'] = []
 
-        # Update UI state once before we start
-        self._update_state()
+        # Update UI state once before we start. The active content page is
+        # built after the window is shown.
+        self._update_state(update_content=False)
+
+        # Everything that isn't needed to show the window is done after the
+        # window has been drawn for the first time.
+        self._startup_finished = False
+        self.bind('<Map>', self._on_first_map, '+')
+        startup_profile.mark('window created')
+
+    def _on_first_map(self, event: tk.Event) -> None:
+        if event.widget is not self or self._startup_finished:
+            return
+        self._startup_finished = True
+        self.after_idle(self._finish_startup)
+
+    def _finish_startup(self) -> None:
+        startup_profile.mark('first paint')
+
+        self._update_content()
+        startup_profile.mark('active content page')
+
+        self._port_scanner = self._scheduler.call_every(1, self._scan_serial_ports)
+        self._update_link_stats()
+        startup_profile.mark('ready')
+        self.logger.info(startup_profile.report())
 
     def _on_connect(self) -> None:
-        run_thread(self._asac.get_parameters, self._update_parameters)
-        self.info_popup(f'Connected to {self._asac.port}', bg='green')
-        self._update_state()
+        if self.settings.full_param_sync:
+            self._asac.get_parameters()
+        for content in list(self.contents.values()):
+            if content.visible:
+                content.fetch_parameters()
+        self._tk.call(self.info_popup, f'Connected to {self._asac.port}', 'green')
+        self._tk.call(self._update_state)
 
     def _on_disconnect(self) -> None:
-        self._update_state()
+        self._tk.call(self._update_state)
 
     def _connect(self) -> None:
         port = self.combo_serial_port_var.get()
         if port:
             port, desc = port.split('(')
             port = port.strip()
-            run_thread(self._asac.start, port)
+            baudrate = self.combo_baudrate_var.get().strip()
+            self.settings.baudrate = baudrate
+            if baudrate == 'auto':
+                baudrate = BAUDRATE_AUTO
+            else:
+                try:
+                    baudrate = int(baudrate)
+                except ValueError:
+                    self.info_popup(f'Invalid baudrate {baudrate}', bg='red')
+                    return
+            self._scheduler.submit(self._asac.start, port, baudrate)
             #self.info_popup(f'Failed to connect to port {port}', bg='red')
         else:
             self.info_popup(f'No serial port available', bg='red')
 
     def _disconnect(self) -> None:
-        run_thread(self._asac.stop)
-
-    def _update_parameters(self, params: Dict[str, common.MAVLink_param_value_message]) -> None:
-        self.content_pid.set_pid_values(params)
+        self._scheduler.submit(self._asac.stop)
 
     def _reboot(self) -> None:
-        run_thread(self._asac.reboot)
+        self._scheduler.submit(self._asac.reboot)
 
     def general_save(self) -> None:
         self.info_popup('Saved!', timeout_ms=1000)
@@ -307,14 +416,11 @@ class Gui(tk.Tk):
             y=self.winfo_height()-40
         )
 
-        def wait_until_complete(timeout_ms: int) -> None:
-            time.sleep(timeout_ms/1000)
+        def hide() -> None:
             self._info.place_forget()
             self._info_showing = False
 
-        Thread(target=wait_until_complete,
-               args=(timeout_ms, ),
-               daemon=True).start()
+        self.after(timeout_ms, hide)
 
     def is_connected(self) -> bool:
         return self._asac.is_connected()
@@ -360,44 +466,89 @@ class Gui(tk.Tk):
         self.settings.window_height = self.winfo_height()
 
         self._store_settings()
+
+        # Stop everything in the background before the window goes away
+        self._scheduler.shutdown()
+        self._asac.stop()
+
+        if profiler.get_profiler().running:
+            profiler.get_profiler().dump()
+
+        # The logging thread may still write, after the console is gone
+        sys.stdout.write = self.sys_stdout
+        sys.stderr.write = self.sys_stderr
         self.destroy()
 
-    def _update_state(self) -> None:
+    def _update_state(self, update_content: bool = True) -> None:
         if self.is_connected():
-            self.label_image_connected.config(image=self.img_btn_connected)
+            self.label_image_connected.config(image=get_image('btn_connected.png'))
             self.btn_connect['text'] = 'Disconnect'
             self.btn_connect['command'] = self._disconnect
             self.btn_reboot['state'] = 'enabled'
         else:
-            self.label_image_connected.config(image=self.img_btn_disconnected)
+            self.label_image_connected.config(image=get_image('btn_disconnected.png'))
             self.btn_connect['text'] = 'Connect'
             self.btn_connect['command'] = self._connect
             self.btn_reboot['state'] = tk.DISABLED
 
-        for content in self.contents.values():
-            content: Content
-            content.pack_forget()
-
         self.combo_serial_port['values'] = [f'{port.device} ({port.description})' for port in self._available_serial_ports]
         if self.combo_serial_port['values']:
             self.combo_serial_port.current(0)
         else:
             self.combo_serial_port_var.set('')
 
-        self.contents[self.settings.active_content].pack(fill=tk.BOTH, expand=True)
+        if update_content:
+            self._update_content()
 
-    def _available_serial_port_thread(self) -> None:
-        while not self.is_connected():
-            available_ports = []
-            ports = list_ports.comports()
-            for port in ports:
-                available_ports.append(port)
+    def _update_content(self) -> None:
+        ''' Shows the active content page, and hides all others. '''
+        active_content = self.settings.active_content
+        if active_content not in self._content_factories:
+            active_content = 'general'
 
-            if available_ports != self._available_serial_ports:
-                self._available_serial_ports = available_ports
-                self._update_state()
+        for name, content in self.contents.items():
+            if name != active_content:
+                content.hide()
 
-            time.sleep(1)
+        content = self.contents.get(active_content)
+        if content is None:
+            content = self._content_factories[active_content]()
+            self.contents[active_content] = content
+        content.show()
+
+    def _update_link_stats(self) -> None:
+        ''' Updates the link status indicator, once per second. '''
+        if self.is_connected():
+            stats = self._asac.link_stats.snapshot()
+            text = (f'{stats.packets_per_s:.0f} pkt/s  '
+                    f'{stats.bytes_per_s / 1000:.1f} kB/s  '
+                    f'loss {stats.loss_rate * 100:.1f}%')
+            errors = stats.crc_errors_per_s + stats.parse_errors_per_s
+            if errors:
+                text += f'  err {errors:.1f}/s'
+            rtt = self._asac.timesync.stats()
+            if rtt is not None:
+                text += f'  rtt {rtt.avg_ms:.0f} ms'
+            heartbeat = stats.time_since_heartbeat_s
+            if heartbeat is None or heartbeat > self.HEARTBEAT_TIMEOUT_S:
+                text += '  no heartbeat'
+        else:
+            text = ''
+        self.label_link_stats['text'] = text
+        self.after(1000, self._update_link_stats)
+
+    def _scan_serial_ports(self) -> None:
+        ''' Runs in the scheduler, every second. '''
+        if self.is_connected():
+            return
+
+        # Not imported at startup since it's not needed to show the window
+        from serial.tools import list_ports
+
+        available_ports = list(list_ports.comports())
+        if available_ports != self._available_serial_ports:
+            self._available_serial_ports = available_ports
+            self._tk.call(self._update_state)
 
     # -- MAVLINK message handlers -- #
     def _mavlink_heartbeat(self, msg: common.MAVLink_heartbeat_message) -> None:
@@ -407,15 +558,13 @@ class Gui(tk.Tk):
     def _mavlink_statustext(self, msg: common.MAVLink_heartbeat_message) -> None:
         print(msg)
 
-    def _mavlink_attitude(self, msg: common.MAVLink_attitude_message) -> None:
-        self.contents['general'].set_attitude_info(msg)
-
-    def _mavlink_battery_status(self, msg: common.MAVLink_battery_status_message) -> None:
-        vbat_mv = msg.voltages[0]
-        self.battery.set(vbat_mv / 1000)
+    def _mavlink_battery_voltages(self, voltages: List[int]) -> None:
+        vbat_mv = voltages[0]
+        self._tk.call(self.battery.set, vbat_mv / 1000)
 
 
 if __name__ == '__main__':
+    startup_profile.mark('imports')
     gui = Gui()
     style = ttk.Style()
     style.theme_use('clam')
@@ -0,0 +1,164 @@
+from dataclasses import dataclass, field
+from typing import Dict, List, Tuple
+import time
+
+
+__all__ = ['LinkStats', 'LinkSnapshot', 'SenderSnapshot']
+
+
+MSG_ID_HEARTBEAT = 0
+
+# Counters kept per bucket
+_PACKETS = 0
+_BYTES = 1
+_LOST = 2
+_CRC_ERRORS = 3
+_PARSE_ERRORS = 4
+_NBR_OF_COUNTERS = 5
+
+
+class _RollingWindow:
+    '''
+    Counters summed over the last `length_s` seconds, in buckets of one
+    second each. Rates are calculated from complete buckets only, so they
+    don't jump around depending on how far into the current second we are.
+    '''
+
+    def __init__(self, length_s: int) -> None:
+        self._length_s = length_s
+        self._seconds = [-1] * length_s
+        self._buckets = [[0] * _NBR_OF_COUNTERS for _ in range(length_s)]
+        self.totals = [0] * _NBR_OF_COUNTERS
+
+    def add(self, now: float, counter: int, value: int) -> None:
+        second = int(now)
+        i = second % self._length_s
+        bucket = self._buckets[i]
+        if self._seconds[i] != second:
+            self._seconds[i] = second
+            for j in range(_NBR_OF_COUNTERS):
+                bucket[j] = 0
+        bucket[counter] += value
+        self.totals[counter] += value
+
+    def rates(self, now: float) -> List[float]:
+        ''' Returns the per-second rate of each counter. '''
+        current = int(now)
+        sums = [0] * _NBR_OF_COUNTERS
+        for second, bucket in zip(self._seconds, self._buckets):
+            if current - self._length_s < second < current:
+                for j in range(_NBR_OF_COUNTERS):
+                    sums[j] += bucket[j]
+        complete_buckets = self._length_s - 1
+        return [s / complete_buckets for s in sums]
+
+
+@dataclass
+class SenderSnapshot:
+    packets_per_s: float
+    bytes_per_s: float
+    loss_rate: float
+    total_packets: int
+    total_lost: int
+    time_since_heartbeat_s: float
+
+
+@dataclass
+class LinkSnapshot:
+    packets_per_s: float
+    bytes_per_s: float
+    loss_rate: float
+    crc_errors_per_s: float
+    parse_errors_per_s: float
+    total_packets: int
+    total_bytes: int
+    total_lost: int
+    total_crc_errors: int
+    total_parse_errors: int
+    time_since_heartbeat_s: float
+    senders: Dict[Tuple[int, int], SenderSnapshot] = field(default_factory=dict)
+
+
+def _loss_rate(packets: float, lost: float) -> float:
+    if packets + lost == 0:
+        return 0
+    return lost / (packets + lost)
+
+
+class LinkStats:
+    '''
+    Statistics of a MAVLink link, both for the link as a whole and per
+    sender (system id, component id).
+
+    Recording is done from the RX thread and is kept cheap. `snapshot` can
+    be called from any thread. It doesn't lock, so the values may be off by
+    a packet or so, which is fine for statistics.
+    '''
+
+    def __init__(self, window_s: int = 5) -> None:
+        self._window_s = window_s
+        self.reset()
+
+    def reset(self) -> None:
+        self._link = _RollingWindow(self._window_s)
+        self._senders: Dict[Tuple[int, int], _RollingWindow] = {}
+        self._last_heartbeat: Dict[Tuple[int, int], float] = {}
+
+    def record_frame(self, sys_id: int, comp_id: int, msg_id: int,
+                     length: int, lost: int) -> None:
+        now = time.monotonic()
+        key = (sys_id, comp_id)
+        sender = self._senders.get(key)
+        if sender is None:
+            sender = _RollingWindow(self._window_s)
+            self._senders[key] = sender
+
+        for window in (self._link, sender):
+            window.add(now, _PACKETS, 1)
+            window.add(now, _BYTES, length)
+            if lost:
+                window.add(now, _LOST, lost)
+
+        if msg_id == MSG_ID_HEARTBEAT:
+            self._last_heartbeat[key] = now
+
+    def record_crc_error(self) -> None:
+        self._link.add(time.monotonic(), _CRC_ERRORS, 1)
+
+    def record_parse_error(self) -> None:
+        self._link.add(time.monotonic(), _PARSE_ERRORS, 1)
+
+    def snapshot(self) -> LinkSnapshot:
+        now = time.monotonic()
+
+        senders = {}
+        for key, window in list(self._senders.items()):
+            rates = window.rates(now)
+            last_heartbeat = self._last_heartbeat.get(key)
+            senders[key] = SenderSnapshot(
+                packets_per_s=rates[_PACKETS],
+                bytes_per_s=rates[_BYTES],
+                loss_rate=_loss_rate(rates[_PACKETS], rates[_LOST]),
+                total_packets=window.totals[_PACKETS],
+                total_lost=window.totals[_LOST],
+                time_since_heartbeat_s=(None if last_heartbeat is None
+                                        else now - last_heartbeat)
+            )
+
+        heartbeats = list(self._last_heartbeat.values())
+        rates = self._link.rates(now)
+        totals = self._link.totals
+        return LinkSnapshot(
+            packets_per_s=rates[_PACKETS],
+            bytes_per_s=rates[_BYTES],
+            loss_rate=_loss_rate(rates[_PACKETS], rates[_LOST]),
+            crc_errors_per_s=rates[_CRC_ERRORS],
+            parse_errors_per_s=rates[_PARSE_ERRORS],
+            total_packets=totals[_PACKETS],
+            total_bytes=totals[_BYTES],
+            total_lost=totals[_LOST],
+            total_crc_errors=totals[_CRC_ERRORS],
+            total_parse_errors=totals[_PARSE_ERRORS],
+            time_since_heartbeat_s=(now - max(heartbeats)) if heartbeats else None,
+            senders=senders
+        )
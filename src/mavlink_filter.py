@@ -0,0 +1,144 @@
+from pymavlink.dialects.v20.common import (MAVLink, MAVLink_message, MAVError,
+                                           mavlink_map, x25crc,
+                                           PROTOCOL_MARKER_V1,
+                                           MAVLINK_IFLAG_SIGNED,
+                                           MAVLINK_SIGNATURE_BLOCK_LEN)
+from threading import RLock
+from typing import Callable, Dict, List, Set, Tuple
+
+
+__all__ = ['FilteringMAVLink']
+
+
+class FilteringMAVLink(MAVLink):
+    '''
+    MAVLink parser that only decodes the messages someone is interested in.
+
+    The message ID is read straight from the frame header. Frames whose ID is
+    not in `wanted_ids` are CRC-checked and counted, but never unpacked into
+    message objects. Sequence numbers are tracked for all frames, so packet
+    loss is counted correctly even for messages that are skipped.
+
+    If set, `on_frame` is called for every valid frame with
+    (system id, component id, message id, frame length, lost packets), and
+    `on_raw_frame` with the bytes of the frame.
+
+    Messages are sent as MAVLink 1 until `use_mavlink2` is set. If
+    `auto_mavlink2` is set, this happens automatically as soon as a MAVLink 2
+    frame is received, and `on_mavlink2` is called. For MAVLink 2 frames, the
+    bytes saved by payload truncation are counted per message ID in
+    `mavlink2_savings`, as [frames, bytes saved by truncation].
+
+    Sending is serialized with `send_lock`, so that each frame gets a
+    sequence number of its own, whatever thread it's sent from. Others that
+    write frames with `seq`, eg msg_template.MessageTemplate, hold it too.
+    '''
+
+    def __init__(self, file, *args, **kwargs) -> None:
+        super().__init__(file, *args, **kwargs)
+        self.wanted_ids: Set[int] = set()
+        self.total_packets_skipped = 0
+        self.total_packets_lost = 0
+        # Last sequence number, per (system id, component id)
+        self._last_seq: Dict[Tuple[int, int], int] = {}
+        self.on_frame: Callable[[int, int, int, int, int], None] = None
+        self.on_raw_frame: Callable[[bytes], None] = None
+
+        self.use_mavlink2 = False
+        self.auto_mavlink2 = True
+        self.on_mavlink2: Callable[[], None] = None
+        self.mavlink2_savings: Dict[int, List[int]] = {}
+        self.send_lock = RLock()
+
+    def send(self, mavmsg: MAVLink_message, force_mavlink1: bool = False) -> None:
+        force_mavlink1 = force_mavlink1 or not self.use_mavlink2
+        with self.send_lock:
+            super().send(mavmsg, force_mavlink1=force_mavlink1)
+        if not force_mavlink1:
+            self._count_savings(type(mavmsg).id, mavmsg.unpacker.size, len(mavmsg._payload))
+
+    def send_mavlink2(self, mavmsg: MAVLink_message) -> None:
+        ''' Sends a message as MAVLink 2, even if we're not using it yet. '''
+        with self.send_lock:
+            super().send(mavmsg, force_mavlink1=False)
+
+    def decode(self, msgbuf: bytearray) -> MAVLink_message:
+        if msgbuf[0] == PROTOCOL_MARKER_V1:
+            seq, sys_id, comp_id, msg_id = msgbuf[2], msgbuf[3], msgbuf[4], msgbuf[5]
+            signature_len = 0
+        else:
+            seq, sys_id, comp_id = msgbuf[4], msgbuf[5], msgbuf[6]
+            msg_id = msgbuf[7] | (msgbuf[8] << 8) | (msgbuf[9] << 16)
+            if msgbuf[2] & MAVLINK_IFLAG_SIGNED:
+                signature_len = MAVLINK_SIGNATURE_BLOCK_LEN
+            else:
+                signature_len = 0
+
+        if msg_id in self.wanted_ids:
+            msg = super().decode(msgbuf)
+            self._on_frame(msgbuf, sys_id, comp_id, msg_id, seq)
+            return msg
+
+        msg_type = mavlink_map.get(msg_id)
+        if msg_type is not None:
+            # We still verify the CRC, so that corrupt frames are reported
+            # the same way regardless of if they're decoded or not.
+            crc_end = len(msgbuf) - 2 - signature_len
+            crc = msgbuf[crc_end] | (msgbuf[crc_end + 1] << 8)
+            crcbuf = msgbuf[1:crc_end]
+            crcbuf.append(msg_type.crc_extra)
+            if x25crc(crcbuf).crc != crc:
+                raise MAVError(f'invalid MAVLink CRC in msgID {msg_id}')
+
+        self._on_frame(msgbuf, sys_id, comp_id, msg_id, seq)
+
+        # parse_char only counts packets it returns, so do it for skipped ones
+        self.total_packets_received += 1
+        self.total_packets_skipped += 1
+        return None
+
+    def _on_frame(self, msgbuf: bytearray, sys_id: int, comp_id: int,
+                  msg_id: int, seq: int) -> None:
+        ''' Called for every valid frame, decoded or not. '''
+        if msgbuf[0] != PROTOCOL_MARKER_V1:
+            self._on_mavlink2_frame(msg_id, msgbuf[1])
+
+        key = (sys_id, comp_id)
+        last_seq = self._last_seq.get(key)
+        if last_seq is not None:
+            lost = (seq - last_seq - 1) & 0xFF
+            self.total_packets_lost += lost
+        else:
+            lost = 0
+        self._last_seq[key] = seq
+
+        if self.on_frame is not None:
+            self.on_frame(sys_id, comp_id, msg_id, len(msgbuf), lost)
+        if self.on_raw_frame is not None:
+            self.on_raw_frame(bytes(msgbuf))
+
+    def _on_mavlink2_frame(self, msg_id: int, payload_len: int) -> None:
+        if not self.use_mavlink2 and self.auto_mavlink2:
+            self.use_mavlink2 = True
+            if self.on_mavlink2 is not None:
+                self.on_mavlink2()
+
+        msg_type = mavlink_map.get(msg_id)
+        if msg_type is not None:
+            self._count_savings(msg_id, msg_type.unpacker.size, payload_len)
+
+    def _count_savings(self, msg_id: int, full_len: int, payload_len: int) -> None:
+        savings = self.mavlink2_savings.get(msg_id)
+        if savings is None:
+            savings = [0, 0]
+            self.mavlink2_savings[msg_id] = savings
+        savings[0] += 1
+        savings[1] += full_len - payload_len
+
+    def reset(self) -> None:
+        '''
+        Forgets all sequence numbers and goes back to MAVLink 1, eg when
+        reconnecting.
+        '''
+        self._last_seq.clear()
+        self.use_mavlink2 = False
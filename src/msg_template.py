@@ -0,0 +1,177 @@
+from pymavlink.dialects.v20 import common
+from pymavlink.dialects.v20.common import (MAVLink, MAVLink_message, x25crc,
+                                           PROTOCOL_MARKER_V1, PROTOCOL_MARKER_V2)
+from threading import Lock
+from typing import Dict, List, Sequence, Tuple
+import re
+import struct
+
+
+__all__ = ['MessageTemplate']
+
+
+_FORMAT_TOKEN = re.compile(r'(\d*)([a-zA-Z?])')
+_CRC = struct.Struct('<H')
+# The C implementation of the CRC that pymavlink uses, if fastcrc is installed
+_mcrf4xx = getattr(common, 'mcrf4xx', None)
+
+
+class _Frame:
+    '''
+    A prebuilt frame for one MAVLink version.
+
+    Without fastcrc, the CRC is updated from the CRC of the template instead
+    of being calculated in Python over the whole frame. The CRC is linear, so
+    for frames of the same length crc(a ^ b) == crc(a) ^ crc(b) ^ crc(0).
+    Changing a byte thus changes the CRC by a fixed amount per position and
+    xor of the byte, regardless of the other bytes, and these are kept in a
+    table per byte that may change.
+    '''
+
+    def __init__(self, mav: MAVLink, prototype: MAVLink_message,
+                 payload_struct: struct.Struct, values: list,
+                 variable: List[Tuple[int, int]], mavlink2: bool) -> None:
+        size = payload_struct.size
+        msg_id = prototype.id
+        if mavlink2:
+            header = bytes([PROTOCOL_MARKER_V2, size, 0, 0, 0,
+                            mav.srcSystem, mav.srcComponent,
+                            msg_id & 0xFF, (msg_id >> 8) & 0xFF, msg_id >> 16])
+            self.seq_offset = 4
+        else:
+            header = bytes([PROTOCOL_MARKER_V1, size, 0,
+                            mav.srcSystem, mav.srcComponent, msg_id])
+            self.seq_offset = 2
+        self.payload_offset = len(header)
+        self.crc_offset = len(header) + size
+        self.crc_extra = bytes([prototype.crc_extra])
+
+        self.buffer = bytearray(header + payload_struct.pack(*values) + b'\x00\x00')
+        # The part of the frame the CRC is calculated over, except crc_extra
+        self.crc_view = memoryview(self.buffer)[1:self.crc_offset]
+
+        self.base_crc = self._full_crc(self.buffer)
+        self.template = bytes(self.buffer)
+        # (position in buffer, template byte, CRC change per xor of the byte)
+        self.crc_tables: List[Tuple[int, int, List[int]]] = []
+        if _mcrf4xx is None:
+            positions = [self.seq_offset]
+            for offset, field_size in variable:
+                positions += range(self.payload_offset + offset,
+                                   self.payload_offset + offset + field_size)
+            zero_crc = self._full_crc(bytes(len(self.buffer)))
+            for position in positions:
+                table = [0] * 256
+                for bit in range(8):
+                    flipped = bytearray(len(self.buffer))
+                    flipped[position] = 1 << bit
+                    table[1 << bit] = self._full_crc(flipped) ^ zero_crc
+                for value in range(1, 256):
+                    low_bit = value & -value
+                    table[value] = table[value ^ low_bit] ^ table[low_bit]
+                self.crc_tables.append((position, self.template[position], table))
+
+    def _full_crc(self, frame: bytes) -> int:
+        return x25crc(bytes(frame[1:self.crc_offset]) + self.crc_extra).crc
+
+    def crc(self) -> int:
+        if _mcrf4xx is not None:
+            return _mcrf4xx(self.crc_extra, _mcrf4xx(self.crc_view, 0xFFFF))
+        buffer = self.buffer
+        crc = self.base_crc
+        for position, template, table in self.crc_tables:
+            crc ^= table[buffer[position] ^ template]
+        return crc
+
+
+class MessageTemplate:
+    '''
+    Fast encoder for a message that is sent often, with only a few fields
+    that change.
+
+    The frame is built once from `prototype`, and on every send only the
+    sequence number and the given `fields` are patched into it, with the
+    payload packed in one go. The same buffer is reused for every send, so
+    there are no allocations per message.
+
+    MAVLink 2 frames are sent without payload truncation, which receivers
+    handle the same way. Signed messages fall back to the regular encoder.
+    '''
+
+    def __init__(self,
+                 mav: MAVLink,
+                 prototype: MAVLink_message,
+                 fields: Sequence[str] = ()) -> None:
+        self._mav = mav
+        self._prototype = prototype
+        self.fields = list(fields)
+        # The sequence number is shared with everything else that is sent,
+        # so it's taken under the same lock, if the encoder has one.
+        self._lock = getattr(mav, 'send_lock', None) or Lock()
+
+        msg_type = type(prototype)
+        self._payload_struct = msg_type.unpacker
+        tokens = _FORMAT_TOKEN.findall(msg_type.unpacker.format[1:])
+
+        # Field values in payload order, with arrays other than char arrays
+        # flattened, as the payload struct takes them.
+        self._values = []
+        # (index in values, number of values, offset in payload, size) per field
+        layout = {}
+        offset = 0
+        for name, (count, code) in zip(msg_type.ordered_fieldnames, tokens):
+            size = struct.calcsize('<' + count + code)
+            value = getattr(prototype, name)
+            if code == 's':
+                values = [value.encode() if isinstance(value, str) else value]
+            elif count not in ('', '1'):
+                values = list(value)
+            else:
+                values = [value]
+            layout[name] = (len(self._values), len(values), offset, size)
+            self._values += values
+            offset += size
+
+        self._indices = [layout[name][:2] for name in self.fields]
+        self._variable = [layout[name][2:] for name in self.fields]
+        self._frames: Dict[bool, _Frame] = {}
+
+    def send(self, *values) -> None:
+        ''' Sends the message with the given values of `fields`, in order. '''
+        mav = self._mav
+        if mav.signing.sign_outgoing:
+            for name, value in zip(self.fields, values):
+                setattr(self._prototype, name, value)
+            mav.send(self._prototype)
+            return
+
+        mavlink2 = getattr(mav, 'use_mavlink2', False)
+        with self._lock:
+            frame = self._frames.get(mavlink2)
+            if frame is None:
+                frame = self._build(mavlink2)
+
+            fields = self._values
+            for (index, count), value in zip(self._indices, values):
+                if isinstance(value, str):
+                    value = value.encode()
+                if count == 1:
+                    fields[index] = value
+                else:
+                    fields[index:index + count] = value
+
+            buffer = frame.buffer
+            buffer[frame.seq_offset] = mav.seq
+            self._payload_struct.pack_into(buffer, frame.payload_offset, *fields)
+            _CRC.pack_into(buffer, frame.crc_offset, frame.crc())
+
+            mav.file.write(buffer)
+            mav.seq = (mav.seq + 1) % 256
+            mav.total_packets_sent += 1
+            mav.total_bytes_sent += len(buffer)
+
+    def _build(self, mavlink2: bool) -> _Frame:
+        frame = _Frame(self._mav, self._prototype, self._payload_struct,
+                       self._values, self._variable, mavlink2)
+        self._frames[mavlink2] = frame
+        return frame
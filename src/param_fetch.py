@@ -0,0 +1,197 @@
+from pymavlink.dialects.v20 import common
+from collections import deque
+from concurrent.futures import Future
+from dataclasses import dataclass, field
+from threading import Condition, Event
+from typing import Callable, Deque, Dict, Iterable, List, Set, Tuple
+import time
+import utils
+
+
+__all__ = ['ParameterFetcher']
+
+
+@dataclass
+class _Fetch:
+    future: Future
+    remaining: Set[str]
+    # name: (value, type)
+    results: Dict[str, Tuple[float, int]] = field(default_factory=dict)
+
+
+@dataclass
+class _Request:
+    deadline: float
+    attempts: int = 1
+
+
+class ParameterFetcher:
+    '''
+    Fetches single parameters by name with PARAM_REQUEST_READ, instead of
+    downloading the whole parameter table.
+
+    Requests are pipelined: up to `window` of them are in flight, and the
+    next one is sent as soon as one is answered, so that fetching N
+    parameters takes about N / window round trips. Fetches are batched: a
+    parameter that is already requested isn't requested again, however many
+    fetches wait for it. Any PARAM_VALUE of a parameter answers its request,
+    eg one from a full download. Requests that aren't answered in time are
+    retransmitted, and given up after `retries` retransmissions.
+
+    Future callbacks are called from the thread that receives the
+    PARAM_VALUE, so they shouldn't block.
+    '''
+
+    DEFAULT_TIMEOUT_S = 0.5
+    DEFAULT_RETRIES = 3
+    # Requests in flight at a time, large enough for the parameters of a
+    # page to be requested at once
+    WINDOW = 16
+
+    def __init__(self,
+                 send: Callable[[str], None],
+                 timeout: Callable[[], float] = None,
+                 retries: int = DEFAULT_RETRIES,
+                 window: int = WINDOW) -> None:
+        '''
+        send: Sends a PARAM_REQUEST_READ for the given parameter name
+        timeout: Returns the current timeout, eg based on the measured
+            round trip time. DEFAULT_TIMEOUT_S is used if not given.
+        '''
+        self._send = send
+        self._timeout = timeout
+        self.retries = retries
+        self.window = window
+        self._cond = Condition()
+        # Names not yet requested
+        self._queue: Deque[str] = deque()
+        self._in_flight: Dict[str, _Request] = {}
+        # Fetches waiting for each queued or requested name
+        self._waiting: Dict[str, List[_Fetch]] = {}
+        self.logger = utils.get_logger('params')
+
+    def fetch(self, names: Iterable[str]) -> Future:
+        '''
+        Fetches the given parameters. Returns a future of
+        {name: (value, type)}, which leaves out parameters the vehicle
+        didn't answer for, eg since it doesn't have them.
+        '''
+        fetch = _Fetch(Future(), set(names))
+        if not fetch.remaining:
+            fetch.future.set_result({})
+            return fetch.future
+
+        with self._cond:
+            for name in fetch.remaining:
+                waiting = self._waiting.get(name)
+                if waiting is None:
+                    waiting = self._waiting[name] = []
+                    self._queue.append(name)
+                waiting.append(fetch)
+            to_send = self._fill_window()
+            self._cond.notify()
+
+        for name in to_send:
+            self._send(name)
+        return fetch.future
+
+    def handle_message(self, msg: common.MAVLink_param_value_message) -> None:
+        ''' Message handler for PARAM_VALUE. '''
+        name = msg.param_id
+        if isinstance(name, bytes):
+            name = name.rstrip(b'\x00').decode('ascii', errors='replace')
+
+        with self._cond:
+            fetches = self._waiting.pop(name, None)
+            if fetches is None:
+                return
+            if self._in_flight.pop(name, None) is None:
+                # Answered before we got to request it
+                self._queue.remove(name)
+            completed = [fetch for fetch in fetches
+                         if self._answered(fetch, name, (msg.param_value, msg.param_type))]
+            to_send = self._fill_window()
+
+        for name_to_send in to_send:
+            self._send(name_to_send)
+        for fetch in completed:
+            # The caller may have cancelled the future meanwhile
+            utils.try_set(fetch.future.set_result, fetch.results)
+
+    def cancel_all(self) -> None:
+        ''' Fails all fetches, eg when the connection is closed. '''
+        with self._cond:
+            # Fetches still waiting aren't completed, since they're done
+            # when nothing is left to wait for.
+            fetches = {id(fetch): fetch for waiting in self._waiting.values() for fetch in waiting}
+            self._queue.clear()
+            self._in_flight.clear()
+            self._waiting.clear()
+            self._cond.notify()
+
+        for fetch in fetches.values():
+            utils.try_set(fetch.future.set_exception, ConnectionError('Connection closed'))
+
+    def run(self, stop_flag: Event) -> None:
+        ''' Retransmits requests that time out, until stop_flag is set. '''
+        while not stop_flag.is_set():
+            now = time.monotonic()
+            to_send: List[str] = []
+            given_up: List[str] = []
+            completed: List[_Fetch] = []
+
+            with self._cond:
+                for name, request in list(self._in_flight.items()):
+                    if request.deadline > now:
+                        continue
+                    if request.attempts <= self.retries:
+                        request.attempts += 1
+                        request.deadline = now + self._get_timeout()
+                        to_send.append(name)
+                    else:
+                        del self._in_flight[name]
+                        given_up.append(name)
+                        completed += [fetch for fetch in self._waiting.pop(name)
+                                      if self._answered(fetch, name, None)]
+                to_send += self._fill_window()
+
+                if not to_send and not given_up:
+                    # Wake up at the next deadline, a new fetch, or now and
+                    # then to check the stop flag.
+                    deadline = min((request.deadline for request in self._in_flight.values()),
+                                   default=now + 0.5)
+                    self._cond.wait(min(max(deadline - now, 0), 0.5))
+                    continue
+
+            for name in to_send:
+                self._send(name)
+            for name in given_up:
+                self.logger.warning(f'No answer for parameter {name}')
+            for fetch in completed:
+                utils.try_set(fetch.future.set_result, fetch.results)
+
+    def _fill_window(self) -> List[str]:
+        ''' Moves queued names in flight, returns the ones to send. Locked. '''
+        to_send = []
+        timeout_s = None
+        while self._queue and len(self._in_flight) < self.window:
+            if timeout_s is None:
+                timeout_s = self._get_timeout()
+            name = self._queue.popleft()
+            self._in_flight[name] = _Request(time.monotonic() + timeout_s)
+            to_send.append(name)
+        return to_send
+
+    def _get_timeout(self) -> float:
+        return self._timeout() if self._timeout is not None else self.DEFAULT_TIMEOUT_S
+
+    @staticmethod
+    def _answered(fetch: _Fetch, name: str, result: Tuple[float, int]) -> bool:
+        '''
+        Records the result of a parameter, None if there was no answer.
+        Returns True if the fetch is complete. Locked.
+        '''
+        if result is not None:
+            fetch.results[name] = result
+        fetch.remaining.discard(name)
+        return not fetch.remaining
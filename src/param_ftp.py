@@ -0,0 +1,396 @@
+'''
+Bulk download of the parameter table over MAVLink FTP.
+
+Instead of one PARAM_VALUE round trip per parameter, the vehicle serves all
+parameters as one packed file, `@PARAM/param.pck`, which is read with FTP
+burst reads, ie the vehicle streams the whole file after a single request.
+Lost chunks are read again one at a time afterwards.
+
+The packed format is the one used by ArduPilot: a header of
+(magic, num_params, total_params) as uint16, followed by one entry per
+parameter:
+
+    uint8 type:4, flags:4
+    uint8 common_len:4, name_len:4   (name_len is the length - 1)
+    name[name_len + 1]               (after common_len bytes of the previous name)
+    value                            (size given by the type)
+    default value                    (if flags has FLAG_DEFAULT)
+
+Zero bytes between entries are padding.
+
+SimulatedFtpResponder serves files the way a vehicle does, for testing
+without hardware.
+'''
+from pymavlink.dialects.v20 import common
+from queue import Queue, Empty
+from typing import Callable, Dict, Iterable, List, Tuple
+import random
+import struct
+import time
+import utils
+
+
+__all__ = ['FtpError', 'FtpUnsupported', 'ParamFtpClient', 'SimulatedFtpResponder',
+           'pack_params', 'unpack_params']
+
+
+PARAM_FILE = '@PARAM/param.pck'
+
+# Opcodes
+OP_NONE = 0
+OP_TERMINATE_SESSION = 1
+OP_RESET_SESSIONS = 2
+OP_OPEN_FILE_RO = 4
+OP_READ_FILE = 5
+OP_BURST_READ_FILE = 15
+OP_ACK = 128
+OP_NAK = 129
+
+# NAK error codes
+ERR_FAIL = 1
+ERR_INVALID_SESSION = 4
+ERR_EOF = 6
+ERR_UNKNOWN_COMMAND = 7
+ERR_FILE_NOT_FOUND = 10
+
+# seq, session, opcode, size, req_opcode, burst_complete, padding, offset
+_HEADER = struct.Struct('<HBBBBBBI')
+PAYLOAD_LEN = 251
+MAX_DATA_LEN = PAYLOAD_LEN - _HEADER.size
+
+PCK_MAGIC = 0x671b
+PCK_MAGIC_WITH_DEFAULTS = 0x671c
+PCK_FLAG_DEFAULT = 1
+
+# Packed type: (struct format, MAV_PARAM_TYPE)
+_PCK_TYPES = {
+    1: ('<b', common.MAV_PARAM_TYPE_INT8),
+    2: ('<h', common.MAV_PARAM_TYPE_INT16),
+    3: ('<i', common.MAV_PARAM_TYPE_INT32),
+    4: ('<f', common.MAV_PARAM_TYPE_REAL32),
+}
+_PCK_TYPE_BY_PARAM_TYPE = {param_type: pck_type for pck_type, (_, param_type) in _PCK_TYPES.items()}
+
+
+class FtpError(Exception):
+    pass
+
+
+class FtpUnsupported(FtpError):
+    ''' The vehicle doesn't support FTP, or doesn't have the file. '''
+    pass
+
+
+def encode_payload(seq: int, session: int, opcode: int, offset: int = 0,
+                   data: bytes = b'', size: int = None, req_opcode: int = 0,
+                   burst_complete: bool = False) -> List[int]:
+    if size is None:
+        size = len(data)
+    payload = _HEADER.pack(seq, session, opcode, size, req_opcode,
+                           burst_complete, 0, offset) + data
+    return list(payload.ljust(PAYLOAD_LEN, b'\x00'))
+
+
+def decode_payload(payload: Iterable[int]) -> Tuple[int, int, int, int, int, bool, int, bytes]:
+    '''
+    Returns (seq, session, opcode, size, req_opcode, burst_complete, offset,
+    data).
+    '''
+    payload = bytes(payload)
+    seq, session, opcode, size, req_opcode, burst_complete, _, offset = \
+        _HEADER.unpack_from(payload)
+    data = payload[_HEADER.size:_HEADER.size + size]
+    return seq, session, opcode, size, req_opcode, bool(burst_complete), offset, data
+
+
+def unpack_params(data: bytes) -> List[Tuple[str, float, int]]:
+    ''' Parses a param.pck file, returns (name, value, MAV_PARAM_TYPE) per param. '''
+    if len(data) < 6:
+        raise FtpError('Parameter file too short')
+    magic, num_params, _ = struct.unpack_from('<HHH', data)
+    if magic not in (PCK_MAGIC, PCK_MAGIC_WITH_DEFAULTS):
+        raise FtpError(f'Bad parameter file magic 0x{magic:04x}')
+
+    params = []
+    name = b''
+    i = 6
+    while len(params) < num_params and i < len(data):
+        type_flags = data[i]
+        if type_flags == 0:
+            # Padding
+            i += 1
+            continue
+        pck_type = type_flags & 0x0F
+        flags = type_flags >> 4
+        if pck_type not in _PCK_TYPES:
+            raise FtpError(f'Unknown parameter type {pck_type}')
+        fmt, param_type = _PCK_TYPES[pck_type]
+
+        try:
+            common_len = data[i + 1] & 0x0F
+            name_len = (data[i + 1] >> 4) + 1
+            i += 2
+            name = name[:common_len] + data[i:i + name_len]
+            i += name_len
+            value, = struct.unpack_from(fmt, data, i)
+        except (IndexError, struct.error) as e:
+            raise FtpError(f'Parameter file truncated in param {len(params)}: {e}') from e
+        i += struct.calcsize(fmt)
+        if flags & PCK_FLAG_DEFAULT:
+            i += struct.calcsize(fmt)
+
+        params.append((name.decode('ascii', errors='replace'), float(value), param_type))
+
+    if len(params) != num_params:
+        raise FtpError(f'Parameter file truncated, got {len(params)} of {num_params} params')
+    return params
+
+
+def pack_params(params: Iterable[Tuple[str, float, int]]) -> bytes:
+    ''' Creates a param.pck file, eg for SimulatedFtpResponder. '''
+    params = sorted(params)
+    entries = []
+    previous = b''
+    for name, value, param_type in params:
+        name = name.encode('ascii')
+        pck_type = _PCK_TYPE_BY_PARAM_TYPE[param_type]
+        fmt, _ = _PCK_TYPES[pck_type]
+        common_len = 0
+        while (common_len < min(len(name) - 1, len(previous), 15)
+               and name[common_len] == previous[common_len]):
+            common_len += 1
+        suffix = name[common_len:]
+        if not 1 <= len(suffix) <= 16:
+            raise ValueError(f'Parameter name too long: {name}')
+        if pck_type != 4:
+            value = int(value)
+        entries.append(bytes([pck_type, common_len | ((len(suffix) - 1) << 4)])
+                       + suffix + struct.pack(fmt, value))
+        previous = name
+    return struct.pack('<HHH', PCK_MAGIC, len(params), len(params)) + b''.join(entries)
+
+
+class ParamFtpClient:
+    '''
+    Reads files over MAVLink FTP. `handle_message` must be registered as a
+    handler of FILE_TRANSFER_PROTOCOL, and `send` sends a payload to the
+    vehicle. Downloads block the calling thread.
+    '''
+
+    DEFAULT_TIMEOUT_S = 0.5
+
+    def __init__(self,
+                 send: Callable[[List[int]], None],
+                 timeout_s: float = DEFAULT_TIMEOUT_S,
+                 retries: int = 3) -> None:
+        self._send_payload = send
+        self.timeout_s = timeout_s
+        self.retries = retries
+        self._responses: Queue = Queue()
+        self._seq = 0
+        self.logger = utils.get_logger('ftp')
+
+    def handle_message(self, msg: common.MAVLink_file_transfer_protocol_message) -> None:
+        self._responses.put(decode_payload(msg.payload))
+
+    def get_parameters(self) -> List[Tuple[str, float, int]]:
+        ''' Downloads all parameters, as (name, value, MAV_PARAM_TYPE). '''
+        return unpack_params(self.download(PARAM_FILE))
+
+    def download(self, path: str) -> bytes:
+        session, size = self._open(path)
+        try:
+            chunks = self._burst_read(session, size)
+        finally:
+            self._send(session, OP_TERMINATE_SESSION)
+        return b''.join(chunks[offset] for offset in sorted(chunks))
+
+    def _send(self, session: int, opcode: int, offset: int = 0,
+              data: bytes = b'', size: int = None) -> int:
+        self._seq = (self._seq + 1) & 0xFFFF
+        self._send_payload(encode_payload(self._seq, session, opcode, offset, data, size))
+        return self._seq
+
+    def _request(self, session: int, opcode: int, **kwargs) -> Tuple:
+        '''
+        Sends a request and returns its response, retrying on timeout. A late
+        response to an earlier attempt is as good as one to the last.
+        '''
+        self._flush()
+        expected = set()
+        for _ in range(self.retries + 1):
+            seq = self._send(session, opcode, **kwargs)
+            expected.add((seq + 1) & 0xFFFF)
+            deadline = time.monotonic() + self.timeout_s
+            while True:
+                response = self._receive(deadline)
+                if response is None:
+                    break
+                if response[4] == opcode and response[0] in expected:
+                    return response
+        # Says nothing about whether the vehicle supports FTP, eg it's busy
+        raise FtpError(f'No response to FTP opcode {opcode}')
+
+    def _receive(self, deadline: float) -> Tuple:
+        try:
+            return self._responses.get(timeout=max(deadline - time.monotonic(), 0))
+        except Empty:
+            return None
+
+    def _flush(self) -> None:
+        while not self._responses.empty():
+            self._responses.get_nowait()
+
+    def _open(self, path: str) -> Tuple[int, int]:
+        ''' Returns (session, file size), size is None if not reported. '''
+        _, session, opcode, _, _, _, _, data = self._request(
+            0, OP_OPEN_FILE_RO, data=path.encode('ascii'))
+        if opcode == OP_NAK:
+            if data and data[0] in (ERR_UNKNOWN_COMMAND, ERR_FILE_NOT_FOUND):
+                raise FtpUnsupported(f'Vehicle has no {path}')
+            raise FtpError(f'Failed to open {path}: error {data[:1].hex()}')
+        size = struct.unpack('<I', data[:4])[0] if len(data) >= 4 else None
+        return session, size
+
+    def _burst_read(self, session: int, size: int) -> Dict[int, bytes]:
+        '''
+        Reads the whole file with burst reads, and then reads lost chunks
+        one at a time. Returns the chunks by offset.
+        '''
+        chunks: Dict[int, bytes] = {}
+        eof = size
+        attempts = 0
+
+        while True:
+            missing = self._missing(chunks, eof)
+            if not missing:
+                return chunks
+            if attempts > self.retries:
+                raise FtpError(f'FTP download failed, {len(missing)} chunks missing')
+
+            offset, length = missing[0]
+            if length is None:
+                # Read the rest of the file in a burst
+                self._flush()
+                self._send(session, OP_BURST_READ_FILE, offset, size=MAX_DATA_LEN)
+                progress, eof = self._receive_burst(session, chunks, eof)
+            else:
+                # Fill in a gap left by a lost burst packet
+                _, _, opcode, _, _, _, _, data = self._request(
+                    session, OP_READ_FILE, offset=offset, size=min(length, MAX_DATA_LEN))
+                progress = opcode == OP_ACK and bool(data)
+                if progress:
+                    chunks[offset] = data
+            attempts = 0 if progress else attempts + 1
+
+    def _receive_burst(self, session: int, chunks: Dict[int, bytes], eof: int) -> Tuple[bool, int]:
+        ''' Returns (whether anything was received, end of file if known). '''
+        progress = False
+        deadline = time.monotonic() + self.timeout_s
+        while True:
+            response = self._receive(deadline)
+            if response is None:
+                return progress, eof
+            _, resp_session, opcode, _, req_opcode, burst_complete, offset, data = response
+            if req_opcode != OP_BURST_READ_FILE or resp_session != session:
+                continue
+            deadline = time.monotonic() + self.timeout_s
+
+            if opcode == OP_NAK:
+                if data and data[0] == ERR_EOF:
+                    if eof is None:
+                        eof = self._contiguous_end(chunks)
+                    return True, eof
+                raise FtpError(f'FTP burst read failed: error {data[:1].hex()}')
+
+            if data and offset not in chunks:
+                chunks[offset] = data
+                progress = True
+            if burst_complete:
+                return progress, eof
+
+    @staticmethod
+    def _contiguous_end(chunks: Dict[int, bytes]) -> int:
+        end = 0
+        for offset in sorted(chunks):
+            if offset > end:
+                break
+            end = max(end, offset + len(chunks[offset]))
+        return end
+
+    @staticmethod
+    def _missing(chunks: Dict[int, bytes], eof: int) -> List[Tuple[int, int]]:
+        '''
+        Returns the missing ranges as (offset, length), where the length is
+        None for the open-ended range at the end of the file.
+        '''
+        missing = []
+        end = 0
+        for offset in sorted(chunks):
+            if offset > end:
+                missing.append((end, offset - end))
+            end = max(end, offset + len(chunks[offset]))
+        if eof is None or end < eof:
+            missing.append((end, None))
+        return missing
+
+
+class SimulatedFtpResponder:
+    '''
+    Serves files like a vehicle's FTP server does, for testing without
+    hardware. Responses to bursts can be dropped at random, to exercise
+    recovery of lost chunks.
+    '''
+
+    def __init__(self, files: Dict[str, bytes], drop_rate: float = 0) -> None:
+        self.files = files
+        self.drop_rate = drop_rate
+        self._sessions: Dict[int, bytes] = {}
+        self._next_session = 0
+
+    def handle(self, payload: Iterable[int]) -> List[List[int]]:
+        ''' Returns the response payloads to a request payload. '''
+        seq, session, opcode, size, _, _, offset, data = decode_payload(payload)
+
+        def ack(data: bytes = b'', **kwargs) -> List[int]:
+            nonlocal seq
+            seq = (seq + 1) & 0xFFFF
+            return encode_payload(seq, session, OP_ACK, data=data, req_opcode=opcode, **kwargs)
+
+        def nak(error: int, **kwargs) -> List[List[int]]:
+            return [encode_payload((seq + 1) & 0xFFFF, session, OP_NAK, data=bytes([error]),
+                                   req_opcode=opcode, **kwargs)]
+
+        if opcode == OP_OPEN_FILE_RO:
+            path = data.decode('ascii', errors='replace')
+            if path not in self.files:
+                return nak(ERR_FILE_NOT_FOUND)
+            session = self._next_session
+            self._next_session = (self._next_session + 1) & 0xFF
+            self._sessions[session] = self.files[path]
+            return [ack(struct.pack('<I', len(self.files[path])))]
+
+        if opcode in (OP_TERMINATE_SESSION, OP_RESET_SESSIONS):
+            self._sessions.pop(session, None)
+            return [ack()]
+
+        if opcode not in (OP_READ_FILE, OP_BURST_READ_FILE):
+            return nak(ERR_UNKNOWN_COMMAND)
+
+        file = self._sessions.get(session)
+        if file is None:
+            return nak(ERR_INVALID_SESSION)
+        if offset >= len(file):
+            return nak(ERR_EOF)
+
+        if opcode == OP_READ_FILE:
+            return [ack(file[offset:offset + size], offset=offset)]
+
+        responses = []
+        for chunk_offset in range(offset, len(file), MAX_DATA_LEN):
+            last = chunk_offset + MAX_DATA_LEN >= len(file)
+            response = ack(file[chunk_offset:chunk_offset + MAX_DATA_LEN],
+                           offset=chunk_offset, burst_complete=last)
+            if random.random() >= self.drop_rate:
+                responses.append(response)
+        return responses
@@ -0,0 +1,166 @@
+from pymavlink.dialects.v20 import common
+from array import array
+from threading import Lock
+from typing import Callable, Dict, List, Tuple, Union
+
+
+__all__ = ['ParameterStore']
+
+
+# Index used by the vehicle when a PARAM_VALUE isn't part of a list response
+PARAM_INDEX_UNKNOWN = 65535
+
+ParameterObserver = Callable[[str, float, int], None]
+
+
+class ParameterStore:
+    '''
+    Current values of all parameters we know of on the vehicle.
+
+    Parameters are stored compactly as arrays of value, type and version,
+    with O(1) lookup both by name and by parameter index. The store is
+    updated incrementally from every PARAM_VALUE message, and observers are
+    called for each individual parameter that changes, as it changes.
+
+    Parameter names are always `str`, even though pymavlink wants `bytes`
+    when sending.
+    '''
+
+    def __init__(self) -> None:
+        self._lock = Lock()
+        self._names: List[str] = []
+        self._values = array('d')
+        self._types = array('B')
+        self._versions = array('L')
+        self._slot_by_name: Dict[str, int] = {}
+        self._slot_by_index: Dict[int, int] = {}
+        self._observers: Dict[str, List[ParameterObserver]] = {}
+        self._global_observers: List[ParameterObserver] = []
+
+        # Number of parameters the vehicle says it has
+        self.param_count = 0
+
+    def update(self, msg: common.MAVLink_param_value_message) -> None:
+        name = self._to_name(msg.param_id)
+        value = msg.param_value
+        type = msg.param_type
+
+        with self._lock:
+            self.param_count = msg.param_count
+            slot = self._slot_by_name.get(name)
+            if slot is None:
+                slot = len(self._names)
+                self._names.append(name)
+                self._values.append(value)
+                self._types.append(type)
+                self._versions.append(1)
+                self._slot_by_name[name] = slot
+                changed = True
+            else:
+                changed = (self._values[slot] != value or
+                           self._types[slot] != type)
+                if changed:
+                    self._values[slot] = value
+                    self._types[slot] = type
+                    self._versions[slot] += 1
+
+            if msg.param_index != PARAM_INDEX_UNKNOWN:
+                self._slot_by_index[msg.param_index] = slot
+
+            if changed:
+                observers = self._observers.get(name, []) + self._global_observers
+
+        if changed:
+            for observer in observers:
+                observer(name, value, type)
+
+    def get(self, name: Union[str, bytes], default: float = None) -> float:
+        name = self._to_name(name)
+        with self._lock:
+            slot = self._slot_by_name.get(name)
+            if slot is None:
+                return default
+            return self._values[slot]
+
+    def get_type(self, name: Union[str, bytes], default: int = None) -> int:
+        name = self._to_name(name)
+        with self._lock:
+            slot = self._slot_by_name.get(name)
+            if slot is None:
+                return default
+            return self._types[slot]
+
+    def get_version(self, name: Union[str, bytes]) -> int:
+        '''
+        Returns how many times the parameter has changed since we first saw
+        it, starting at 1. Returns 0 if the parameter is unknown.
+        '''
+        name = self._to_name(name)
+        with self._lock:
+            slot = self._slot_by_name.get(name)
+            if slot is None:
+                return 0
+            return self._versions[slot]
+
+    def get_by_index(self, index: int) -> Tuple[str, float, int]:
+        ''' Returns (name, value, type) of the parameter at the given index. '''
+        with self._lock:
+            slot = self._slot_by_index.get(index)
+            if slot is None:
+                return None
+            return self._names[slot], self._values[slot], self._types[slot]
+
+    def names(self) -> List[str]:
+        with self._lock:
+            return list(self._names)
+
+    def is_complete(self) -> bool:
+        ''' Returns True if we've received every parameter of the vehicle. '''
+        return self.param_count > 0 and len(self._slot_by_index) >= self.param_count
+
+    def as_dict(self) -> Dict[str, Tuple[float, int]]:
+        ''' Returns a copy of all parameters, as {name: (value, type)}. '''
+        with self._lock:
+            return {name: (self._values[slot], self._types[slot])
+                    for name, slot in self._slot_by_name.items()}
+
+    def add_observer(self, callback: ParameterObserver, name: str = None) -> None:
+        '''
+        Adds an observer that is called with (name, value, type) whenever
+        the given parameter changes. If no name is given, the observer is
+        called for changes of any parameter.
+        '''
+        with self._lock:
+            if name is None:
+                self._global_observers.append(callback)
+            else:
+                self._observers.setdefault(name, []).append(callback)
+
+    def del_observer(self, callback: ParameterObserver, name: str = None) -> None:
+        with self._lock:
+            if name is None:
+                self._global_observers.remove(callback)
+            else:
+                self._observers.get(name, []).remove(callback)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._names.clear()
+            self._values = array('d')
+            self._types = array('B')
+            self._versions = array('L')
+            self._slot_by_name.clear()
+            self._slot_by_index.clear()
+            self.param_count = 0
+
+    def __contains__(self, name: Union[str, bytes]) -> bool:
+        return self._to_name(name) in self._slot_by_name
+
+    def __len__(self) -> int:
+        return len(self._names)
+
+    @staticmethod
+    def _to_name(name: Union[str, bytes]) -> str:
+        if isinstance(name, bytes):
+            return name.rstrip(b'\x00').decode('ascii', errors='replace')
+        return name
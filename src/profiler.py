@@ -0,0 +1,187 @@
+'''
+Built-in, opt-in profiling, for finding hot spots in field sessions without
+attaching external tools.
+
+The profiler samples the stacks of all threads at a low rate, and also
+accounts the time spent in each MAVLink message handler and each Tk
+callback. Enable it by setting the environment variable ASAC_PROFILE=1, or
+with the toggle in the GUI. `dump` writes the samples as folded stacks, one
+line per stack with its sample count, which flamegraph.pl, speedscope and
+similar tools can read. The handler and Tk timings are written next to it.
+'''
+from collections import defaultdict
+from pathlib import Path
+from threading import Lock, Thread, Event
+from typing import Dict, List
+import os
+import signal
+import sys
+import threading
+import time
+import utils
+
+
+__all__ = ['Profiler', 'get_profiler']
+
+
+ENV_ENABLE = 'ASAC_PROFILE'
+ENV_DIR = 'ASAC_PROFILE_DIR'
+
+MAX_STACK_DEPTH = 64
+
+
+class Profiler:
+
+    def __init__(self, interval_s: float = 0.01) -> None:
+        self.interval_s = interval_s
+        self.running = False
+        self._stop_flag = Event()
+        self._thread: Thread = None
+        self._lock = Lock()
+        self._stacks: Dict[str, int] = defaultdict(int)
+        # category: {name: [calls, total time, max time]}
+        self._calls: Dict[str, Dict[str, List[float]]] = defaultdict(dict)
+        self._labels: Dict[object, str] = {}
+
+    def start(self) -> None:
+        if self.running:
+            return
+        self.running = True
+        self._stop_flag.clear()
+        self._thread = Thread(target=self._sample_thread, name='profiler', daemon=True)
+        self._thread.start()
+        utils.get_logger('profiler').info('Profiling started')
+
+    def stop(self) -> None:
+        if not self.running:
+            return
+        self.running = False
+        self._stop_flag.set()
+        utils.get_logger('profiler').info('Profiling stopped')
+
+    def reset(self) -> None:
+        with self._lock:
+            self._stacks.clear()
+            self._calls.clear()
+
+    def record_call(self, category: str, name: str, duration_s: float) -> None:
+        ''' Accounts a call of eg a message handler or a Tk callback. '''
+        with self._lock:
+            stats = self._calls[category].get(name)
+            if stats is None:
+                self._calls[category][name] = [1, duration_s, duration_s]
+            else:
+                stats[0] += 1
+                stats[1] += duration_s
+                if duration_s > stats[2]:
+                    stats[2] = duration_s
+
+    def dump(self, path: Path = None) -> Path:
+        '''
+        Writes the stack samples as folded stacks to the given path, and the
+        call timings to the same path with a .calls.txt suffix. Returns the
+        path of the folded stacks.
+        '''
+        if path is None:
+            directory = Path(os.environ.get(ENV_DIR, '.'))
+            path = directory.joinpath(time.strftime('asac_profile_%Y%m%d_%H%M%S.folded'))
+        path = Path(path)
+
+        with self._lock:
+            stacks = sorted(self._stacks.items(), key=lambda item: -item[1])
+            calls = {category: dict(names) for category, names in self._calls.items()}
+
+        with open(path, 'w') as f:
+            for stack, count in stacks:
+                f.write(f'{stack} {count}\n')
+
+        with open(path.with_suffix('.calls.txt'), 'w') as f:
+            for category, names in sorted(calls.items()):
+                f.write(f'{category}:\n')
+                f.write(f'    {"total ms":>10} {"calls":>8} {"avg ms":>8} {"max ms":>8}  name\n')
+                ordered = sorted(names.items(), key=lambda item: -item[1][1])
+                for name, (count, total, max_) in ordered:
+                    f.write(f'    {total*1000:10.1f} {count:8d} {total/count*1000:8.3f} {max_*1000:8.3f}  {name}\n')
+                f.write('\n')
+
+        utils.get_logger('profiler').info(f'Wrote profile to {path}')
+        return path
+
+    def _label(self, code) -> str:
+        label = self._labels.get(code)
+        if label is None:
+            filename = os.path.basename(code.co_filename)
+            label = f'{code.co_name} ({filename}:{code.co_firstlineno})'
+            self._labels[code] = label
+        return label
+
+    def _sample_thread(self) -> None:
+        own_ident = threading.get_ident()
+        while not self._stop_flag.wait(self.interval_s):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            samples: List[str] = []
+            for ident, frame in sys._current_frames().items():
+                if ident == own_ident:
+                    continue
+                stack = []
+                while frame is not None and len(stack) < MAX_STACK_DEPTH:
+                    stack.append(self._label(frame.f_code))
+                    frame = frame.f_back
+                stack.append(names.get(ident, str(ident)))
+                stack.reverse()
+                samples.append(';'.join(stack))
+
+            with self._lock:
+                for stack in samples:
+                    self._stacks[stack] += 1
+
+
+_profiler: Profiler = None
+
+
+def get_profiler() -> Profiler:
+    ''' Returns the profiler, started if enabled by the environment. '''
+    global _profiler
+    if _profiler is None:
+        _profiler = Profiler()
+        if os.environ.get(ENV_ENABLE, '') not in ('', '0'):
+            _profiler.start()
+    return _profiler
+
+
+def install_tk_hooks() -> None:
+    ''' Accounts the time of every Tk callback, while profiling. '''
+    import tkinter
+
+    profiler = get_profiler()
+    call = tkinter.CallWrapper.__call__
+
+    def timed_call(self, *args):
+        if not profiler.running:
+            return call(self, *args)
+        t0 = time.perf_counter()
+        try:
+            return call(self, *args)
+        finally:
+            name = getattr(self.func, '__qualname__', repr(self.func))
+            profiler.record_call('tk', name, time.perf_counter() - t0)
+
+    tkinter.CallWrapper.__call__ = timed_call
+
+
+def install_signal_handler() -> None:
+    '''
+    Dumps the profile on SIGUSR1, for headless use. Profiling is started by
+    the first signal if it isn't already running.
+    '''
+    if not hasattr(signal, 'SIGUSR1'):
+        return
+
+    def on_signal(*_) -> None:
+        profiler = get_profiler()
+        if profiler.running:
+            profiler.dump()
+        else:
+            profiler.start()
+
+    signal.signal(signal.SIGUSR1, on_signal)
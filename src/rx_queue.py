@@ -0,0 +1,107 @@
+from pymavlink.dialects.v20.common import MAVLink_message
+from collections import deque
+from queue import Empty
+from threading import Condition
+from typing import Deque, Dict, Iterable, Union
+import time
+
+
+__all__ = ['RxQueue']
+
+
+class RxQueue:
+    '''
+    Bounded queue of received messages, between the RX thread and the
+    dispatch thread. Has the same get/put interface as queue.Queue.
+
+    Messages of the conflated types are state, where only the newest value
+    matters, so only the newest message of each such type is kept. They keep
+    their place in the queue, so a burst of them doesn't delay others.
+
+    When the queue is full, the oldest message that isn't critical is
+    dropped. Critical messages (eg parameters and command acks) are never
+    dropped, and may make the queue grow past its size if nothing else can
+    be dropped.
+    '''
+
+    def __init__(self,
+                 maxsize: int,
+                 conflated_types: Iterable[type] = (),
+                 critical_types: Iterable[type] = ()) -> None:
+        self.maxsize = maxsize
+        self._conflated_types = frozenset(conflated_types)
+        self._critical_types = frozenset(critical_types)
+        # Items are either messages, or for conflated messages, their type,
+        # in which case the message is found in _latest.
+        self._items: Deque[Union[MAVLink_message, type]] = deque()
+        self._latest: Dict[type, MAVLink_message] = {}
+        self._cond = Condition()
+
+        self.dropped = 0
+        self.conflated = 0
+
+    def put(self, msg: MAVLink_message) -> None:
+        msg_type = type(msg)
+        with self._cond:
+            if msg_type in self._conflated_types:
+                if msg_type in self._latest:
+                    self._latest[msg_type] = msg
+                    self.conflated += 1
+                    return
+                item = msg_type
+                self._latest[msg_type] = msg
+            else:
+                item = msg
+
+            if len(self._items) >= self.maxsize and not self._drop_oldest():
+                if msg_type not in self._critical_types:
+                    # Nothing older can be dropped, so drop this one instead
+                    if item is msg_type:
+                        del self._latest[msg_type]
+                    self.dropped += 1
+                    return
+
+            self._items.append(item)
+            self._cond.notify()
+
+    def get(self, block: bool = True, timeout: float = None) -> MAVLink_message:
+        with self._cond:
+            if block:
+                deadline = None if timeout is None else time.monotonic() + timeout
+                while not self._items:
+                    remaining = None if deadline is None else deadline - time.monotonic()
+                    if remaining is not None and remaining <= 0:
+                        raise Empty
+                    self._cond.wait(remaining)
+            elif not self._items:
+                raise Empty
+
+            item = self._items.popleft()
+            if isinstance(item, type):
+                return self._latest.pop(item)
+            return item
+
+    def qsize(self) -> int:
+        return len(self._items)
+
+    def empty(self) -> bool:
+        return not self._items
+
+    def clear(self) -> None:
+        with self._cond:
+            self._items.clear()
+            self._latest.clear()
+
+    def _drop_oldest(self) -> bool:
+        ''' Drops the oldest non-critical item, returns False if there's none. '''
+        for i, item in enumerate(self._items):
+            if isinstance(item, type):
+                del self._items[i]
+                del self._latest[item]
+            elif type(item) not in self._critical_types:
+                del self._items[i]
+            else:
+                continue
+            self.dropped += 1
+            return True
+        return False
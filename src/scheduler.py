@@ -0,0 +1,179 @@
+from concurrent.futures import Future, ThreadPoolExecutor
+from collections import deque
+from threading import Condition, Lock, Thread
+from typing import Callable, Deque, List, Tuple
+import heapq
+import itertools
+import time
+import utils
+
+
+__all__ = ['Scheduler', 'TimerHandle', 'TkExecutor', 'get_scheduler']
+
+
+class TimerHandle:
+    ''' A scheduled call, which can be cancelled until it has run. '''
+
+    def __init__(self, function: Callable, args: tuple, interval_s: float = None) -> None:
+        self.function = function
+        self.args = args
+        # Repeating timers are rescheduled after each call
+        self.interval_s = interval_s
+        self.cancelled = False
+
+    def cancel(self) -> None:
+        self.cancelled = True
+
+
+class Scheduler:
+    '''
+    Shared worker pool and timers, instead of a thread per task.
+
+    Work is run in a bounded pool of threads, and may block, eg waiting
+    for the vehicle. Timers are kept in a heap, served by one thread that
+    sleeps until the next deadline, so there are no wakeups when nothing is
+    due. Timer callbacks are run in a pool of their own, so that heartbeats
+    and timeouts keep going however much work blocks, and must not block
+    for long, since they share it with all other timers.
+    '''
+
+    def __init__(self, max_workers: int = 4, timer_workers: int = 2) -> None:
+        self._pool = ThreadPoolExecutor(max_workers=max_workers,
+                                        thread_name_prefix='scheduler')
+        self._timer_pool = ThreadPoolExecutor(max_workers=timer_workers,
+                                              thread_name_prefix='scheduler-timer')
+        self._timers: List[Tuple[float, int, TimerHandle]] = []
+        self._counter = itertools.count()
+        self._cond = Condition()
+        self._thread: Thread = None
+        self._shutdown = False
+
+    def submit(self, function: Callable, *args, **kwargs) -> Future:
+        ''' Runs the function in the pool. '''
+        return self._pool.submit(self._run, function, *args, **kwargs)
+
+    def call_later(self, delay_s: float, function: Callable, *args) -> TimerHandle:
+        ''' Runs the function in the timer pool after the delay. '''
+        handle = TimerHandle(function, args)
+        self._schedule(time.monotonic() + delay_s, handle)
+        return handle
+
+    def call_every(self, interval_s: float, function: Callable, *args) -> TimerHandle:
+        '''
+        Runs the function in the timer pool every interval, starting now,
+        until cancelled. A call is never started before the previous one is
+        done.
+        '''
+        handle = TimerHandle(function, args, interval_s)
+        self._schedule(time.monotonic(), handle)
+        return handle
+
+    def shutdown(self) -> None:
+        '''
+        Cancels all timers and queued work, and stops the timer thread. Work
+        that is already running is left to finish on its own.
+        '''
+        with self._cond:
+            self._shutdown = True
+            for _, _, handle in self._timers:
+                handle.cancel()
+            self._timers.clear()
+            self._cond.notify()
+        self._pool.shutdown(wait=False, cancel_futures=True)
+        self._timer_pool.shutdown(wait=False, cancel_futures=True)
+
+    def _schedule(self, deadline: float, handle: TimerHandle) -> None:
+        with self._cond:
+            if self._shutdown:
+                handle.cancel()
+                return
+            heapq.heappush(self._timers, (deadline, next(self._counter), handle))
+            if self._thread is None:
+                self._thread = Thread(target=self._timer_thread, name='scheduler-timers',
+                                      daemon=True)
+                self._thread.start()
+            self._cond.notify()
+
+    def _timer_thread(self) -> None:
+        while True:
+            with self._cond:
+                while not self._shutdown:
+                    if not self._timers:
+                        self._cond.wait()
+                        continue
+                    timeout = self._timers[0][0] - time.monotonic()
+                    if timeout <= 0:
+                        break
+                    self._cond.wait(timeout)
+                if self._shutdown:
+                    return
+                _, _, handle = heapq.heappop(self._timers)
+
+            if handle.cancelled:
+                continue
+            try:
+                self._timer_pool.submit(self._run_timer, handle)
+            except RuntimeError:
+                # The pool is shut down
+                return
+
+    def _run_timer(self, handle: TimerHandle) -> None:
+        if handle.cancelled:
+            return
+        try:
+            self._run(handle.function, *handle.args)
+        except Exception:
+            # Already logged, and a repeating timer keeps going
+            pass
+        if handle.interval_s is not None and not handle.cancelled:
+            self._schedule(time.monotonic() + handle.interval_s, handle)
+
+    @staticmethod
+    def _run(function: Callable, *args, **kwargs):
+        try:
+            return function(*args, **kwargs)
+        except Exception:
+            # Nobody might be looking at the future, so always log
+            utils.get_logger('scheduler').exception(f'Exception in scheduled call {function}')
+            raise
+
+
+class TkExecutor:
+    '''
+    Runs calls on the Tk thread, for UI callbacks from other threads. Calls
+    are queued and run in order, in one Tk callback per batch.
+    '''
+
+    def __init__(self, root: 'tk.Misc') -> None:
+        self._root = root
+        self._calls: Deque[Tuple[Callable, tuple]] = deque()
+        self._lock = Lock()
+        self._scheduled = False
+
+    def call(self, function: Callable, *args) -> None:
+        with self._lock:
+            self._calls.append((function, args))
+            if self._scheduled:
+                return
+            self._scheduled = True
+        self._root.after(0, self._drain)
+
+    def _drain(self) -> None:
+        with self._lock:
+            calls = list(self._calls)
+            self._calls.clear()
+            self._scheduled = False
+        for function, args in calls:
+            function(*args)
+
+
+_scheduler: Scheduler = None
+_scheduler_lock = Lock()
+
+
+def get_scheduler() -> Scheduler:
+    global _scheduler
+    with _scheduler_lock:
+        if _scheduler is None:
+            _scheduler = Scheduler()
+        return _scheduler
@@ -0,0 +1,296 @@
+'''
+Live telemetry in shared memory, for local processes that want the latest
+vehicle state at full rate without sockets or serialization.
+
+The writer copies the raw payload of each received message into a fixed
+slot per message type, which is about as cheap as handling a message can
+be. Each slot holds a ring of the last `history` records, the newest being
+the latest state. Readers map the same memory, so they cost the ASAC
+process nothing, however many there are and however often they read.
+
+Consistency is kept with a seqlock per slot: the writer makes the sequence
+number odd while it writes and even again when done, and readers retry
+their copy if the number was odd or changed meanwhile. Readers never block
+the writer.
+
+The segment describes its own layout, so readers only need this module:
+
+    reader = SharedTelemetryReader()
+    reader.latest('ATTITUDE')['roll']
+    [record['chan1_raw'] for record in reader.history('RC_CHANNELS')]
+
+Layout, all little endian:
+
+    header:     magic 'ASAC', version u16, number of slots u16, history u32
+    directory:  per slot, name 48s, record struct format 64s,
+                comma separated field names 512s, record size u32, offset u64
+    slot:       sequence u64, records written u64, `history` records of
+                receive time (time.monotonic) f64 + payload in wire order
+'''
+from pymavlink.dialects.v20 import common
+from pymavlink.dialects.v20.common import (MAVLink_message, PROTOCOL_MARKER_V1,
+                                           MAVLINK_IFLAG_SIGNED,
+                                           MAVLINK_SIGNATURE_BLOCK_LEN)
+from multiprocessing import resource_tracker, shared_memory
+from typing import Any, Dict, List, Tuple
+import re
+import struct
+import time
+
+
+__all__ = ['SharedTelemetryWriter', 'SharedTelemetryReader', 'DEFAULT_NAME']
+
+
+DEFAULT_NAME = 'asac_telemetry'
+DEFAULT_MESSAGES = [
+    common.MAVLink_attitude_message,
+    common.MAVLink_rc_channels_message,
+]
+
+MAGIC = b'ASAC'
+VERSION = 2
+TIME_FIELD = '_time'
+
+_HEADER = struct.Struct('<4sHHI')
+_NAME_SIZE = 48
+_FORMAT_SIZE = 64
+_FIELDNAMES_SIZE = 512
+_DIRECTORY_ENTRY = struct.Struct(f'<{_NAME_SIZE}s{_FORMAT_SIZE}s{_FIELDNAMES_SIZE}sIQ')
+# Sequence number, records written
+_SLOT_HEADER = struct.Struct('<QQ')
+_TIME = struct.Struct('<d')
+_FORMAT_TOKEN = re.compile(r'(\d*)([a-zA-Z?])')
+
+
+class _Slot:
+
+    def __init__(self, msg_type: type, offset: int, history: int) -> None:
+        self.name = msg_type.msgname.encode()
+        self.record_format = ('<d' + msg_type.unpacker.format[1:]).encode()
+        self.fieldnames = ','.join(msg_type.ordered_fieldnames).encode()
+        # struct would silently truncate them in the directory
+        for value, size in ((self.name, _NAME_SIZE),
+                            (self.record_format, _FORMAT_SIZE),
+                            (self.fieldnames, _FIELDNAMES_SIZE)):
+            if len(value) > size:
+                raise ValueError(f'{msg_type.msgname} does not fit in the directory, '
+                                 f'{len(value)} > {size} bytes')
+        self.offset = offset
+        self.payload_size = msg_type.unpacker.size
+        self.record_size = _TIME.size + self.payload_size
+        self.records_offset = offset + _SLOT_HEADER.size
+        self.history = history
+        self.seq = 0
+        self.count = 0
+        self.size = _SLOT_HEADER.size + history * self.record_size
+
+
+class SharedTelemetryWriter:
+    '''
+    Publishes received messages of the given types in a shared memory
+    segment, see the module docstring. Call `close` when done, which also
+    removes the segment.
+
+    history: Number of records kept per message type, at least 1
+    '''
+
+    def __init__(self,
+                 name: str = DEFAULT_NAME,
+                 msg_types: List[type] = None,
+                 history: int = 1) -> None:
+        if msg_types is None:
+            msg_types = DEFAULT_MESSAGES
+        history = max(1, history)
+
+        offset = _HEADER.size + len(msg_types) * _DIRECTORY_ENTRY.size
+        self._slots: Dict[type, _Slot] = {}
+        for msg_type in msg_types:
+            slot = _Slot(msg_type, offset, history)
+            self._slots[msg_type] = slot
+            offset += slot.size
+
+        try:
+            self._shm = shared_memory.SharedMemory(name, create=True, size=offset)
+        except FileExistsError:
+            # Left behind by a process that didn't exit cleanly
+            stale = shared_memory.SharedMemory(name)
+            stale.close()
+            stale.unlink()
+            self._shm = shared_memory.SharedMemory(name, create=True, size=offset)
+        self.name = name
+
+        buf = self._shm.buf
+        buf[:offset] = bytes(offset)
+        _HEADER.pack_into(buf, 0, MAGIC, VERSION, len(msg_types), history)
+        for i, slot in enumerate(self._slots.values()):
+            _DIRECTORY_ENTRY.pack_into(
+                buf, _HEADER.size + i * _DIRECTORY_ENTRY.size,
+                slot.name,
+                slot.record_format,
+                slot.fieldnames,
+                slot.record_size,
+                slot.offset)
+        self._attached: List['ASAC'] = []
+
+    def write(self, msg: MAVLink_message, timestamp: float = None) -> None:
+        '''
+        Message handler. Must not be called from more than one thread at a
+        time for the same message type, which is the case for inline handlers.
+        '''
+        slot = self._slots.get(type(msg))
+        if slot is None:
+            return
+        if timestamp is None:
+            timestamp = time.monotonic()
+
+        # The payload is taken as is from the frame, instead of packing the
+        # fields again.
+        msgbuf = msg.get_msgbuf()
+        if msgbuf[0] == PROTOCOL_MARKER_V1:
+            start = 6
+            end = len(msgbuf) - 2
+        else:
+            start = 10
+            end = len(msgbuf) - 2
+            if msgbuf[2] & MAVLINK_IFLAG_SIGNED:
+                end -= MAVLINK_SIGNATURE_BLOCK_LEN
+        end = min(end, start + slot.payload_size)
+
+        buf = self._shm.buf
+        record = slot.records_offset + (slot.count % slot.history) * slot.record_size
+        payload = record + _TIME.size
+        payload_len = end - start
+
+        slot.seq += 1
+        _SLOT_HEADER.pack_into(buf, slot.offset, slot.seq, slot.count)
+        _TIME.pack_into(buf, record, timestamp)
+        buf[payload:payload + payload_len] = msgbuf[start:end]
+        if payload_len < slot.payload_size:
+            # Truncated MAVLink 2 payload
+            buf[payload + payload_len:payload + slot.payload_size] = bytes(slot.payload_size - payload_len)
+        slot.count += 1
+        slot.seq += 1
+        _SLOT_HEADER.pack_into(buf, slot.offset, slot.seq, slot.count)
+
+    def attach(self, asac: 'ASAC') -> None:
+        ''' Publishes the messages of an ASAC session. '''
+        for msg_type in self._slots:
+            asac.add_message_handler(msg_type, self.write)
+        self._attached.append(asac)
+
+    def close(self) -> None:
+        for asac in self._attached:
+            for msg_type in self._slots:
+                asac.del_message_handler(msg_type, self.write)
+        self._attached.clear()
+        self._shm.close()
+        self._shm.unlink()
+
+
+class _ReaderSlot:
+
+    def __init__(self, record_format: str, fieldnames: List[str], record_size: int,
+                 offset: int, history: int) -> None:
+        self.record = struct.Struct(record_format)
+        if self.record.size != record_size:
+            raise ValueError(f'Bad record format {record_format}')
+        self.offset = offset
+        self.records_offset = offset + _SLOT_HEADER.size
+        self.history = history
+        # (name, number of values, is an array) per field, in wire order
+        self.fields: List[Tuple[str, int, bool]] = []
+        for name, (count, code) in zip(fieldnames, _FORMAT_TOKEN.findall(record_format[2:])):
+            is_array = code != 's' and count not in ('', '1')
+            self.fields.append((name, int(count) if is_array else 1, is_array))
+
+    def to_dict(self, data: bytes) -> Dict[str, Any]:
+        values = self.record.unpack(data)
+        record = {TIME_FIELD: values[0]}
+        i = 1
+        for name, count, is_array in self.fields:
+            if is_array:
+                record[name] = list(values[i:i + count])
+            elif isinstance(values[i], bytes):
+                record[name] = values[i].rstrip(b'\x00').decode(errors='replace')
+            else:
+                record[name] = values[i]
+            i += count
+        return record
+
+
+class SharedTelemetryReader:
+    '''
+    Reads the telemetry published by a SharedTelemetryWriter, possibly in
+    another process. Records are dicts of the MAVLink fields, plus `_time`,
+    the receive time as time.monotonic() of the writer, which is the same
+    clock in all processes on the machine.
+    '''
+
+    # A read that keeps colliding with writes gives up after this many tries
+    MAX_ATTEMPTS = 1000
+
+    def __init__(self, name: str = DEFAULT_NAME) -> None:
+        try:
+            self._shm = shared_memory.SharedMemory(name, track=False)
+        except TypeError:
+            # Before Python 3.13, every process that attaches would remove
+            # the segment on exit, so keep it from being registered
+            register = resource_tracker.register
+            resource_tracker.register = lambda *_: None
+            try:
+                self._shm = shared_memory.SharedMemory(name)
+            finally:
+                resource_tracker.register = register
+
+        buf = self._shm.buf
+        magic, version, nbr_of_slots, history = _HEADER.unpack_from(buf, 0)
+        if magic != MAGIC or version != VERSION:
+            self._shm.close()
+            raise ValueError(f'{name} is not an ASAC telemetry segment of version {VERSION}')
+
+        self._slots: Dict[str, _ReaderSlot] = {}
+        for i in range(nbr_of_slots):
+            msg_name, record_format, fieldnames, record_size, offset = \
+                _DIRECTORY_ENTRY.unpack_from(buf, _HEADER.size + i * _DIRECTORY_ENTRY.size)
+            self._slots[msg_name.rstrip(b'\x00').decode()] = _ReaderSlot(
+                record_format.rstrip(b'\x00').decode(),
+                fieldnames.rstrip(b'\x00').decode().split(','),
+                record_size, offset, history)
+
+    def message_types(self) -> List[str]:
+        return list(self._slots)
+
+    def count(self, msg_name: str) -> int:
+        ''' Returns how many messages of the type have been written. '''
+        _, count = _SLOT_HEADER.unpack_from(self._shm.buf, self._slots[msg_name].offset)
+        return count
+
+    def latest(self, msg_name: str) -> Dict[str, Any]:
+        ''' Returns the latest record, or None if there is none yet. '''
+        records = self.history(msg_name, 1)
+        return records[0] if records else None
+
+    def history(self, msg_name: str, n: int = None) -> List[Dict[str, Any]]:
+        ''' Returns up to the last `n` records, oldest first. '''
+        slot = self._slots[msg_name]
+        if n is None or n > slot.history:
+            n = slot.history
+        size = slot.record.size
+        buf = self._shm.buf
+
+        for _ in range(self.MAX_ATTEMPTS):
+            seq, count = _SLOT_HEADER.unpack_from(buf, slot.offset)
+            if seq & 1:
+                # Being written
+                time.sleep(0)
+                continue
+            records = []
+            for i in range(max(0, count - n), count):
+                start = slot.records_offset + (i % slot.history) * size
+                records.append(bytes(buf[start:start + size]))
+            if _SLOT_HEADER.unpack_from(buf, slot.offset)[0] == seq:
+                return [slot.to_dict(record) for record in records]
+        raise TimeoutError(f'Could not get a consistent read of {msg_name}')
+
+    def close(self) -> None:
+        self._shm.close()
@@ -0,0 +1,167 @@
+from pymavlink.dialects.v20.common import MAVLink_message
+from concurrent.futures import Future
+from threading import Event, Lock
+from serial.serialutil import SerialException
+from typing import Any, Dict
+from commands import CommandError, CommandTimeout
+
+
+__all__ = ['StreamRateController']
+
+
+class StreamRateController:
+    '''
+    Decides at what rate the vehicle should stream each message, and sends
+    MAV_CMD_SET_MESSAGE_INTERVAL requests when that changes.
+
+    Consumers (eg content pages) request a rate for a message type while
+    they need it, and release it when they don't. The rate we ask for is the
+    highest requested rate, or the default rate of the message if nobody has
+    requested it. Only messages that have a default rate or a request are
+    touched at all.
+
+    When the measured link load nears the capacity of the link, all
+    requested rates are scaled down, and then scaled back up once the load
+    is low again. Rates never go below the default rate.
+    '''
+
+    HIGH_LOAD = 0.8
+    LOW_LOAD = 0.5
+    MIN_SCALE = 0.1
+
+    def __init__(self, asac: 'ASAC') -> None:
+        self._asac = asac
+        self._lock = Lock()
+        self._default_rates: Dict[int, float] = {}
+        self._requests: Dict[int, Dict[Any, float]] = {}
+        # Rates the vehicle has accepted, of the messages that aren't at
+        # their default rate
+        self._sent_rates: Dict[int, float] = {}
+        # Rates sent but not yet acked
+        self._in_flight: Dict[int, float] = {}
+        # Rates the vehicle said no to
+        self._rejected: Dict[int, float] = {}
+        self._scale = 1.0
+        self._changed = Event()
+        # Bumped on every reset, so that a run thread from a previous
+        # connection stops even if we reconnect before it notices.
+        self._generation = 0
+
+    def set_default_rate(self, msg_type: MAVLink_message, rate_hz: float) -> None:
+        with self._lock:
+            self._default_rates[msg_type.id] = rate_hz
+        self._changed.set()
+
+    def request(self, owner: Any, msg_type: MAVLink_message, rate_hz: float) -> None:
+        with self._lock:
+            self._requests.setdefault(msg_type.id, {})[owner] = rate_hz
+        self._changed.set()
+
+    def release(self, owner: Any, msg_type: MAVLink_message) -> None:
+        with self._lock:
+            requests = self._requests.get(msg_type.id, {})
+            requests.pop(owner, None)
+        self._changed.set()
+
+    def effective_rates(self) -> Dict[int, float]:
+        ''' Returns the rate we want for each managed message ID. '''
+        with self._lock:
+            rates = {}
+            for msg_id in self._default_rates.keys() | self._requests.keys():
+                default = self._default_rates.get(msg_id, 0)
+                requests = self._requests.get(msg_id)
+                if requests:
+                    rate = max(default, max(requests.values()) * self._scale)
+                else:
+                    rate = default
+                if rate > 0:
+                    rates[msg_id] = round(rate, 1)
+            return rates
+
+    def reset(self) -> None:
+        ''' Forgets what's been sent, so that all rates are sent again. '''
+        with self._lock:
+            self._sent_rates.clear()
+            self._in_flight.clear()
+            self._rejected.clear()
+            self._scale = 1.0
+            self._generation += 1
+        self._changed.set()
+
+    def run(self, stop_flag: Event) -> None:
+        ''' Runs until the stop flag is set, meant to be run in a thread. '''
+        generation = self._generation
+        while not stop_flag.is_set():
+            self._changed.wait(timeout=1)
+            self._changed.clear()
+            if stop_flag.is_set() or generation != self._generation:
+                break
+            self._update_scale()
+            self._send_changed_rates()
+
+    def _update_scale(self) -> None:
+        capacity = self._asac.link_capacity()
+        if not capacity:
+            return
+
+        load = self._asac.link_stats.snapshot().bytes_per_s / capacity
+        scale = self._scale
+        if load > self.HIGH_LOAD:
+            scale = max(self.MIN_SCALE, scale * 0.7)
+        elif load < self.LOW_LOAD:
+            scale = min(1.0, scale * 1.25)
+
+        if scale != self._scale:
+            self._asac.logger.info(f'Link load {load*100:.0f}%, scaling stream rates to {scale*100:.0f}%')
+            self._scale = scale
+
+    def _send_changed_rates(self) -> None:
+        rates = self.effective_rates()
+        to_send = []
+        with self._lock:
+            # Messages nobody cares about anymore go back to the vehicle's
+            # default, which is asked for with a rate of 0.
+            for msg_id in self._sent_rates:
+                rates.setdefault(msg_id, 0)
+            for msg_id, rate in rates.items():
+                sent = self._sent_rates.get(msg_id, 0)
+                if (sent == rate or self._in_flight.get(msg_id) == rate
+                        or self._rejected.get(msg_id) == rate):
+                    continue
+                self._in_flight[msg_id] = rate
+                to_send.append((msg_id, rate))
+            generation = self._generation
+
+        for msg_id, rate in to_send:
+            try:
+                future = self._asac.set_message_interval(msg_id, rate)
+            except SerialException:
+                # Disconnected, everything is sent again on reconnect
+                return
+            future.add_done_callback(
+                lambda future, msg_id=msg_id, rate=rate: self._on_rate_set(future, msg_id, rate, generation))
+
+    def _on_rate_set(self, future: Future, msg_id: int, rate: float, generation: int) -> None:
+        '''
+        Records the rate once the vehicle has accepted it. Rates that timed
+        out are sent again on the next run, while rates the vehicle rejected
+        aren't, until they change.
+        '''
+        error = None if future.cancelled() else future.exception()
+        with self._lock:
+            if generation != self._generation:
+                return
+            if self._in_flight.get(msg_id) == rate:
+                del self._in_flight[msg_id]
+            if future.cancelled():
+                return
+            if error is None:
+                if rate:
+                    self._sent_rates[msg_id] = rate
+                else:
+                    self._sent_rates.pop(msg_id, None)
+                self._rejected.pop(msg_id, None)
+            elif isinstance(error, CommandError) and not isinstance(error, CommandTimeout):
+                self._rejected[msg_id] = rate
+        if error is not None:
+            self._asac.logger.debug(f'Failed to set the rate of message {msg_id} to {rate} Hz: {error}')
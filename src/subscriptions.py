@@ -0,0 +1,100 @@
+from pymavlink.dialects.v20.common import MAVLink_message
+from threading import Lock
+from typing import Callable
+from scheduler import TimerHandle, get_scheduler
+
+
+__all__ = ['Subscription']
+
+
+class Subscription:
+    '''
+    Handle of a message handler, returned by ASAC.subscribe. Cancelling it
+    removes the handler.
+
+    The callback is only called with the messages that `predicate`, if
+    given, returns True for. A one-shot subscription is cancelled by the
+    first message it delivers, so it's called at most once, whatever the
+    execution policy of its handler. A subscription with a timeout is
+    cancelled if nothing was delivered in time, and `on_timeout` is then
+    called from the scheduler timer pool.
+    '''
+
+    def __init__(self,
+                 msg_type: MAVLink_message,
+                 callback: Callable[[MAVLink_message], None],
+                 remove: Callable[['Subscription'], None],
+                 predicate: Callable[[MAVLink_message], bool] = None,
+                 once: bool = False,
+                 on_timeout: Callable[[], None] = None) -> None:
+        '''
+        remove: Removes the handler of the subscription
+        '''
+        self.msg_type = msg_type
+        self.callback = callback
+        self.predicate = predicate
+        self.once = once
+        self.on_timeout = on_timeout
+        self._remove = remove
+        self._lock = Lock()
+        self._active = True
+        self._delivered = False
+        self._timer: TimerHandle = None
+
+    @property
+    def active(self) -> bool:
+        return self._active
+
+    def set_timeout(self, timeout_s: float) -> None:
+        ''' Cancels the subscription if nothing is delivered within timeout_s. '''
+        with self._lock:
+            if not self._active or self._delivered:
+                return
+            if self._timer is not None:
+                self._timer.cancel()
+            self._timer = get_scheduler().call_later(timeout_s, self._expire)
+
+    def cancel(self) -> None:
+        ''' Removes the handler. Does nothing if already cancelled. '''
+        with self._lock:
+            if not self._active:
+                return
+            self._active = False
+        self._close()
+
+    def __call__(self, msg: MAVLink_message) -> None:
+        ''' Message handler. '''
+        if self.predicate is not None and not self.predicate(msg):
+            return
+
+        with self._lock:
+            if not self._active:
+                return
+            self._delivered = True
+            timer, self._timer = self._timer, None
+            if self.once:
+                self._active = False
+
+        if timer is not None:
+            timer.cancel()
+        if self.once:
+            self._close()
+        self.callback(msg)
+
+    def __repr__(self) -> str:
+        name = getattr(self.callback, '__qualname__', repr(self.callback))
+        return f'{name} (once)' if self.once else name
+
+    def _expire(self) -> None:
+        with self._lock:
+            if not self._active or self._delivered:
+                return
+            self._active = False
+        self._close()
+        if self.on_timeout is not None:
+            self.on_timeout()
+
+    def _close(self) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+        self._remove(self)
@@ -0,0 +1,140 @@
+from pymavlink.dialects.v20 import common
+from collections import deque
+from dataclasses import dataclass
+from threading import Lock
+from typing import Callable, Deque, Set, Tuple
+import time
+
+
+__all__ = ['TimeSync', 'RttStats']
+
+
+@dataclass
+class RttStats:
+    samples: int
+    last_ms: float
+    min_ms: float
+    avg_ms: float
+    max_ms: float
+    # Mean deviation, as used for the timeout
+    jitter_ms: float
+    # Vehicle clock minus GCS clock
+    offset_ms: float
+
+
+class TimeSync:
+    '''
+    Measures the round trip time of the link, and the offset between the
+    vehicle clock and ours, with TIMESYNC messages.
+
+    We send tc1=0 and ts1=our time. The vehicle answers with tc1=its time and
+    ts1 unchanged, so the round trip time is the time since ts1, and the
+    vehicle time was tc1 at about halfway through the round trip. The offset
+    is taken from the sample with the lowest RTT in the window, since it has
+    the least room for asymmetric delays.
+
+    The vehicle clock is assumed to count from boot, as in ArduPilot and
+    PX4, so that `time_boot_ms` of eg ATTITUDE can be mapped to our time.
+
+    The smoothed RTT and its deviation are kept as in TCP (RFC 6298), and
+    give the adaptive timeout.
+    '''
+
+    WINDOW = 20
+    _ALPHA = 1 / 8
+    _BETA = 1 / 4
+    # A jump in offset larger than this means the vehicle has rebooted
+    _OFFSET_JUMP_NS = 1e9
+    # Requests that aren't answered by then are forgotten
+    _REQUEST_TIMEOUT_NS = 10e9
+    MAX_TIMEOUT_S = 5
+
+    def __init__(self, send: Callable[[int, int], None]) -> None:
+        '''
+        send: Sends a TIMESYNC with (tc1, ts1)
+        '''
+        self._send = send
+        self._lock = Lock()
+        self.reset()
+
+    def reset(self) -> None:
+        with self._lock:
+            # (rtt, offset), in ns
+            self._samples: Deque[Tuple[int, int]] = deque(maxlen=self.WINDOW)
+            # ts1 of requests we've sent
+            self._pending: Set[int] = set()
+            self._srtt_ns: float = None
+            self._rttvar_ns: float = None
+            self._offset_ns: int = None
+
+    def send_request(self) -> None:
+        now = time.monotonic_ns()
+        with self._lock:
+            for ts1 in [ts1 for ts1 in self._pending if now - ts1 > self._REQUEST_TIMEOUT_NS]:
+                self._pending.remove(ts1)
+            self._pending.add(now)
+        self._send(0, now)
+
+    def handle_message(self, msg: common.MAVLink_timesync_message) -> None:
+        now = time.monotonic_ns()
+        if msg.tc1 == 0:
+            # A request from the vehicle
+            self._send(now, msg.ts1)
+            return
+
+        with self._lock:
+            if msg.ts1 not in self._pending:
+                # Not one of ours, or a duplicate
+                return
+            self._pending.remove(msg.ts1)
+
+            rtt = now - msg.ts1
+            offset = msg.tc1 - (msg.ts1 + now) // 2
+            if self._offset_ns is not None and abs(offset - self._offset_ns) > self._OFFSET_JUMP_NS:
+                self._samples.clear()
+            self._samples.append((rtt, offset))
+            self._offset_ns = min(self._samples)[1]
+
+            if self._srtt_ns is None:
+                self._srtt_ns = rtt
+                self._rttvar_ns = rtt / 2
+            else:
+                self._rttvar_ns += self._BETA * (abs(self._srtt_ns - rtt) - self._rttvar_ns)
+                self._srtt_ns += self._ALPHA * (rtt - self._srtt_ns)
+
+    def stats(self) -> RttStats:
+        ''' Returns None until there are any samples. '''
+        with self._lock:
+            if not self._samples:
+                return None
+            rtts = [rtt for rtt, _ in self._samples]
+            return RttStats(
+                samples=len(rtts),
+                last_ms=rtts[-1] / 1e6,
+                min_ms=min(rtts) / 1e6,
+                avg_ms=self._srtt_ns / 1e6,
+                max_ms=max(rtts) / 1e6,
+                jitter_ms=self._rttvar_ns / 1e6,
+                offset_ms=self._offset_ns / 1e6
+            )
+
+    def timeout_s(self, default: float, minimum: float = 0.1) -> float:
+        '''
+        Returns how long to wait for an answer, based on the measured RTT,
+        or `default` if we have no measurements yet.
+        '''
+        srtt, rttvar = self._srtt_ns, self._rttvar_ns
+        if srtt is None:
+            return default
+        timeout = (srtt + 4 * rttvar) / 1e9
+        return min(max(timeout, minimum), self.MAX_TIMEOUT_S)
+
+    def to_local_time(self, time_boot_ms: int) -> float:
+        '''
+        Returns the time.monotonic() time of the given vehicle time, or None
+        if the offset isn't known yet.
+        '''
+        offset = self._offset_ns
+        if offset is None:
+            return None
+        return (time_boot_ms * 1e6 - offset) / 1e9
@@ -1,17 +1,71 @@
-from threading import Thread
+import atexit
 import logging
+import logging.handlers
+import os
+import queue
 import sys
-from typing import Union
+import time
+from concurrent.futures import InvalidStateError
+from typing import Any, Callable, List, Tuple, Union
 
 _logger: logging.Logger = None
+_listener: '_LogListener' = None
+_queue_handler: '_DroppingQueueHandler' = None
+_console_handler: logging.StreamHandler = None
+_file_handler: logging.Handler = None
 
+# Records waiting to be written, after which new ones are dropped
+LOG_QUEUE_SIZE = 10000
+LOG_FILE_MAX_BYTES = 5 * 1024 * 1024
+LOG_FILE_BACKUPS = 3
 
-def run_thread(function: callable, *args) -> None:
-    Thread(target=function, args=args, daemon=True).start()
+LOG_FORMAT = '%(asctime)s %(levelname)s %(message)s'
+# One line per record, with the time as seconds since the epoch
+COMPACT_LOG_FORMAT = '%(created).3f %(levelname).1s %(name)s %(message)s'
 
 
-def get_logger() -> logging.Logger:
-    global _logger
+class _DroppingQueueHandler(logging.handlers.QueueHandler):
+    '''
+    Hands records over to the listener thread, without ever blocking. If
+    the listener can't keep up, records are dropped and counted instead.
+    '''
+
+    def __init__(self, log_queue: queue.Queue) -> None:
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # Formatting is left to the listener thread. Only the message is
+        # resolved here, since the arguments may change after the call.
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class _LogListener(logging.handlers.QueueListener):
+
+    def enqueue_sentinel(self) -> None:
+        # Waits for room, so that everything queued is written on stop
+        self.queue.put(self._sentinel)
+
+
+def get_logger(subsystem: str = None) -> logging.Logger:
+    '''
+    Returns the ASAC logger, or the logger of a subsystem, eg 'ftp', whose
+    level can be set on its own, see set_log_levels.
+
+    Records are written by a background thread, so logging never blocks the
+    calling thread. The levels are taken from ASAC_LOG_LEVEL, eg
+    `ASAC_LOG_LEVEL=INFO,ftp=DEBUG,bridge=WARNING`, and records are also
+    written to the file ASAC_LOG_FILE, if set.
+    '''
+    global _logger, _listener, _queue_handler, _console_handler
     if _logger is None:
         logging.basicConfig(
             level=logging.DEBUG,
@@ -19,20 +73,127 @@ def get_logger() -> logging.Logger:
         )
         # Setup logging
         _logger = logging.getLogger('asac')
-        formatter = logging.Formatter('%(asctime)s %(levelname)s %(message)s')
-        handler = logging.StreamHandler(sys.stdout)
-        handler.setFormatter(formatter)
-        _logger.addHandler(handler)
+        _console_handler = logging.StreamHandler(sys.stdout)
+        _console_handler.setFormatter(logging.Formatter(LOG_FORMAT))
+
+        _queue_handler = _DroppingQueueHandler(queue.Queue(LOG_QUEUE_SIZE))
+        _logger.addHandler(_queue_handler)
+        _listener = _LogListener(_queue_handler.queue, _console_handler,
+                                 respect_handler_level=True)
+        _listener.start()
+        # Writes what's still queued
+        atexit.register(_listener.stop)
 
         # Without this, python does some stupid magic double logging...
         _logger.propagate = False
 
+        _logger.setLevel(logging.INFO)
+        set_log_levels(os.environ.get('ASAC_LOG_LEVEL', ''))
+        if os.environ.get('ASAC_LOG_FILE'):
+            set_log_file(os.environ['ASAC_LOG_FILE'])
+
+    if subsystem is not None:
+        return _logger.getChild(subsystem)
     return _logger
 
 
+def set_log_levels(levels: str) -> None:
+    '''
+    Sets the levels of the ASAC logger and its subsystems, from eg
+    'INFO,ftp=DEBUG'. A level without a name is for the ASAC logger, which
+    is also used by subsystems without a level of their own.
+    '''
+    logger = get_logger()
+    for item in filter(None, (item.strip() for item in levels.split(','))):
+        subsystem, _, level = item.rpartition('=')
+        level = level.upper()
+        if not isinstance(logging.getLevelName(level), int):
+            logger.warning(f'Unknown log level {level}')
+            continue
+        if subsystem:
+            logger.getChild(subsystem).setLevel(level)
+        else:
+            logger.setLevel(level)
+
+
+def set_log_file(path: str) -> None:
+    '''
+    Also writes the log to the given file, one compact line per record,
+    rotated when it grows large. None stops writing to file.
+    '''
+    global _file_handler
+    get_logger()
+    handlers = [_console_handler]
+    if _file_handler is not None:
+        _file_handler.close()
+        _file_handler = None
+    if path is not None:
+        _file_handler = logging.handlers.RotatingFileHandler(
+            path, maxBytes=LOG_FILE_MAX_BYTES, backupCount=LOG_FILE_BACKUPS)
+        _file_handler.setFormatter(logging.Formatter(COMPACT_LOG_FORMAT))
+        handlers.append(_file_handler)
+    # Handlers are only read by the listener thread between records
+    _listener.handlers = tuple(handlers)
+
+
+def add_log_handler(handler: logging.Handler) -> None:
+    ''' Adds a handler, which is called from the logging thread. '''
+    get_logger()
+    _listener.handlers = _listener.handlers + (handler, )
+
+
+def dropped_log_records() -> int:
+    ''' Returns how many records have been dropped since the queue was full. '''
+    get_logger()
+    return _queue_handler.dropped
+
+
+def set_log_stream(stream) -> None:
+    ''' Changes where the ASAC logger writes to, eg to keep stdout clean. '''
+    get_logger()
+    _console_handler.setStream(stream)
+
+
+def try_set(set_outcome: Callable[[Any], None], value: Any) -> bool:
+    '''
+    Sets the result or exception of a future, eg try_set(future.set_result,
+    msg), unless it's done already, eg cancelled by its caller. Returns
+    False if it was.
+    '''
+    try:
+        set_outcome(value)
+    except InvalidStateError:
+        return False
+    return True
+
+
 def constrain(value: Union[int, float], min: Union[int, float], max: Union[int, float]) -> Union[int, float]:
     if value < min:
         return min
     if value > max:
         return max
     return value
+
+
+class StartupProfile:
+    '''
+    Simple timeline of named startup steps, relative to when the profile
+    was created. Used to report how long it takes to get the GUI up.
+    '''
+
+    def __init__(self) -> None:
+        self._t0 = time.perf_counter()
+        self._last = self._t0
+        self._steps: List[Tuple[str, float, float]] = []
+
+    def mark(self, step: str) -> None:
+        ''' Marks the end of the given step. '''
+        now = time.perf_counter()
+        self._steps.append((step, now - self._last, now - self._t0))
+        self._last = now
+
+    def report(self) -> str:
+        lines = ['Startup profile:']
+        for step, duration, total in self._steps:
+            lines.append(f'    {step:<20} {duration*1000:7.1f} ms  (total {total*1000:7.1f} ms)')
+        return '\n'.join(lines)